@@ -0,0 +1,311 @@
+"""Time the bot's answers to queries on seeded synthetic game states, and write the timings as JSON so
+runs on two commits can be compared.
+
+Every case is one query on one board: a phase of the game, a player count, a map size and a
+recording length. Boards are built on the local engine's LocalBoard, which offers the same
+`game.state` surface as the client, with each player's territories grown out from a random start the
+way they end up after some turns of play, and a recording of made-up turns (claims and placements in
+the setup phases) leading up to the query. Each call goes through `choose_move`, so it includes
+catching up with the recording. A case makes --warmup untimed calls, then times --repeats runs of
+--number calls each. By default every call starts cold, with a new bot state, so a call costs what it
+does the first time a board (and its recording) is seen; --warm keeps the state, so the recording
+has been read by the time calls are timed. The "path" phase isn't a query, so it times the path
+search directly, after catching up. The attack search is turned off unless --search-budget is given,
+so the work done is the same on every run, and the watchdog is given an hour, so slow cases are
+timed in full rather than as their fallback.
+
+    python benchmark.py --out before.json
+    python benchmark.py --compare before.json --out after.json
+"""
+
+import argparse
+from collections import deque
+import contextlib
+import io
+import json
+import platform
+import random
+import statistics
+import time
+from types import ModuleType
+from typing import Any, Callable, Optional
+
+from local_engine import LocalBoard, LocalGame, LocalMap
+from risk_shared.queries.query_attack import QueryAttack
+from risk_shared.queries.query_claim_territory import QueryClaimTerritory
+from risk_shared.queries.query_defend import QueryDefend
+from risk_shared.queries.query_distribute_troops import QueryDistributeTroops
+from risk_shared.queries.query_fortify import QueryFortify
+from risk_shared.queries.query_place_initial_troop import QueryPlaceInitialTroop
+from risk_shared.queries.query_redeem_cards import QueryRedeemCards
+from risk_shared.queries.query_troops_after_attack import QueryTroopsAfterAttack
+from risk_shared.records.moves.move_attack import MoveAttack
+from risk_shared.records.moves.move_attack_pass import MoveAttackPass
+from risk_shared.records.moves.move_claim_territory import MoveClaimTerritory
+from risk_shared.records.moves.move_defend import MoveDefend
+from risk_shared.records.moves.move_distribute_troops import MoveDistributeTroops
+from risk_shared.records.moves.move_fortify import MoveFortify
+from risk_shared.records.moves.move_fortify_pass import MoveFortifyPass
+from risk_shared.records.moves.move_place_initial_troop import MovePlaceInitialTroop
+from risk_shared.records.moves.move_troops_after_attack import MoveTroopsAfterAttack
+from risk_shared.records.record_attack import RecordAttack
+from risk_shared.records.record_start_turn import RecordStartTurn
+from tournament import load_bot
+
+
+PHASES = ["claim", "place", "redeem", "distribute", "attack", "troops_after_attack", "defend", "fortify", "path"]
+
+# We are always player 0.
+ME = 0
+
+
+def make_map(seed: int, territories: int) -> LocalMap:
+    """A classic-shaped map for the classic size, and a large generated one otherwise."""
+    return LocalMap.generate(seed) if territories == 43 else LocalMap.generate_large(seed, territories)
+
+
+def grow_territories(board: LocalBoard, players: int, fraction: float, rng: random.Random) -> None:
+    """Hand out `fraction` of the territories, each player's grown out from a random start."""
+    territories = list(board.territories)
+    wanted = int(len(territories) * fraction)
+    frontiers = [deque([start]) for start in rng.sample(territories, players)]
+    claimed = 0
+    while claimed < wanted and any(frontiers):
+        for player, frontier in enumerate(frontiers):
+            while frontier and board.territories[frontier[0]].occupier is not None:
+                frontier.popleft()
+            if not frontier or claimed >= wanted:
+                continue
+            territory = frontier.popleft()
+            board.territories[territory].occupier = player
+            board.territories[territory].troops = 1
+            claimed += 1
+            neighbours = list(board.map.get_adjacent_to(territory))
+            rng.shuffle(neighbours)
+            frontier.extend(neighbours)
+
+    # Anything the growth couldn't reach goes to whoever.
+    for territory in territories[:]:
+        if claimed >= wanted:
+            break
+        if board.territories[territory].occupier is None:
+            board.territories[territory].occupier = rng.randrange(players)
+            board.territories[territory].troops = 1
+            claimed += 1
+
+
+def synthetic_records(board: LocalBoard, players: int, count: int, setup: bool, rng: random.Random) -> list:
+    """`count` records of the kind a game has by the time it is in this phase. In the setup phases they
+    are claims and placements; after that, turns of distributing, attacking and fortifying between
+    neighbouring territories on the board. The records don't have to add up to the board, since the
+    bot reads troops and owners from the game state, but every reference in them is to a real
+    territory or record."""
+    owned: list[list[int]] = [[] for _ in range(players)]
+    attacks: list[list[tuple[int, int]]] = [[] for _ in range(players)]
+    for territory, model in board.territories.items():
+        if model.occupier is None:
+            continue
+        owned[model.occupier].append(territory)
+        for neighbour in board.map.get_adjacent_to(territory):
+            if board.territories[neighbour].occupier not in (None, model.occupier):
+                attacks[model.occupier].append((territory, neighbour))
+
+    records: list = []
+    player = 0
+    while len(records) < count:
+        player = (player + 1) % players
+        if not owned[player]:
+            continue
+        if setup:
+            territory = rng.choice(owned[player])
+            records.append(MoveClaimTerritory(move_by_player=player, territory=territory) if rng.random() < 0.5 else MovePlaceInitialTroop(move_by_player=player, territory=territory))
+            continue
+
+        troops = 3 + rng.randrange(5)
+        records.append(RecordStartTurn(player=player, troops_gained=troops))
+        records.append(MoveDistributeTroops(move_by_player=player, distributions={rng.choice(owned[player]): troops}, cause="turn_started"))
+        for _ in range(rng.randrange(8) if attacks[player] else 0):
+            source, target = rng.choice(attacks[player])
+            defender = board.territories[target].occupier
+            records.append(MoveAttack(move_by_player=player, attacking_territory=source, defending_territory=target, attacking_troops=rng.randint(1, 3)))
+            move_attack_id = len(board.recording) + len(records) - 1
+            records.append(MoveDefend(move_by_player=defender, move_attack_id=move_attack_id, defending_troops=rng.randint(1, 2)))
+            attacking_lost = rng.randint(0, 2)
+            conquered = rng.random() < 0.2
+            records.append(RecordAttack(move_attack_id=move_attack_id, attacking_lost=attacking_lost, defending_lost=2 - attacking_lost, territory_conquered=conquered, defender_eliminated=False))
+            if conquered:
+                records.append(MoveTroopsAfterAttack(move_by_player=player, record_attack_id=len(board.recording) + len(records) - 1, troop_count=rng.randint(1, 3)))
+        records.append(MoveAttackPass(move_by_player=player))
+        if len(owned[player]) > 1 and rng.random() < 0.5:
+            source, target = rng.sample(owned[player], 2)
+            records.append(MoveFortify(move_by_player=player, source_territory=source, target_territory=target, troop_count=1))
+        else:
+            records.append(MoveFortifyPass(move_by_player=player))
+    return records[:count]
+
+
+def adjacent_pair(board: LocalBoard, rng: random.Random) -> tuple[int, int]:
+    """One of our territories and an enemy territory next to it."""
+    pairs = [
+        (ours, theirs)
+        for ours, model in board.territories.items() if model.occupier == ME
+        for theirs in board.map.get_adjacent_to(ours) if board.territories[theirs].occupier not in (None, ME)
+    ]
+    return rng.choice(pairs)
+
+
+class Case():
+    """A board, its recording, a query about it, and the bot state to answer it with."""
+
+    def __init__(self, bot: ModuleType, phase: str, territories: int, players: int, records: int, seed: int):
+        self.phase = phase
+        self.territories = territories
+        self.players = players
+        self.records = records
+        rng = random.Random(f"{seed}-{phase}-{territories}-{players}-{records}")
+        random.seed(seed)
+
+        board = LocalBoard(make_map(seed, territories), players, rng)
+        self.board = board
+        me = board.players[ME]
+        grow_territories(board, players, 0.5 if phase == "claim" else 1.0, rng)
+        if phase not in ("claim", "place"):
+            for model in board.territories.values():
+                model.troops = 1 + int(rng.expovariate(1 / 3))
+        board.recording += synthetic_records(board, players, records, phase in ("claim", "place"), rng)
+
+        # Everything a query is about has to be on the board (and in the recording) before the bot sees it.
+        query: Any = None
+        if phase == "claim":
+            query = QueryClaimTerritory(update={})
+        elif phase == "place":
+            me.troops_remaining = 10
+            query = QueryPlaceInitialTroop(update={})
+        elif phase == "redeem":
+            me.cards = [board.deck.pop() for _ in range(5)]
+            query = QueryRedeemCards(update={}, cause="turn_started")
+        elif phase == "distribute":
+            me.troops_remaining = max(3, len(board.get_territories_owned_by(ME)) // 3)
+            query = QueryDistributeTroops(update={}, cause="turn_started")
+        elif phase == "attack":
+            query = QueryAttack(update={})
+        elif phase == "defend":
+            ours, theirs = adjacent_pair(board, rng)
+            board.territories[theirs].troops = max(4, board.territories[theirs].troops)
+            board.recording.append(MoveAttack(move_by_player=board.territories[theirs].occupier, attacking_territory=theirs, defending_territory=ours, attacking_troops=3))
+            query = QueryDefend(update={}, move_attack_id=len(board.recording) - 1)
+        elif phase == "troops_after_attack":
+            ours, theirs = adjacent_pair(board, rng)
+            board.territories[ours].troops = max(6, board.territories[ours].troops)
+            board.recording.append(MoveAttack(move_by_player=ME, attacking_territory=ours, defending_territory=theirs, attacking_troops=3))
+            board.recording.append(RecordAttack(move_attack_id=len(board.recording) - 1, attacking_lost=0, defending_lost=1, territory_conquered=True, defender_eliminated=False))
+            board.territories[theirs].occupier = ME
+            board.territories[theirs].troops = 0
+            query = QueryTroopsAfterAttack(update={}, record_attack_id=len(board.recording) - 1)
+        elif phase in ("fortify", "path"):
+            query = QueryFortify(update={})
+
+        self.game = LocalGame(board, ME)
+        self._bot = bot
+        self.reset()
+
+        if phase == "path":
+            source = max(board.get_territories_owned_by(ME), key=lambda t: board.territories[t].troops)
+            target = max(range(1, players), key=lambda p: self.bot_state.ownership.troop_totals[p])
+            self.call: Callable[[], Any] = lambda: bot.find_shortest_path_from_vertex_to_set(self.bot_state, source, target)
+        else:
+            self.call = lambda: bot.choose_move(self.game, self.bot_state, query)
+
+    def reset(self) -> None:
+        """Start again with a bot state that has seen nothing of the game (but, for the path search,
+        has caught up with it)."""
+        self.bot_state = self._bot.create_bot_state(self.game)
+        if self.phase == "path":
+            self._bot.update_indexes(self.game, self.bot_state)
+
+
+def time_case(case: Case, warmup: int, repeats: int, number: int, warm: bool) -> dict:
+    for _ in range(warmup):
+        if not warm:
+            case.reset()
+        case.call()
+    runs = []
+    for _ in range(repeats):
+        elapsed = 0.0
+        for _ in range(number):
+            if not warm:
+                case.reset()
+            start = time.perf_counter()
+            case.call()
+            elapsed += time.perf_counter() - start
+        runs.append(elapsed / number)
+    return {
+        "phase": case.phase,
+        "territories": case.territories,
+        "players": case.players,
+        "records": case.records,
+        "min_us": 1e6 * min(runs),
+        "median_us": 1e6 * statistics.median(runs),
+        "mean_us": 1e6 * statistics.fmean(runs),
+        "stdev_us": 1e6 * statistics.stdev(runs) if len(runs) > 1 else 0.0,
+    }
+
+
+def case_key(result: dict) -> tuple:
+    return (result["phase"], result["territories"], result["players"], result["records"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bot", default="my_submission.py", help="the bot file to benchmark")
+    parser.add_argument("--phases", nargs="+", default=PHASES, choices=PHASES)
+    parser.add_argument("--territories", nargs="+", type=int, default=[43, 200, 1000], help="map sizes (43 is the classic shape)")
+    parser.add_argument("--players", nargs="+", type=int, default=[2, 4, 6])
+    parser.add_argument("--records", nargs="+", type=int, default=[0, 10000], help="recording lengths")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--number", type=int, default=10, help="calls per timed run")
+    parser.add_argument("--warm", action="store_true", help="keep what the bot worked out between calls")
+    parser.add_argument("--search-budget", type=float, default=0.0, help="seconds for the attack search (default: no search)")
+    parser.add_argument("--compare", default=None, help="an earlier run's JSON to compare against")
+    parser.add_argument("--out", default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    bot = load_bot(args.bot)
+    bot.SEARCH_BUDGET_SECONDS = args.search_budget
+    bot.SOFT_DEADLINE_SECONDS = 3600.0
+    baseline: dict[tuple, dict] = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {case_key(r): r for r in json.load(f)["cases"]}
+
+    results = []
+    start = time.perf_counter()
+    for territories in args.territories:
+        for players in args.players:
+            for records in args.records:
+                for phase in args.phases:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        result = time_case(Case(bot, phase, territories, players, records, args.seed), args.warmup, args.repeats, args.number, args.warm)
+                    results.append(result)
+                    line = f"{phase:<20} {territories:>5} territories {players} players {records:>6} records  median {result['median_us']:>10.1f}us  min {result['min_us']:>10.1f}us"
+                    before: Optional[dict] = baseline.get(case_key(result))
+                    if before is not None:
+                        line += f"  {result['median_us'] / max(before['median_us'], 1e-3):>5.2f}x"
+                    print(line, flush=True)
+
+    summary = {
+        "bot": args.bot,
+        "python": platform.python_version(),
+        "settings": {k: getattr(args, k) for k in ("seed", "warmup", "repeats", "number", "warm", "search_budget")},
+        "seconds": time.perf_counter() - start,
+        "cases": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,595 @@
+"""An in-process stand-in for the game engine, used for offline evaluation of the bot.
+
+The engine reimplements the query/move protocol that `risk_helper.game.Game` speaks with the
+real engine, so the handlers in `my_submission.py` can be driven directly without a socket
+connection. Every player gets its own `LocalGame`, which offers the same `state` surface and
+`move_*` helpers that the handlers use.
+"""
+
+from collections import defaultdict
+from dataclasses import dataclass, field
+import random
+from typing import Callable, Optional
+
+from risk_shared.models.card_model import CardModel
+from risk_shared.queries.query_attack import QueryAttack
+from risk_shared.queries.query_claim_territory import QueryClaimTerritory
+from risk_shared.queries.query_defend import QueryDefend
+from risk_shared.queries.query_distribute_troops import QueryDistributeTroops
+from risk_shared.queries.query_fortify import QueryFortify
+from risk_shared.queries.query_place_initial_troop import QueryPlaceInitialTroop
+from risk_shared.queries.query_redeem_cards import QueryRedeemCards
+from risk_shared.queries.query_troops_after_attack import QueryTroopsAfterAttack
+from risk_shared.records.moves.move_attack import MoveAttack
+from risk_shared.records.moves.move_attack_pass import MoveAttackPass
+from risk_shared.records.moves.move_claim_territory import MoveClaimTerritory
+from risk_shared.records.moves.move_defend import MoveDefend
+from risk_shared.records.moves.move_distribute_troops import MoveDistributeTroops
+from risk_shared.records.moves.move_fortify import MoveFortify
+from risk_shared.records.moves.move_fortify_pass import MoveFortifyPass
+from risk_shared.records.moves.move_place_initial_troop import MovePlaceInitialTroop
+from risk_shared.records.moves.move_redeem_cards import MoveRedeemCards
+from risk_shared.records.moves.move_troops_after_attack import MoveTroopsAfterAttack
+from risk_shared.records.record_attack import RecordAttack
+from risk_shared.records.record_player_eliminated import RecordPlayerEliminated
+from risk_shared.records.record_redeemed_cards import RecordRedeemedCards
+from risk_shared.records.record_start_turn import RecordStartTurn
+
+
+INITIAL_TROOPS = {2: 40, 3: 35, 4: 30, 5: 25}
+CARD_SYMBOLS = ["Infantry", "Cavalry", "Artillery"]
+MAX_TURNS = 400
+
+# The classic map's continent sizes and bonuses, in the id order the bot expects, and the pairs of
+# continents that are linked on the classic board.
+CLASSIC_LAYOUT = [
+    ("North America", 9, 5),
+    ("Europe", 7, 5),
+    ("Asia", 13, 7),
+    ("South America", 3, 2),
+    ("Africa", 6, 3),
+    ("Australia", 5, 2),
+]
+CLASSIC_LINKS = [(0, 1), (0, 2), (0, 3), (1, 2), (1, 4), (2, 4), (2, 5), (3, 4)]
+
+
+class IllegalMove(Exception):
+    """Raised when a bot answers a query with a move the engine would reject."""
+
+
+class LocalMap():
+    """An adjacency-list map with named continents, offering the `game.state.map` surface."""
+
+    def __init__(self, adjacency: dict[int, list[int]], names: dict[int, str], continents: dict[str, list[int]], continent_bonuses: dict[str, int]):
+        self._adjacency = {v: sorted(set(n)) for v, n in adjacency.items()}
+        self._names = names
+        self._continents = continents
+        self._continent_bonuses = continent_bonuses
+
+    def get_vertices(self) -> list[int]:
+        return sorted(self._adjacency)
+
+    def get_vertex_name(self, vertex: int) -> str:
+        return self._names[vertex]
+
+    def get_adjacent_to(self, vertex: int) -> list[int]:
+        return self._adjacency[vertex]
+
+    def get_continents(self) -> dict[str, list[int]]:
+        return self._continents
+
+    def get_continent_bonuses(self) -> dict[str, int]:
+        return self._continent_bonuses
+
+    @classmethod
+    def from_layout(cls, layout: dict) -> "LocalMap":
+        """Rebuild a map from its JSON layout (as written into game logs): "adjacency", "continents" and
+        "continent_bonuses", and optionally "names"."""
+        adjacency = {int(t): [int(x) for x in n] for t, n in layout["adjacency"].items()}
+        names = {int(t): name for t, name in layout.get("names", {}).items()}
+        return cls(
+            adjacency,
+            {t: names.get(t, str(t)) for t in adjacency},
+            {c: [int(t) for t in members] for c, members in layout["continents"].items()},
+            {c: int(bonus) for c, bonus in layout["continent_bonuses"].items()},
+        )
+
+    @classmethod
+    def generate(cls, seed: int, layout: list[tuple[str, int, int]] = CLASSIC_LAYOUT, links: list[tuple[int, int]] = CLASSIC_LINKS) -> "LocalMap":
+        """Generate a connected map with contiguous continent id ranges, shaped like the given layout."""
+        rng = random.Random(seed)
+        adjacency: dict[int, set[int]] = defaultdict(set)
+        continents: dict[str, list[int]] = {}
+        bonuses: dict[str, int] = {}
+        names: dict[int, str] = {}
+
+        start = 0
+        for name, size, bonus in layout:
+            members = list(range(start, start + size))
+            continents[name] = members
+            bonuses[name] = bonus
+            for i, v in enumerate(members):
+                names[v] = f"{name} {i + 1}"
+                adjacency[v]
+
+                # Each territory joins the continent's spanning tree near its predecessors, which keeps
+                # continents roughly chain-like, and then picks up a few extra local edges.
+                if i > 0:
+                    u = members[rng.randrange(max(0, i - 3), i)]
+                    adjacency[u].add(v)
+                    adjacency[v].add(u)
+                if i > 1 and rng.random() < 0.5:
+                    u = members[rng.randrange(0, i - 1)]
+                    adjacency[u].add(v)
+                    adjacency[v].add(u)
+            start += size
+
+        names_in_order = list(continents)
+        for a, b in links:
+            u = rng.choice(continents[names_in_order[a]])
+            v = rng.choice(continents[names_in_order[b]])
+            adjacency[u].add(v)
+            adjacency[v].add(u)
+
+        return cls({v: list(n) for v, n in adjacency.items()}, names, continents, bonuses)
+
+    @classmethod
+    def generate_large(cls, seed: int, territories: int, continent_size: int = 12) -> "LocalMap":
+        """Generate a map with many territories, split into similarly sized continents in a ring."""
+        count = max(2, territories // continent_size)
+        layout = []
+        for i in range(count):
+            size = continent_size if i < count - 1 else territories - continent_size * (count - 1)
+            layout.append((f"Continent {i + 1}", size, max(1, size // 3)))
+        links = [(i, (i + 1) % count) for i in range(count)] + [(i, (i + count // 2) % count) for i in range(0, count, 3)]
+        return cls.generate(seed, layout, links)
+
+
+@dataclass
+class LocalTerritory():
+    territory_id: int
+    occupier: Optional[int] = None
+    troops: int = 0
+
+
+@dataclass
+class LocalPlayer():
+    player_id: int
+    troops_remaining: int = 0
+    alive: bool = True
+    cards: list[CardModel] = field(default_factory=list)
+    must_place_territory_bonus: list[int] = field(default_factory=list)
+
+    @property
+    def card_count(self) -> int:
+        return len(self.cards)
+
+
+class LocalBoard():
+    """The authoritative game state shared by every player's view."""
+
+    def __init__(self, game_map: LocalMap, player_count: int, rng: random.Random):
+        self.map = game_map
+        self.territories = {v: LocalTerritory(v) for v in game_map.get_vertices()}
+        self.players = {p: LocalPlayer(p) for p in range(player_count)}
+        self.turn_order = list(range(player_count))
+        rng.shuffle(self.turn_order)
+        self.recording: list = []
+        self.card_sets_redeemed = 0
+
+        self.deck: list[CardModel] = [CardModel(card_id=i, territory_id=v, symbol=CARD_SYMBOLS[i % 3]) for i, v in enumerate(game_map.get_vertices())]
+        n = len(self.deck)
+        self.deck += [CardModel(card_id=n, territory_id=None, symbol="Wildcard"), CardModel(card_id=n + 1, territory_id=None, symbol="Wildcard")]
+        rng.shuffle(self.deck)
+        self.discard: list[CardModel] = []
+
+    def get_territories_owned_by(self, player: Optional[int]) -> list[int]:
+        return [t.territory_id for t in self.territories.values() if t.occupier == player]
+
+    def get_all_border_territories(self, territories: list[int]) -> list[int]:
+        territory_set = set(territories)
+        return [x for x in territories if any(y not in territory_set for y in self.map.get_adjacent_to(x))]
+
+    def get_all_adjacent_territories(self, territories: list[int]) -> list[int]:
+        territory_set = set(territories)
+        result = set()
+        for x in territories:
+            result.update(y for y in self.map.get_adjacent_to(x) if y not in territory_set)
+        return list(result)
+
+    @staticmethod
+    def is_card_set(cards: tuple[CardModel, ...]) -> bool:
+        symbols = [c.symbol for c in cards if c.symbol != "Wildcard"]
+        return len(set(symbols)) in (1, len(symbols)) or len(symbols) <= 1
+
+    def get_card_set(self, cards: list[CardModel]) -> Optional[tuple[CardModel, CardModel, CardModel]]:
+        by_symbol = defaultdict(list)
+        for card in cards:
+            by_symbol[card.symbol].append(card)
+
+        for symbol in CARD_SYMBOLS:
+            if len(by_symbol[symbol]) >= 3:
+                return tuple(by_symbol[symbol][:3])
+        if all(by_symbol[s] for s in CARD_SYMBOLS):
+            return tuple(by_symbol[s][0] for s in CARD_SYMBOLS)
+
+        wildcards = by_symbol["Wildcard"]
+        others = [c for c in cards if c.symbol != "Wildcard"]
+        if len(wildcards) >= 1 and len(others) >= 2:
+            return (wildcards[0], others[0], others[1])
+        if len(wildcards) >= 2 and len(others) >= 1:
+            return (wildcards[0], wildcards[1], others[0])
+        return None
+
+    def set_bonus(self) -> int:
+        values = [4, 6, 8, 10, 12, 15]
+        if self.card_sets_redeemed < len(values):
+            return values[self.card_sets_redeemed]
+        return 15 + 5 * (self.card_sets_redeemed - len(values) + 1)
+
+
+class LocalState():
+    """One player's view of the board, with the attributes and helpers of the client game state."""
+
+    def __init__(self, board: LocalBoard, player_id: int):
+        self._board = board
+        self.me = board.players[player_id]
+        self.new_records = 0
+        self._cursor = 0
+
+    @property
+    def map(self) -> LocalMap:
+        return self._board.map
+
+    @property
+    def territories(self) -> dict[int, LocalTerritory]:
+        return self._board.territories
+
+    @property
+    def players(self) -> dict[int, LocalPlayer]:
+        return self._board.players
+
+    @property
+    def recording(self) -> list:
+        return self._board.recording
+
+    @property
+    def card_sets_redeemed(self) -> int:
+        return self._board.card_sets_redeemed
+
+    @property
+    def turn_order(self) -> list[int]:
+        return self._board.turn_order
+
+    def get_territories_owned_by(self, player: Optional[int]) -> list[int]:
+        return self._board.get_territories_owned_by(player)
+
+    def get_all_border_territories(self, territories: list[int]) -> list[int]:
+        return self._board.get_all_border_territories(territories)
+
+    def get_all_adjacent_territories(self, territories: list[int]) -> list[int]:
+        return self._board.get_all_adjacent_territories(territories)
+
+    def get_card_set(self, cards: list[CardModel]) -> Optional[tuple[CardModel, CardModel, CardModel]]:
+        return self._board.get_card_set(cards)
+
+    def deliver(self) -> None:
+        """Mark the records since the previous query as new, as the client does when a query arrives."""
+        self.new_records = self._cursor
+        self._cursor = len(self._board.recording)
+
+
+class LocalGame():
+    """Stands in for `risk_helper.game.Game` for a single player."""
+
+    def __init__(self, board: LocalBoard, player_id: int):
+        self.state = LocalState(board, player_id)
+
+    def _me(self) -> int:
+        return self.state.me.player_id
+
+    def move_claim_territory(self, query: QueryClaimTerritory, territory_id: int) -> MoveClaimTerritory:
+        return MoveClaimTerritory(move_by_player=self._me(), territory=territory_id)
+
+    def move_place_initial_troop(self, query: QueryPlaceInitialTroop, territory_id: int) -> MovePlaceInitialTroop:
+        return MovePlaceInitialTroop(move_by_player=self._me(), territory=territory_id)
+
+    def move_redeem_cards(self, query: QueryRedeemCards, card_ids: list[tuple[int, int, int]]) -> MoveRedeemCards:
+        return MoveRedeemCards(move_by_player=self._me(), sets=card_ids, cause=query.cause)
+
+    def move_distribute_troops(self, query: QueryDistributeTroops, distributions: dict[int, int]) -> MoveDistributeTroops:
+        return MoveDistributeTroops(move_by_player=self._me(), distributions=dict(distributions), cause=query.cause)
+
+    def move_attack(self, query: QueryAttack, attacking_territory: int, defending_territory: int, attacking_troops: int) -> MoveAttack:
+        return MoveAttack(move_by_player=self._me(), attacking_territory=attacking_territory, defending_territory=defending_territory, attacking_troops=attacking_troops)
+
+    def move_attack_pass(self, query: QueryAttack) -> MoveAttackPass:
+        return MoveAttackPass(move_by_player=self._me())
+
+    def move_troops_after_attack(self, query: QueryTroopsAfterAttack, troop_count: int) -> MoveTroopsAfterAttack:
+        return MoveTroopsAfterAttack(move_by_player=self._me(), record_attack_id=query.record_attack_id, troop_count=troop_count)
+
+    def move_defend(self, query: QueryDefend, defending_troops: int) -> MoveDefend:
+        return MoveDefend(move_by_player=self._me(), move_attack_id=query.move_attack_id, defending_troops=defending_troops)
+
+    def move_fortify(self, query: QueryFortify, source_territory: int, target_territory: int, troop_count: int) -> MoveFortify:
+        return MoveFortify(move_by_player=self._me(), source_territory=source_territory, target_territory=target_territory, troop_count=troop_count)
+
+    def move_fortify_pass(self, query: QueryFortify) -> MoveFortifyPass:
+        return MoveFortifyPass(move_by_player=self._me())
+
+
+# A policy answers a query with a move, for the player whose `LocalGame` it was built around.
+Policy = Callable[[object], object]
+
+
+@dataclass
+class GameResult():
+    seed: int
+    winner: Optional[int]
+    turns: int
+    records: int
+    banned: dict[int, str]
+    turn_order: list[int]
+
+
+class LocalEngine():
+    """Runs a full game between policies, asking each for moves through the query/move protocol.
+    The policies are passed to `play`, so they can be built around the players' `games`."""
+
+    def __init__(self, player_count: int, seed: int, game_map: Optional[LocalMap] = None, max_turns: int = MAX_TURNS):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.board = LocalBoard(game_map or LocalMap.generate(seed), player_count, self.rng)
+        self.games = [LocalGame(self.board, p) for p in range(player_count)]
+        self.policies: list[Policy] = []
+        self.max_turns = max_turns
+        self.turn = 0
+        self.banned: dict[int, str] = {}
+
+    def _ask(self, player: int, query):
+        self.games[player].state.deliver()
+        move = self.policies[player](query)
+        if move is None:
+            raise IllegalMove(f"no move for {type(query).__name__}")
+        return move
+
+    def _record(self, record) -> int:
+        self.board.recording.append(record)
+        return len(self.board.recording) - 1
+
+    def _alive(self) -> list[int]:
+        return [p for p in self.board.turn_order if self.board.players[p].alive and p not in self.banned]
+
+    def _ban(self, player: int, reason: str) -> None:
+        self.banned[player] = reason
+        self.board.players[player].alive = False
+
+    def play(self, policies: list[Policy]) -> GameResult:
+        assert len(policies) == len(self.games)
+        self.policies = policies
+        board = self.board
+        try:
+            self._claim_phase()
+            self._place_phase()
+            while len(self._alive()) > 1 and self.turn < self.max_turns:
+                for player in self._alive():
+                    if len(self._alive()) <= 1:
+                        break
+                    if not self.board.players[player].alive or player in self.banned:
+                        continue
+                    self.turn += 1
+                    try:
+                        self._take_turn(player)
+                    except IllegalMove as e:
+                        self._ban(player, str(e))
+        except IllegalMove as e:
+            # Illegal moves in the setup phases abort the game for everyone.
+            return GameResult(self.seed, None, self.turn, len(board.recording), {**self.banned, -1: str(e)}, board.turn_order)
+
+        alive = self._alive()
+        winner = max(alive, key=lambda p: len(board.get_territories_owned_by(p))) if alive else None
+        return GameResult(self.seed, winner, self.turn, len(board.recording), self.banned, board.turn_order)
+
+    def _claim_phase(self) -> None:
+        board = self.board
+        order = board.turn_order
+        i = 0
+        while board.get_territories_owned_by(None):
+            player = order[i % len(order)]
+            move = self._ask(player, QueryClaimTerritory(update={}))
+            territory = board.territories.get(move.territory)
+            if not isinstance(move, MoveClaimTerritory) or territory is None or territory.occupier is not None:
+                raise IllegalMove(f"player {player} claimed {getattr(move, 'territory', None)}")
+            territory.occupier = player
+            territory.troops = 1
+            self._record(move)
+            i += 1
+
+        for p, player in board.players.items():
+            player.troops_remaining = INITIAL_TROOPS.get(len(order), 25) - len(board.get_territories_owned_by(p))
+
+    def _place_phase(self) -> None:
+        board = self.board
+        while any(p.troops_remaining > 0 for p in board.players.values()):
+            for player in board.turn_order:
+                if board.players[player].troops_remaining <= 0:
+                    continue
+                move = self._ask(player, QueryPlaceInitialTroop(update={}))
+                territory = board.territories.get(move.territory)
+                if not isinstance(move, MovePlaceInitialTroop) or territory is None or territory.occupier != player:
+                    raise IllegalMove(f"player {player} placed on {getattr(move, 'territory', None)}")
+                territory.troops += 1
+                board.players[player].troops_remaining -= 1
+                self._record(move)
+
+    def _income(self, player: int) -> int:
+        board = self.board
+        owned = set(board.get_territories_owned_by(player))
+        troops = max(3, len(owned) // 3)
+        bonuses = board.map.get_continent_bonuses()
+        for name, members in board.map.get_continents().items():
+            if all(v in owned for v in members):
+                troops += bonuses[name]
+        return troops
+
+    def _redeem(self, player: int, cause: str) -> None:
+        board = self.board
+        me = board.players[player]
+        move = self._ask(player, QueryRedeemCards(update={}, cause=cause))
+        if not isinstance(move, MoveRedeemCards):
+            raise IllegalMove(f"player {player} answered redeem with {type(move).__name__}")
+
+        cards = {c.card_id: c for c in me.cards}
+        used = set()
+        total = 0
+        matched = []
+        for card_set in move.sets:
+            if len(card_set) != 3 or any(c not in cards or c in used for c in card_set):
+                raise IllegalMove(f"player {player} redeemed unknown cards {card_set}")
+            if not LocalBoard.is_card_set(tuple(cards[c] for c in card_set)):
+                raise IllegalMove(f"player {player} redeemed invalid set {card_set}")
+            used.update(card_set)
+            total += board.set_bonus()
+            board.card_sets_redeemed += 1
+            for c in card_set:
+                territory = cards[c].territory_id
+                if territory is not None and board.territories[territory].occupier == player and territory not in matched:
+                    matched.append(territory)
+
+        remaining = len(me.cards) - len(used)
+        if remaining >= 5:
+            raise IllegalMove(f"player {player} kept {remaining} cards")
+        if cause == "player_eliminated" and move.sets and remaining + 3 < 5:
+            raise IllegalMove(f"player {player} redeemed more sets than required after an elimination")
+
+        me.cards = [c for c in me.cards if c.card_id not in used]
+        board.discard += [cards[c] for c in used]
+        if matched:
+            me.must_place_territory_bonus = matched[:1]
+            total += 2
+        me.troops_remaining += total
+        move_id = self._record(move)
+        self._record(RecordRedeemedCards(move_id=move_id, total_set_bonus=total, matching_territory_bonus=2 if matched else 0))
+
+    def _distribute(self, player: int, cause: str) -> None:
+        board = self.board
+        me = board.players[player]
+        move = self._ask(player, QueryDistributeTroops(update={}, cause=cause))
+        if not isinstance(move, MoveDistributeTroops):
+            raise IllegalMove(f"player {player} answered distribute with {type(move).__name__}")
+
+        distributions = {t: n for t, n in move.distributions.items() if n != 0}
+        if any(n < 0 or board.territories[t].occupier != player for t, n in distributions.items()):
+            raise IllegalMove(f"player {player} distributed onto {distributions}")
+        if sum(distributions.values()) != me.troops_remaining:
+            raise IllegalMove(f"player {player} distributed {sum(distributions.values())} of {me.troops_remaining} troops")
+        if me.must_place_territory_bonus and distributions.get(me.must_place_territory_bonus[0], 0) < 2:
+            raise IllegalMove(f"player {player} ignored the territory bonus")
+
+        for t, n in distributions.items():
+            board.territories[t].troops += n
+        me.troops_remaining = 0
+        me.must_place_territory_bonus = []
+        self._record(move)
+
+    def _take_turn(self, player: int) -> None:
+        board = self.board
+        me = board.players[player]
+        me.troops_remaining = self._income(player)
+        self._record(RecordStartTurn(player=player, troops_gained=me.troops_remaining))
+
+        self._redeem(player, "turn_started")
+        self._distribute(player, "turn_started")
+
+        conquered_any = False
+        while True:
+            move = self._ask(player, QueryAttack(update={}))
+            if isinstance(move, MoveAttackPass):
+                self._record(move)
+                break
+            if not isinstance(move, MoveAttack):
+                raise IllegalMove(f"player {player} answered attack with {type(move).__name__}")
+            conquered, eliminated = self._battle(player, move)
+            conquered_any = conquered_any or conquered
+            if len(self._alive()) <= 1:
+                return
+            if eliminated is not None and len(me.cards) >= 5:
+                self._redeem(player, "player_eliminated")
+                if me.troops_remaining > 0:
+                    self._distribute(player, "player_eliminated")
+
+        if conquered_any:
+            if not board.deck:
+                board.deck, board.discard = board.discard, []
+                self.rng.shuffle(board.deck)
+            if board.deck:
+                me.cards.append(board.deck.pop())
+
+        move = self._ask(player, QueryFortify(update={}))
+        if isinstance(move, MoveFortify):
+            source = board.territories.get(move.source_territory)
+            target = board.territories.get(move.target_territory)
+            if (source is None or target is None or source.occupier != player or target.occupier != player
+                    or move.target_territory not in board.map.get_adjacent_to(move.source_territory)
+                    or not 0 < move.troop_count < source.troops):
+                raise IllegalMove(f"player {player} fortified {move.source_territory}->{move.target_territory} with {move.troop_count}")
+            source.troops -= move.troop_count
+            target.troops += move.troop_count
+        elif not isinstance(move, MoveFortifyPass):
+            raise IllegalMove(f"player {player} answered fortify with {type(move).__name__}")
+        self._record(move)
+
+    def _battle(self, player: int, move: MoveAttack) -> tuple[bool, Optional[int]]:
+        board = self.board
+        source = board.territories.get(move.attacking_territory)
+        target = board.territories.get(move.defending_territory)
+        if (source is None or target is None or source.occupier != player or target.occupier == player
+                or move.defending_territory not in board.map.get_adjacent_to(move.attacking_territory)
+                or not 1 <= move.attacking_troops <= min(3, source.troops - 1)):
+            raise IllegalMove(f"player {player} attacked {move.attacking_territory}->{move.defending_territory} with {move.attacking_troops}")
+        move_attack_id = self._record(move)
+
+        defender = target.occupier
+        assert defender is not None
+        defend = self._ask(defender, QueryDefend(update={}, move_attack_id=move_attack_id))
+        if not isinstance(defend, MoveDefend) or not 1 <= defend.defending_troops <= min(2, target.troops):
+            self._ban(defender, f"player {defender} defended with {getattr(defend, 'defending_troops', None)}")
+            defend = MoveDefend(move_by_player=defender, move_attack_id=move_attack_id, defending_troops=min(2, target.troops))
+        self._record(defend)
+
+        attack_dice = sorted((self.rng.randint(1, 6) for _ in range(move.attacking_troops)), reverse=True)
+        defend_dice = sorted((self.rng.randint(1, 6) for _ in range(defend.defending_troops)), reverse=True)
+        attacking_lost = defending_lost = 0
+        for a, d in zip(attack_dice, defend_dice):
+            if a > d:
+                defending_lost += 1
+            else:
+                attacking_lost += 1
+        source.troops -= attacking_lost
+        target.troops -= defending_lost
+
+        conquered = target.troops == 0
+        eliminated = None
+        if conquered:
+            target.occupier = player
+            eliminated = defender if not board.get_territories_owned_by(defender) else None
+        record_attack_id = self._record(RecordAttack(move_attack_id=move_attack_id, attacking_lost=attacking_lost, defending_lost=defending_lost, territory_conquered=conquered, defender_eliminated=eliminated is not None))
+
+        if eliminated is not None:
+            board.players[eliminated].alive = False
+            surrendered = board.players[eliminated].cards
+            board.players[eliminated].cards = []
+            board.players[player].cards += surrendered
+            self._record(RecordPlayerEliminated(player=eliminated, record_attack_id=record_attack_id, cards_surrendered_count=len(surrendered)))
+
+        if conquered:
+            minimum = move.attacking_troops - attacking_lost
+            after = self._ask(player, QueryTroopsAfterAttack(update={}, record_attack_id=record_attack_id))
+            if not isinstance(after, MoveTroopsAfterAttack) or not minimum <= after.troop_count <= source.troops - 1:
+                raise IllegalMove(f"player {player} moved {getattr(after, 'troop_count', None)} troops after attack")
+            source.troops -= after.troop_count
+            target.troops += after.troop_count
+            self._record(after)
+
+        return conquered, eliminated
@@ -0,0 +1,161 @@
+"""Build an opening book for the claim and initial placement phases by self-play on the local engine.
+
+Every seat is played by the bot, except that each claim or initial placement is made at random instead
+with probability --explore. For every position (seen from the seat that moved, and as coarse as the
+bot's book keys) we count how often each pick (the continent of the territory picked) went on to
+win, and the book keeps the best pick for each position seen at least --min-visits times. Then
+--holdout more games, without exploring, show how often the bot would have found its position in
+the book. The book only applies to the map it was made on, so for a real game it has to be
+made on the real map: --map-file reads its layout as JSON, with "adjacency", "continents",
+"continent_bonuses" and optionally "names" (the map a game log carries has this shape). Without it,
+the book is made on the local map generated from --map-seed.
+
+    python make_opening_book.py --games 5000 --map-file map.json --out opening_book.bin
+"""
+
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from dataclasses import dataclass
+import io
+import json
+import os
+import random
+import time
+from typing import Optional
+
+from local_engine import LocalEngine, LocalGame, LocalMap
+from risk_shared.queries.query_claim_territory import QueryClaimTerritory
+from risk_shared.queries.query_place_initial_troop import QueryPlaceInitialTroop
+from tournament import load_bot
+
+
+@dataclass
+class BookJob():
+    seed: int
+    bot: str
+    players: int
+    map_seed: int
+    explore: float
+    layout: Optional[dict] = None
+
+
+def game_map(map_seed: int, layout: Optional[dict]) -> LocalMap:
+    return LocalMap.from_layout(layout) if layout is not None else LocalMap.generate(map_seed)
+
+
+def play_game(job: BookJob) -> list[tuple[int, int, int, bool]]:
+    """Play one game, and return (phase, position key, pick, whether the picker won) for every opening
+    move. This runs in a worker process."""
+    random.seed(job.seed)
+    bot = load_bot(job.bot)
+    rng = random.Random(job.seed)
+    engine = LocalEngine(job.players, job.seed, game_map(job.map_seed, job.layout))
+    visits: list[tuple[int, int, int, int]] = []
+
+    def exploring_policy(player: int, game: LocalGame):
+        bot_state = bot.create_bot_state(game)
+
+        # We are here to find out what the heuristics can't, so the bot doesn't get to read an old book.
+        bot_state.book = None
+
+        def policy(query):
+            move = bot.choose_move(game, bot_state, query)
+            match query:
+                case QueryClaimTerritory():
+                    phase, legal = bot.BOOK_CLAIM, bot_state.ownership.masks[None]
+                case QueryPlaceInitialTroop():
+                    phase, legal = bot.BOOK_PLACE, bot_state.ownership.masks[player]
+                case _:
+                    return move
+
+            if rng.random() < job.explore:
+                pick = rng.choice(list(bot.bits(legal)))
+                move = game.move_claim_territory(query, pick) if phase == bot.BOOK_CLAIM else game.move_place_initial_troop(query, pick)
+            key = bot.OpeningBook.key(bot_state.map_index, bot_state.ownership, phase)
+            visits.append((player, phase, key, bot_state.map_index.continent_of[move.territory]))
+            return move
+        return policy
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = engine.play([exploring_policy(player, game) for player, game in enumerate(engine.games)])
+    return [(phase, key, pick, player == result.winner) for player, phase, key, pick in visits]
+
+
+def play_games(jobs: list[BookJob], workers: Optional[int]):
+    """The opening moves of each game, as the games finish."""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(play_game, jobs, chunksize=max(1, len(jobs) // (8 * (workers or os.cpu_count() or 1))))
+
+
+def build_book(bot: str, games: int, players: int, map_seed: int, explore: float, min_visits: int, seed: int = 0, workers: Optional[int] = None, layout: Optional[dict] = None) -> dict[int, int]:
+    # Position key -> pick -> [wins, plays].
+    outcomes: defaultdict[int, defaultdict[int, list[int]]] = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+    jobs = [BookJob(seed + i, bot, players, map_seed, explore, layout) for i in range(games)]
+    for visits in play_games(jobs, workers):
+        for _, key, pick, won in visits:
+            counts = outcomes[key][pick]
+            counts[0] += won
+            counts[1] += 1
+
+    # Picks are compared by their win rate with one win and one loss added, so that a pick tried
+    # once that happened to win doesn't beat one that wins often.
+    book = {}
+    for key, picks in outcomes.items():
+        if sum(plays for _, plays in picks.values()) >= min_visits:
+            book[key] = max(picks, key=lambda pick: ((picks[pick][0] + 1) / (picks[pick][1] + 2), pick))
+    return book
+
+
+def hit_rates(book: dict[int, int], jobs: list[BookJob], workers: Optional[int]) -> dict[int, tuple[int, int]]:
+    """Phase -> (positions the book has, positions seen) over the opening moves of the games."""
+    hits: defaultdict[int, list[int]] = defaultdict(lambda: [0, 0])
+    for visits in play_games(jobs, workers):
+        for phase, key, _, _ in visits:
+            hits[phase][0] += key in book
+            hits[phase][1] += 1
+    return {phase: (found, seen) for phase, (found, seen) in hits.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bot", default="my_submission.py", help="the bot file that plays and reads the book")
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--map-seed", type=int, default=0, help="the local map to make the book for")
+    parser.add_argument("--map-file", default=None, help="make the book for the map with this JSON layout instead")
+    parser.add_argument("--explore", type=float, default=0.1, help="chance of a random opening move")
+    parser.add_argument("--min-visits", type=int, default=5, help="times a position has to be seen to get into the book")
+    parser.add_argument("--holdout", type=int, default=100, help="games played after making the book to measure its hit rate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--out", default="opening_book.bin")
+    args = parser.parse_args()
+
+    layout = None
+    if args.map_file is not None:
+        try:
+            with open(args.map_file) as f:
+                layout = json.load(f)
+            LocalMap.from_layout(layout)
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            parser.error(f"can't read a map layout from {args.map_file}: {e!r}")
+
+    start = time.perf_counter()
+    book = build_book(args.bot, args.games, args.players, args.map_seed, args.explore, args.min_visits, args.seed, args.workers, layout)
+    bot = load_bot(args.bot)
+    book_map = game_map(args.map_seed, layout)
+    fingerprint = bot.MapIndex(book_map, *bot.map_continents(book_map)).fingerprint
+    bot.OpeningBook.write(args.out, fingerprint, book)
+    print(f"{len(book)} positions from {args.games} games in {time.perf_counter() - start:.1f}s, written to {args.out} for map {fingerprint:016x}")
+
+    if args.holdout > 0:
+        jobs = [BookJob(args.seed + args.games + i, args.bot, args.players, args.map_seed, 0.0, layout) for i in range(args.holdout)]
+        for phase, (found, seen) in sorted(hit_rates(book, jobs, args.workers).items()):
+            name = "claims" if phase == bot.BOOK_CLAIM else "placements"
+            print(f"  {name:<10} {found}/{seen} held-out positions in the book ({found / max(1, seen):.1%})")
+
+
+if __name__ == "__main__":
+    main()
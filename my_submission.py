@@ -1,6 +1,23 @@
-from collections import defaultdict, deque
+import time
+
+# We time our own start-up from here (see QueryStats), so this comes before the other imports.
+STARTED = time.perf_counter()
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, deque
+import copy
+import hashlib
+from itertools import product
+import json
+import math
+import mmap
+import os
 import random
-from typing import Optional, Tuple, Union, cast
+import signal
+import struct
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, Optional, Sequence, Tuple, Union, cast
 from risk_helper.game import Game
 from risk_shared.models.card_model import CardModel
 from risk_shared.queries.query_attack import QueryAttack
@@ -23,222 +40,2659 @@ from risk_shared.records.moves.move_place_initial_troop import MovePlaceInitialT
 from risk_shared.records.moves.move_redeem_cards import MoveRedeemCards
 from risk_shared.records.moves.move_troops_after_attack import MoveTroopsAfterAttack
 from risk_shared.records.record_attack import RecordAttack
+from risk_shared.records.record_player_eliminated import RecordPlayerEliminated
+from risk_shared.records.record_start_turn import RecordStartTurn
 from risk_shared.records.types.move_type import MoveType
 
+# The search's worker pool is only started when it is asked for, and its module takes a while to
+# import, so we leave that until then.
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+
+# The continents of the classic map, in the order we prioritise them, and the troops each one
+# gives us at the start of our turn when we hold all of it.
+CLASSIC_CONTINENTS: dict[str, list[int]] = {
+    "North America": list(range(9)),
+    "South America": list(range(29, 32)),
+    "Australia": list(range(38, 43)),
+    "Africa": list(range(32, 38)),
+    "Europe": list(range(9, 16)),
+    "Asia": list(range(16, 29)),
+}
+CLASSIC_CONTINENT_BONUSES: dict[str, int] = {
+    "North America": 5,
+    "South America": 2,
+    "Australia": 2,
+    "Africa": 3,
+    "Europe": 5,
+    "Asia": 7,
+}
+
+
+# We represent sets of territories as int bitmasks, with bit t set when territory t is in the set.
+# Intersections and unions are then single integer operations, and Python ints grow as needed for
+# maps with hundreds of territories.
+def mask_of(territories: Iterable[int]) -> int:
+    mask = 0
+    for territory in territories:
+        mask |= 1 << territory
+    return mask
+
+
+def bits(mask: int) -> Iterator[int]:
+    """The territories in a bitmask, in increasing order."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def lowest(mask: int) -> int:
+    """The smallest territory in a non-empty bitmask."""
+    return (mask & -mask).bit_length() - 1
+
+
+def popcount(mask: int) -> int:
+    return mask.bit_count()
+
+
+# Where to read the map's continents from, if it isn't the map the engine gives us (see `map_continents`).
+MAP_FILE = os.environ.get("BOT_MAP_FILE", "")
+
+
+def map_continents(game_map, path: str = MAP_FILE) -> tuple[dict[str, list[int]], dict[str, int]]:
+    """The map's continents and their bonuses. They come from the map description file at the path
+    if there is one (JSON with "continents" and "continent_bonuses", like the map in a game log),
+    else from the map itself if it can tell us, else we assume the classic map. The classic
+    continents keep the order we prioritise them in; other continents are taken in order of how few
+    joints they have to hold, then how small they are."""
+    continents: Optional[dict] = None
+    bonuses: dict = {}
+    if path:
+        try:
+            with open(path) as f:
+                description = json.load(f)
+            continents, bonuses = description["continents"], description["continent_bonuses"]
+        except (OSError, ValueError, KeyError):
+            continents = None
+    if continents is None and hasattr(game_map, "get_continents"):
+        continents, bonuses = game_map.get_continents(), game_map.get_continent_bonuses()
+    if not continents:
+        return CLASSIC_CONTINENTS, CLASSIC_CONTINENT_BONUSES
+
+    members = {c: [int(t) for t in territories] for c, territories in continents.items()}
+    bonuses = {c: int(bonuses.get(c, 0)) for c in members}
+
+    # The classic map is recognised by its continents' territories, whatever they are called, and the
+    # bonuses are then carried over to the classic names.
+    named = {frozenset(m): c for c, m in members.items()}
+    if set(named) == {frozenset(m) for m in CLASSIC_CONTINENTS.values()}:
+        return CLASSIC_CONTINENTS, {c: bonuses[named[frozenset(m)]] for c, m in CLASSIC_CONTINENTS.items()}
+
+    continent_of = {t: c for c, territories in members.items() for t in territories}
+
+    def joints(continent: str) -> int:
+        return sum(1 for t in members[continent] if any(continent_of.get(x) != continent for x in game_map.get_adjacent_to(t)))
+
+    order = sorted(members, key=lambda c: (joints(c), len(members[c]), c))
+    return {c: members[c] for c in order}, {c: bonuses[c] for c in order}
+
+
+# How many of the shortest path trees behind `MapIndex.path` we keep.
+PATH_TREES = 256
+
+
+class MapIndex():
+    """Everything we need to know about the (static) map, derived once at startup so the handlers
+    never have to rebuild continent or joint lists per query."""
+
+    def __init__(self, game_map, continents: dict[str, list[int]] = CLASSIC_CONTINENTS, continent_bonuses: dict[str, int] = CLASSIC_CONTINENT_BONUSES):
+        self.continent_names: tuple[str, ...] = tuple(continents)
+        self.territories: tuple[int, ...] = tuple(sorted(t for members in continents.values() for t in members))
+        size = max(self.territories) + 1
+
+        # Territory id -> continent position in `continent_names`, and territory id -> neighbours.
+        self.continent_of: list[int] = [-1] * size
+        self.adjacent: list[tuple[int, ...]] = [()] * size
+        for i, members in enumerate(continents.values()):
+            for territory in members:
+                self.continent_of[territory] = i
+        for territory in self.territories:
+            self.adjacent[territory] = tuple(game_map.get_adjacent_to(territory))
+        self.neighbour_mask: list[int] = [mask_of(neighbours) for neighbours in self.adjacent]
+        self.all_mask = mask_of(self.territories)
+
+        self.continent_members: dict[str, frozenset[int]] = {c: frozenset(m) for c, m in continents.items()}
+        self.continent_lists: dict[str, tuple[int, ...]] = {c: tuple(sorted(m)) for c, m in continents.items()}
+        self.continent_mask: dict[str, int] = {c: mask_of(m) for c, m in continents.items()}
+        self.continent_bonus: dict[str, int] = {c: continent_bonuses.get(c, 0) for c in continents}
+        self.continent_sizes: tuple[int, ...] = tuple(len(m) for m in continents.values())
+
+        # A joint is a territory with a neighbour in another continent, which makes it one of the
+        # chokepoints we have to hold to keep a continent. We also remember which continents each
+        # joint leads into.
+        self.joint_links: dict[int, frozenset[str]] = {}
+        for territory in self.territories:
+            linked = frozenset(
+                self.continent_names[self.continent_of[x]] for x in self.adjacent[territory]
+                if self.continent_of[x] != self.continent_of[territory]
+            )
+            if linked:
+                self.joint_links[territory] = linked
+        self.joints: dict[str, tuple[int, ...]] = {c: tuple(t for t in self.continent_lists[c] if t in self.joint_links) for c in continents}
+        self.joint_order: tuple[int, ...] = tuple(t for c in continents for t in self.joints[c])
+        self.joint_set: frozenset[int] = frozenset(self.joint_order)
+        self.joint_mask: dict[str, int] = {c: mask_of(self.joints[c]) for c in continents}
+
+        # The territories outside each continent that border it.
+        self.continent_approaches: dict[str, int] = {c: 0 for c in continents}
+        for territory, linked in self.joint_links.items():
+            for continent in linked:
+                self.continent_approaches[continent] |= 1 << territory
+
+        # A 64-bit digest of the territories, their borders and the continents, so that anything we
+        # worked out for one map is never used on another.
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(repr([(c, self.continent_lists[c], self.continent_bonus[c]) for c in continents]).encode())
+        digest.update(repr([tuple(sorted(self.adjacent[t])) for t in self.territories]).encode())
+        self.fingerprint: int = int.from_bytes(digest.digest(), "little")
+
+        # The shortest path trees rooted at the territories we have looked for paths to lately. They
+        # are built when first needed rather than for every territory up front, which would take
+        # time and memory quadratic in the size of the map.
+        self._toward: OrderedDict[int, array] = OrderedDict()
+
+    def toward(self, root: int) -> array:
+        """For every territory, its neighbour one hop closer to the root (-1 for the root itself, or
+        when it can't reach the root)."""
+        trees = self._toward
+        if root in trees:
+            trees.move_to_end(root)
+            return trees[root]
+
+        toward = array("i", [-1]) * len(self.adjacent)
+        seen = bytearray(len(self.adjacent))
+        seen[root] = 1
+        queue = deque([root])
+        while queue:
+            current = queue.popleft()
+            for neighbour in self.adjacent[current]:
+                if not seen[neighbour]:
+                    seen[neighbour] = 1
+                    toward[neighbour] = current
+                    queue.append(neighbour)
+        trees[root] = toward
+        if len(trees) > PATH_TREES:
+            trees.popitem(last=False)
+        return toward
+
+    def path(self, source: int, target: int) -> list[int]:
+        """The territories on a shortest path from source to target, not including the source."""
+        toward = self.toward(target)
+        path = []
+        current = source
+        while current != target:
+            current = toward[current]
+            if current < 0:
+                return []
+            path.append(current)
+        return path
+
+    def frontier(self, mask: int) -> int:
+        """The territories outside the mask that are adjacent to it."""
+        result = 0
+        for territory in bits(mask):
+            result |= self.neighbour_mask[territory]
+        return result & ~mask
+
+    def border(self, mask: int) -> int:
+        """The territories in the mask that are adjacent to a territory outside it."""
+        result = 0
+        for territory in bits(mask):
+            if self.neighbour_mask[territory] & ~mask:
+                result |= 1 << territory
+        return result
+
+    def exposed_joints(self, captured_continents: set[str]) -> list[int]:
+        """The joints of the captured continents that lead into a continent we have not captured,
+        and so still need reinforcing."""
+        return [t for c in self.continent_names if c in captured_continents for t in self.joints[c] if not self.joint_links[t] <= captured_continents]
+
+
+class RecordDispatcher():
+    """Hands each new record to the subscribers for its type, at most once. The recording only ever
+    grows, so keeping our place in it means the work per query is proportional to the records that
+    came with it, however long the game has gone on. Subscribers are called with the record's index
+    in the recording and the record, in the order they subscribed."""
 
-# We will store our enemy in the bot state.
-class BotState():
     def __init__(self):
-        self.enemy: Optional[int] = None
+        self._subscribers: defaultdict[type, list[Callable[[int, Any], None]]] = defaultdict(list)
+        self.cursor = 0
+
+        # How many times a subscriber raised, and whether any subscriber has missed a record since
+        # `dropped` was last cleared (because another raised, or we were interrupted).
+        self.errors = 0
+        self.dropped = False
+
+    def subscribe(self, record_type: type, subscriber: Callable[[int, Any], None]) -> None:
+        self._subscribers[record_type].append(subscriber)
+
+    def dispatch(self, game: Game) -> int:
+        """Deliver the records that have arrived since the last call, and return how many there were.
+        We move past each record before handing it out, so if we are interrupted, the next call
+        carries on from the next record rather than handing this one again to the subscribers that
+        already had it. A subscriber that raises only misses the record."""
+        recording = game.state.recording
+        start = self.cursor
+        subscribers = self._subscribers
+        while self.cursor < len(recording):
+            index = self.cursor
+            record = recording[index]
+            self.cursor = index + 1
+            for subscriber in subscribers.get(type(record), ()):
+                try:
+                    subscriber(index, record)
+                except DeadlineExceeded:
+                    self.dropped = True
+                    raise
+                except Exception as e:
+                    self.errors += 1
+                    self.dropped = True
+                    if telemetry.level >= TELEMETRY_INFO:
+                        telemetry.emit(TELEMETRY_INFO, "subscriber_error", record=index, record_type=type(record).__name__, error=repr(e))
+        return self.cursor - start
+
+
+# How many of the latest attacks we remember. Queries only ever ask about the attack in progress.
+RECENT_ATTACKS = 64
+
+
+class AttackTracker():
+    """The latest attacks, so queries can look up the attack they are about without going back to
+    the recording."""
 
+    def __init__(self):
+        self._moves: dict[int, MoveAttack] = {}
+        self._results: dict[int, MoveAttack] = {}
+
+    def subscribe(self, dispatcher: RecordDispatcher) -> None:
+        dispatcher.subscribe(MoveAttack, self._on_move_attack)
+        dispatcher.subscribe(RecordAttack, self._on_record_attack)
+
+    def move_attack(self, move_attack_id: int) -> Optional[MoveAttack]:
+        """The attack move with this record id."""
+        return self._moves.get(move_attack_id)
+
+    def move_attack_for(self, record_attack_id: int) -> Optional[MoveAttack]:
+        """The attack move that the attack result with this record id is the result of."""
+        return self._results.get(record_attack_id)
+
+    @staticmethod
+    def _remember(attacks: dict[int, MoveAttack], index: int, move: MoveAttack) -> None:
+        attacks[index] = move
+        if len(attacks) > RECENT_ATTACKS:
+            del attacks[next(iter(attacks))]
+
+    def _on_move_attack(self, index: int, record: MoveAttack) -> None:
+        self._remember(self._moves, index, record)
+
+    def _on_record_attack(self, index: int, record: RecordAttack) -> None:
+        move = self._moves.get(record.move_attack_id)
+        if move is not None:
+            self._remember(self._results, index, move)
+
+
+# An opponent's statistics decay by this much at the start of each of their turns (and their
+# average attacking force by this much per attack), so they reflect roughly their last five turns.
+# There are slots for this many players.
+OPPONENT_DECAY = 0.8
+MAX_PLAYERS = 8
+
+# Until we have seen a player take this many turns we assume the worst of them: that they attack
+# every turn, and throw everything they have at a battle. However rarely a player has attacked, we
+# still allow for this much chance that they attack in a turn.
+OPPONENT_WARMUP_TURNS = 3
+MIN_ATTACK_CHANCE = 0.25
+
+
+class OpponentModel():
+    """Rolling statistics about how each player plays, in fixed-size arrays of decaying counters, so
+    memory stays the same however long the game goes on. Every record costs O(1), apart from the
+    start of a turn, which decays that player's continent counters.
+
+    - `attacks_on_us`: attacks the player has made on our territories.
+    - `aggression`: attacks the player makes per turn.
+    - `attack_force`: the average number of troops the player attacks with.
+    - `continent_focus`: attacks the player has made into each continent, at
+      `player * len(continent_names) + continent`.
+    - `cards`: an estimate of how many cards the player holds.
+    - `income`: troops the player gets at the start of a turn (0 if the records never say).
+    - `turns`: turns the player has started.
+    """
 
-def main():
-    
-    # Get the game object, which will connect you to the engine and
-    # track the state of the game.
-    game = Game()
-    bot_state = BotState()
-   
-    # Respond to the engine's queries with your moves.
-    while True:
-
-        # Get the engine's query (this will block until you receive a query).
-        query = game.get_next_query()
-
-        # Based on the type of query, respond with the correct move.
-        def choose_move(query: QueryType) -> MoveType:
-            match query:
-                case QueryClaimTerritory() as q:
-                    return handle_claim_territory(game, bot_state, q)
+    def __init__(self, map_index: MapIndex):
+        self.map_index = map_index
+        self.me: Optional[int] = None
+        self.mine = 0
+        self.attacks_on_us = array("d", [0.0]) * MAX_PLAYERS
+        self.aggression = array("d", [0.0]) * MAX_PLAYERS
+        self.attack_force = array("d", [0.0]) * MAX_PLAYERS
+        self.continent_focus = array("d", [0.0]) * (MAX_PLAYERS * len(map_index.continent_names))
+        self.cards = array("i", [0]) * MAX_PLAYERS
+        self.income = array("d", [0.0]) * MAX_PLAYERS
+        self.turns = array("i", [0]) * MAX_PLAYERS
+        self._attacks_this_turn = 0
+        self._conquered_this_turn = False
+        self._current: Optional[int] = None
+
+    def subscribe(self, dispatcher: RecordDispatcher) -> None:
+        dispatcher.subscribe(RecordStartTurn, self._on_start_turn)
+        dispatcher.subscribe(MoveAttack, self._on_move_attack)
+        dispatcher.subscribe(MoveTroopsAfterAttack, self._on_troops_after_attack)
+        dispatcher.subscribe(MoveRedeemCards, self._on_redeem_cards)
+        dispatcher.subscribe(RecordPlayerEliminated, self._on_player_eliminated)
+
+    def danger(self, player: Optional[int]) -> float:
+        """How much more we should fear this player's troops than anyone else's, from 1 (they haven't
+        been attacking us) up to 2 (they are the only one who has)."""
+        if player is None or not 0 <= player < MAX_PLAYERS:
+            return 1.0
+        return 1 + self.attacks_on_us[player] / (1 + sum(self.attacks_on_us))
+
+    def known(self, player: Optional[int]) -> bool:
+        """Whether we have seen enough of the player to go by their statistics."""
+        return player is not None and 0 <= player < MAX_PLAYERS and self.turns[player] >= OPPONENT_WARMUP_TURNS
+
+    def attack_chance(self, player: Optional[int]) -> float:
+        """The chance that the player attacks at all in a turn, from how many attacks they make a turn."""
+        if not self.known(player):
+            return 1.0
+        return max(MIN_ATTACK_CHANCE, min(1.0, self.aggression[player]))
+
+    def committed(self, player: Optional[int], attackers: int, dice: int) -> int:
+        """How many of the `attackers` the player is likely to spend on one battle: about as many as
+        the dice they roll in a turn, and at least the dice of the roll in front of us."""
+        if not self.known(player):
+            return attackers
+        return min(attackers, max(dice, math.ceil(self.aggression[player] * self.attack_force[player])))
+
+    def reinforcements(self, player: int, income: int) -> float:
+        """The troops the player can expect at the start of their next turn: their income (or the
+        `income` they would get for what they hold, if the records don't say), and their cards."""
+        return (self.income[player] or income) + CARD_VALUE * self.cards[player]
+
+    def focus(self, player: Optional[int]) -> int:
+        """The continent (position in `continent_names`) the player has been attacking into most, or
+        -1 if we don't know enough about them."""
+        if not self.known(player):
+            return -1
+        continents = len(self.map_index.continent_names)
+        row = self.continent_focus[player * continents:(player + 1) * continents]
+        best = max(range(continents), key=row.__getitem__)
+        return best if row[best] > 0 else -1
+
+    def signature(self, players: Iterable[Optional[int]]) -> tuple:
+        """Everything about the players that our plans depend on, rounded, for memo keys."""
+        return tuple((p, round(self.danger(p), 1), round(self.attack_chance(p), 1), self.focus(p)) for p in sorted(p for p in players if p is not None))
+
+    def snapshot(self) -> "OpponentModel":
+        """A copy of the statistics as they are now, which later records don't change."""
+        copied = copy.copy(self)
+        for name in ("attacks_on_us", "aggression", "attack_force", "continent_focus", "cards", "income", "turns"):
+            setattr(copied, name, array(getattr(self, name).typecode, getattr(self, name)))
+        return copied
+
+    def _on_start_turn(self, index: int, record: RecordStartTurn) -> None:
+        # First we finish off the turn that just ended. A player draws a card for a turn in which they
+        # conquered something.
+        previous = self._current
+        if previous is not None:
+            if self.turns[previous] == 1:
+                self.aggression[previous] = self._attacks_this_turn
+            else:
+                self.aggression[previous] = OPPONENT_DECAY * self.aggression[previous] + (1 - OPPONENT_DECAY) * self._attacks_this_turn
+            if self._conquered_this_turn:
+                self.cards[previous] += 1
+
+        player = record.player
+        self._current = player if 0 <= player < MAX_PLAYERS else None
+        self._attacks_this_turn = 0
+        self._conquered_this_turn = False
+        if self._current is None:
+            return
+
+        self.turns[player] += 1
+        self.attacks_on_us[player] *= OPPONENT_DECAY
+        continents = len(self.map_index.continent_names)
+        for i in range(player * continents, (player + 1) * continents):
+            self.continent_focus[i] *= OPPONENT_DECAY
+
+        # Only some engines say how many troops the player got, so without it we keep the estimate we have.
+        troops_gained = getattr(record, "troops_gained", None)
+        if troops_gained is None:
+            return
+        if self.income[player] == 0:
+            self.income[player] = troops_gained
+        else:
+            self.income[player] = OPPONENT_DECAY * self.income[player] + (1 - OPPONENT_DECAY) * troops_gained
+
+    def _on_move_attack(self, index: int, record: MoveAttack) -> None:
+        player = record.move_by_player
+        if not 0 <= player < MAX_PLAYERS:
+            return
+        self._attacks_this_turn += 1
+        if self.attack_force[player] == 0:
+            self.attack_force[player] = record.attacking_troops
+        else:
+            self.attack_force[player] = OPPONENT_DECAY * self.attack_force[player] + (1 - OPPONENT_DECAY) * record.attacking_troops
+        self.continent_focus[player * len(self.map_index.continent_names) + self.map_index.continent_of[record.defending_territory]] += 1
+        if self.mine >> record.defending_territory & 1 and player != self.me:
+            self.attacks_on_us[player] += 1
+
+    def _on_troops_after_attack(self, index: int, record: MoveTroopsAfterAttack) -> None:
+        self._conquered_this_turn = True
+
+    def _on_redeem_cards(self, index: int, record: MoveRedeemCards) -> None:
+        player = record.move_by_player
+        if 0 <= player < MAX_PLAYERS:
+            self.cards[player] = max(0, self.cards[player] - 3 * len(record.sets))
+
+    def _on_player_eliminated(self, index: int, record: RecordPlayerEliminated) -> None:
+        # Whoever's turn it is takes the eliminated player's cards.
+        if self._current is not None:
+            self.cards[self._current] += record.cards_surrendered_count
+        if 0 <= record.player < MAX_PLAYERS:
+            self.cards[record.player] = 0
+
+
+# How many of the latest attack rolls the battle history keeps row by row. Its running totals cover
+# the whole game.
+BATTLE_HISTORY = 8192
+
+
+class BattleHistory():
+    """Every attack roll of the game, one row each, in typed columns of a fixed size that wrap around
+    like a ring, plus running totals over the whole game. A row is filled in from the attack's three
+    records (the attack, the defence and its result) as the dispatcher hands them over, and only
+    numbers are kept, never the records themselves, so memory stays the same however long the game
+    goes on.
+
+    The i-th roll of the game is at `i % BATTLE_HISTORY` in each column:
+    - `turn`: the turn it was rolled in (counting turn starts, so the first turn is 1).
+    - `attacker`, `defender`: the players.
+    - `source`, `target`: the territory attacked from, and the one attacked.
+    - `attacking_dice`, `defending_dice`, `attacking_lost`, `defending_lost`: the dice and the troops lost.
+    - `conquered`: 1 if the roll took the target.
+
+    Rows are in the order they were rolled, so `turn` is sorted within each of the (at most two)
+    stretches of the ring the rows are in, and a query about the last few turns binary searches
+    for where they start and reads only those rows.
+    """
 
-                case QueryPlaceInitialTroop() as q:
-                    return handle_place_initial_troop(game, bot_state, q)
+    def __init__(self, map_index: MapIndex):
+        self.map_index = map_index
+        self.capacity = BATTLE_HISTORY
+        self.turn = array("i", [0]) * BATTLE_HISTORY
+        self.attacker = array("b", [0]) * BATTLE_HISTORY
+        self.defender = array("b", [0]) * BATTLE_HISTORY
+        self.source = array("i", [0]) * BATTLE_HISTORY
+        self.target = array("i", [0]) * BATTLE_HISTORY
+        self.attacking_dice = array("b", [0]) * BATTLE_HISTORY
+        self.defending_dice = array("b", [0]) * BATTLE_HISTORY
+        self.attacking_lost = array("b", [0]) * BATTLE_HISTORY
+        self.defending_lost = array("b", [0]) * BATTLE_HISTORY
+        self.conquered = array("b", [0]) * BATTLE_HISTORY
+        self.rolls = 0
+        self.turns = 0
+
+        # Running totals: per player, and per player and territory attacked from at
+        # `player * len(continent_of) + territory`.
+        size = len(map_index.continent_of)
+        self.rolls_by = array("i", [0]) * MAX_PLAYERS
+        self.lost_by = array("i", [0]) * MAX_PLAYERS
+        self.killed_by = array("i", [0]) * MAX_PLAYERS
+        self.conquests_by = array("i", [0]) * MAX_PLAYERS
+        self.lost_from = array("i", [0]) * (MAX_PLAYERS * size)
+        self.killed_from = array("i", [0]) * (MAX_PLAYERS * size)
+
+        # The attack we have seen the move (and maybe the defence) for, but not yet the result, as
+        # (record id, attacker, source, target, attacking dice), and the defender and their dice.
+        self._pending: Optional[tuple[int, int, int, int, int]] = None
+        self._defence = (-1, 0)
+
+    def subscribe(self, dispatcher: RecordDispatcher) -> None:
+        dispatcher.subscribe(RecordStartTurn, self._on_start_turn)
+        dispatcher.subscribe(MoveAttack, self._on_move_attack)
+        dispatcher.subscribe(MoveDefend, self._on_move_defend)
+        dispatcher.subscribe(RecordAttack, self._on_record_attack)
+
+    def _stretches(self, since_turn: int = 0) -> list[tuple[int, int]]:
+        """The rows rolled in or after the given turn, oldest first, as ranges of positions in the columns."""
+        if self.rolls <= self.capacity:
+            stretches = [(0, self.rolls)]
+        else:
+            head = self.rolls % self.capacity
+            stretches = [(head, self.capacity), (0, head)]
+        return [(bisect_left(self.turn, since_turn, lo, hi), hi) for lo, hi in stretches]
+
+    def loss_rate_from(self, territory: int, player: Optional[int] = None, turns: Optional[int] = None) -> float:
+        """The share of the troops lost in attacks from the territory that were the attacker's, by
+        the player (anyone, if not given) and in the last `turns` turns (the whole game, if not
+        given). It is 0.5 if there haven't been any."""
+        lost = killed = 0
+        if turns is None:
+            size = len(self.map_index.continent_of)
+            for p in range(MAX_PLAYERS) if player is None else (player,):
+                lost += self.lost_from[p * size + territory]
+                killed += self.killed_from[p * size + territory]
+        else:
+            for lo, hi in self._stretches(self.turns - turns + 1):
+                for source, attacker, attacking_lost, defending_lost in zip(self.source[lo:hi], self.attacker[lo:hi], self.attacking_lost[lo:hi], self.defending_lost[lo:hi]):
+                    if source == territory and (player is None or attacker == player):
+                        lost += attacking_lost
+                        killed += defending_lost
+        return lost / (lost + killed) if lost + killed else 0.5
+
+    def continent_attackers(self, continent: int, turns: int) -> list[int]:
+        """How many rolls each player has attacked into the continent (its position in
+        `continent_names`) with in the last `turns` turns, indexed by player."""
+        continent_of = self.map_index.continent_of
+        counts = [0] * MAX_PLAYERS
+        for lo, hi in self._stretches(self.turns - turns + 1):
+            for target, attacker in zip(self.target[lo:hi], self.attacker[lo:hi]):
+                if continent_of[target] == continent:
+                    counts[attacker] += 1
+        return counts
+
+    def summary(self) -> dict:
+        return {
+            "rolls": self.rolls,
+            "turns": self.turns,
+            "players": {
+                player: {"rolls": self.rolls_by[player], "lost": self.lost_by[player], "killed": self.killed_by[player], "conquests": self.conquests_by[player]}
+                for player in range(MAX_PLAYERS) if self.rolls_by[player]
+            },
+        }
+
+    def _on_start_turn(self, index: int, record: RecordStartTurn) -> None:
+        self.turns += 1
+
+    def _on_move_attack(self, index: int, record: MoveAttack) -> None:
+        self._pending = (index, record.move_by_player, record.attacking_territory, record.defending_territory, record.attacking_troops)
+        self._defence = (-1, 0)
+
+    def _on_move_defend(self, index: int, record: MoveDefend) -> None:
+        if self._pending is not None and record.move_attack_id == self._pending[0]:
+            self._defence = (record.move_by_player, record.defending_troops)
+
+    def _on_record_attack(self, index: int, record: RecordAttack) -> None:
+        pending = self._pending
+        self._pending = None
+        if pending is None or record.move_attack_id != pending[0]:
+            return
+        _, attacker, source, target, attacking_dice = pending
+        defender, defending_dice = self._defence
+        if not 0 <= attacker < MAX_PLAYERS or not -1 <= defender < MAX_PLAYERS:
+            return
+
+        row = self.rolls % self.capacity
+        self.turn[row] = self.turns
+        self.attacker[row] = attacker
+        self.defender[row] = defender
+        self.source[row] = source
+        self.target[row] = target
+        self.attacking_dice[row] = attacking_dice
+        # If we missed the defence, the dice that were compared are all we know the defender rolled.
+        self.defending_dice[row] = defending_dice or record.attacking_lost + record.defending_lost
+        self.attacking_lost[row] = record.attacking_lost
+        self.defending_lost[row] = record.defending_lost
+        self.conquered[row] = record.territory_conquered
+        self.rolls += 1
+
+        i = attacker * len(self.map_index.continent_of) + source
+        self.lost_from[i] += record.attacking_lost
+        self.killed_from[i] += record.defending_lost
+        self.rolls_by[attacker] += 1
+        self.lost_by[attacker] += record.attacking_lost
+        self.killed_by[attacker] += record.defending_lost
+        self.conquests_by[attacker] += record.territory_conquered
+
+
+# Set this to check the incrementally maintained indexes against a full recompute after every update.
+DEBUG_INDEXES = False
+
+
+# Zobrist hashing: every (territory, owner, troops) gets a fixed pseudo-random 64-bit key, and a
+# board's hash is the xor of the keys of its territories, so changing one territory changes the hash
+# in O(1). The hash uses exact troop counts, since the decisions we memoise by it depend on them.
+# The keys come from a splitmix64 mix of the triple rather than a table, so they cost no memory on
+# big maps. An unowned territory with no troops contributes nothing.
+HASH_MASK = (1 << 64) - 1
+
+
+def zobrist_key(territory: int, occupier: Optional[int], troops: int) -> int:
+    if occupier is None and troops == 0:
+        return 0
+    return mix64((territory * 64 + (occupier + 1 if occupier is not None else 0)) << 32 | troops)
+
+
+def mix64(x: int) -> int:
+    """The splitmix64 finaliser, which turns consecutive integers into unrelated 64-bit ones."""
+    x = (x + 0x9E3779B97F4A7C15) & HASH_MASK
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & HASH_MASK
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & HASH_MASK
+    return x ^ (x >> 31)
+
+
+# How many decisions and evaluations we memoise.
+MEMO_SIZE = 4096
+
+
+class LRUCache():
+    """A memo of at most `size` entries that evicts the least recently used one, and counts hits and
+    misses by the first element of the key (which is what kind of thing is being memoised). Entries
+    computed by the `speculator` thread are remembered, so we can count how many of them get used.
+    The speculator and the main thread can both be using the memo, so lookups and insertions hold a
+    lock (but computing a missing value doesn't)."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._entries: OrderedDict[tuple, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits: defaultdict[str, int] = defaultdict(int)
+        self.misses: defaultdict[str, int] = defaultdict(int)
+        self.evictions = 0
+        self.speculator: Optional[int] = None
+        self._speculative: set[tuple] = set()
+        self.speculative_hits: defaultdict[str, int] = defaultdict(int)
+
+    def get(self, key: tuple, compute: Callable[[], Any]) -> Any:
+        """The memoised value for the key, computing and remembering it on a miss."""
+        entries = self._entries
+        speculating = self.speculator is not None and threading.get_ident() == self.speculator
+        with self._lock:
+            if key in entries:
+                entries.move_to_end(key)
+                self.hits[key[0]] += 1
+                if self._speculative and not speculating and key in self._speculative:
+                    self._speculative.discard(key)
+                    self.speculative_hits[key[0]] += 1
+                return entries[key]
+            self.misses[key[0]] += 1
+
+        value = compute()
+        with self._lock:
+            entries[key] = value
+            if speculating:
+                self._speculative.add(key)
+            if len(entries) > self.size:
+                self._speculative.discard(entries.popitem(last=False)[0])
+                self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        """Forget every entry (but not the counts)."""
+        with self._lock:
+            self._entries.clear()
+            self._speculative.clear()
+
+    def summary(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "evictions": self.evictions,
+            "kinds": {
+                kind: {"hits": self.hits[kind], "misses": self.misses[kind], "speculative_hits": self.speculative_hits[kind]}
+                for kind in sorted(set(self.hits) | set(self.misses))
+            },
+        }
+
+
+class OwnershipIndex():
+    """Who owns each territory and how many troops are on it, with per-player territory bitmasks,
+    troop totals and continent counts, and our own border. It is kept up to date from the records that
+    arrive with each query, so the work per query is proportional to what changed."""
+
+    def __init__(self, map_index: MapIndex):
+        self.map_index = map_index
+        self.rebuilds = 0
+        self._attacks: Optional[AttackTracker] = None
+        self._reset()
+
+    def _reset(self) -> None:
+        map_index = self.map_index
+        size = len(map_index.continent_of)
+        self.owner: list[Optional[int]] = [None] * size
+        self.troops: list[int] = [0] * size
+        self.masks: defaultdict[Optional[int], int] = defaultdict(int)
+        self.troop_totals: defaultdict[Optional[int], int] = defaultdict(int)
+        self.continent_counts: defaultdict[Optional[int], list[int]] = defaultdict(lambda: [0] * len(map_index.continent_names))
+        self.border_mask = 0
+        self.me: Optional[int] = None
+
+        # The Zobrist hash of who owns what, with how many troops, and how many players there are.
+        self.hash = 0
+        self.players = 1
+
+        # The territories touched by the records delivered since the last update, and whether we were
+        # handed a record we couldn't place (so have to rebuild).
+        self._changed = 0
+        self._lost_track = False
+
+        # The (territory, previous owner, new owner) changes made by the latest update, so that
+        # anything derived from ownership can follow along incrementally (or notice `rebuilds` go up).
+        self.owner_changes: list[tuple[int, Optional[int], Optional[int]]] = []
+
+    def subscribe(self, dispatcher: RecordDispatcher, attacks: AttackTracker) -> None:
+        """Follow the records that move troops. Attack results are placed with the attack tracker,
+        which has to have subscribed first."""
+        self._attacks = attacks
+        for record_type in (MoveClaimTerritory, MovePlaceInitialTroop, MoveDistributeTroops, MoveAttack, RecordAttack, MoveTroopsAfterAttack, MoveFortify):
+            dispatcher.subscribe(record_type, self._on_record)
+
+    def update(self, game: Game) -> None:
+        """Apply the records delivered since the last update."""
+
+        # If this is the first query, or we lost track of a record, we rebuild from scratch.
+        if self._lost_track or self.me != game.state.me.player_id:
+            self.rebuild(game)
+            return
+
+        self.owner_changes = []
+        changed = self._changed
+        self._changed = 0
+        for territory in bits(changed):
+            self._set(territory, game.state.territories[territory].occupier, game.state.territories[territory].troops)
+        self._refresh_border(changed)
+
+        if DEBUG_INDEXES:
+            self.check(game)
+
+    def invalidate(self) -> None:
+        """Rebuild from the game state at the next update, for when the game state has been replaced
+        rather than recorded into (like when replaying a game log)."""
+        self._lost_track = True
+
+    def rebuild(self, game: Game) -> None:
+        """Recompute the whole index from the game state."""
+        self._reset()
+        self.rebuilds += 1
+        self.me = game.state.me.player_id
+        self.players = max(1, len(game.state.players))
+        self.masks[None] = self.map_index.all_mask
+        self.continent_counts[None] = list(self.map_index.continent_sizes)
+        for territory in self.map_index.territories:
+            model = game.state.territories[territory]
+            self._set(territory, model.occupier, model.troops)
+        self._refresh_border(self.map_index.all_mask)
+
+    def check(self, game: Game) -> None:
+        """Assert that the index matches a full recompute."""
+        expected = OwnershipIndex(self.map_index)
+        expected.rebuild(game)
+        assert self.owner == expected.owner, "owners diverged"
+        assert self.troops == expected.troops, "troops diverged"
+        for player in set(self.masks) | set(expected.masks):
+            assert self.masks[player] == expected.masks[player], f"territories of {player} diverged"
+            assert self.troop_totals[player] == expected.troop_totals[player], f"troop total of {player} diverged"
+            assert self.continent_counts[player] == expected.continent_counts[player], f"continent counts of {player} diverged"
+        assert self.border_mask == expected.border_mask, "border diverged"
+        assert self.hash == expected.hash, "hash diverged"
+
+    def snapshot(self) -> "OwnershipIndex":
+        """A copy of the index as it is now, which later updates don't change."""
+        copied = copy.copy(self)
+        copied.owner = list(self.owner)
+        copied.troops = list(self.troops)
+        copied.masks = defaultdict(int, self.masks)
+        copied.troop_totals = defaultdict(int, self.troop_totals)
+        copied.continent_counts = defaultdict(lambda: [0] * len(self.map_index.continent_names), {p: list(c) for p, c in self.continent_counts.items()})
+        copied.owner_changes = list(self.owner_changes)
+        return copied
+
+    def continent_progress(self, player: Optional[int]) -> list[float]:
+        """The fraction of each continent (in `continent_names` order) owned by the player."""
+        return [count / size for count, size in zip(self.continent_counts[player], self.map_index.continent_sizes)]
+
+    def income(self, player: Optional[int]) -> int:
+        """The troops the player gets at the start of a turn for the territories and continents they hold."""
+        map_index = self.map_index
+        counts = self.continent_counts.get(player)
+        held = 0 if counts is None else sum(map_index.continent_bonus[c] for c, count, size in zip(map_index.continent_names, counts, map_index.continent_sizes) if count == size)
+        return max(3, popcount(self.masks.get(player, 0)) // 3) + held
+
+    def _set(self, territory: int, occupier: Optional[int], troops: int) -> None:
+        previous = self.owner[territory]
+        self.hash ^= zobrist_key(territory, previous, self.troops[territory]) ^ zobrist_key(territory, occupier, troops)
+        if previous != occupier:
+            continent = self.map_index.continent_of[territory]
+            self.masks[previous] &= ~(1 << territory)
+            self.masks[occupier] |= 1 << territory
+            self.continent_counts[previous][continent] -= 1
+            self.continent_counts[occupier][continent] += 1
+            self.owner[territory] = occupier
+            self.owner_changes.append((territory, previous, occupier))
+        self.troop_totals[previous] -= self.troops[territory]
+        self.troop_totals[occupier] += troops
+        self.troops[territory] = troops
+
+    def _refresh_border(self, changed: int) -> None:
+        # A change of owner can only change the border status of the territory and its neighbours.
+        affected = changed | self.map_index.frontier(changed)
+        mine = self.masks[self.me] if self.me is not None else 0
+        self.border_mask &= ~affected
+        for territory in bits(mine & affected):
+            if self.map_index.neighbour_mask[territory] & ~mine:
+                self.border_mask |= 1 << territory
+
+    def _on_record(self, index: int, record: Any) -> None:
+        match record:
+            case MoveClaimTerritory() | MovePlaceInitialTroop():
+                self._changed |= 1 << record.territory
+            case MoveDistributeTroops():
+                self._changed |= mask_of(record.distributions.keys())
+            case MoveAttack():
+                self._changed |= 1 << record.attacking_territory | 1 << record.defending_territory
+            case MoveFortify():
+                self._changed |= 1 << record.source_territory | 1 << record.target_territory
+            case RecordAttack() | MoveTroopsAfterAttack():
+                assert self._attacks is not None
+                if isinstance(record, RecordAttack):
+                    move_attack = self._attacks.move_attack(record.move_attack_id)
+                else:
+                    move_attack = self._attacks.move_attack_for(record.record_attack_id)
+                if move_attack is None:
+                    self._lost_track = True
+                else:
+                    self._changed |= 1 << move_attack.attacking_territory | 1 << move_attack.defending_territory
+
+
+def _highest_dice(dice: int, keep: int) -> dict[tuple[int, ...], int]:
+    """The number of ways each of the `keep` highest of `dice` dice (highest first) can be rolled."""
+    counts: defaultdict[tuple[int, ...], int] = defaultdict(int)
+    for roll in product(range(1, 7), repeat=dice):
+        counts[tuple(sorted(roll, reverse=True)[:keep])] += 1
+    return counts
+
+
+# The outcomes of a single roll, for each number of attacking and defending dice, as a list of
+# (attacking troops lost, defending troops lost, probability). We work these out exactly, once, from
+# the dice each side compares rather than from every roll, which keeps our start-up quick.
+def _roll_outcomes(attacking_dice: int, defending_dice: int) -> list[tuple[int, int, float]]:
+    compared = min(attacking_dice, defending_dice)
+    counts: defaultdict[tuple[int, int], int] = defaultdict(int)
+    defences = _highest_dice(defending_dice, compared)
+    for attack, attack_ways in _highest_dice(attacking_dice, compared).items():
+        for defend, defend_ways in defences.items():
+            defending_lost = sum(1 for a, d in zip(attack, defend) if a > d)
+            counts[(compared - defending_lost, defending_lost)] += attack_ways * defend_ways
+    total = 6 ** (attacking_dice + defending_dice)
+    return [(a, d, n / total) for (a, d), n in sorted(counts.items())]
+
+
+ROLL_OUTCOMES: dict[tuple[int, int], list[tuple[int, int, float]]] = {
+    (a, d): _roll_outcomes(a, d) for a in range(1, 4) for d in range(1, 3)
+}
+
+# Battles bigger than this are scaled down onto the table, which keeps their odds very close.
+MAX_BATTLE_TROOPS = 400
+
+# The full battle tables take a while to work out, so if we are given a file for them, at the end of a
+# game we write them there, and read them back at the start of the next one.
+BATTLE_TABLES_PATH = os.environ.get("BOT_BATTLE_TABLES", "")
+
+
+class BattleOdds():
+    """Exact odds of a full battle, where the attacker keeps attacking with as many dice as it can
+    until one side runs out of troops, and the defender always defends with as many as it can.
+    The tables are filled bottom-up and grown on demand, so every lookup after that is O(1). They
+    are kept flat, with the entry for `a` attackers and `d` defenders at `a * size + d`, which lets
+    us memory-map full tables written by an earlier game and read them in place."""
+
+    HEADER = struct.Struct("<8sQ")
+    MAGIC = b"RISKBO01"
+
+    def __init__(self, size: int = 64):
+        self._tables: tuple[int, Sequence[float], Sequence[float]] = (0, array("d"), array("d"))
+        self.loaded = False
+        self._grow(size)
+
+    def _grow(self, size: int) -> None:
+        size = min(size, MAX_BATTLE_TROOPS + 1)
+        win = array("d", [0.0]) * (size * size)
+        survivors = array("d", [0.0]) * (size * size)
+
+        # Where each outcome of a roll leaves the battle, as an offset back from the current entry.
+        offsets = {dice: [(a * size + d, p) for a, d, p in outcomes] for dice, outcomes in ROLL_OUTCOMES.items()}
+        for a in range(1, size):
+            row = a * size
+            win[row] = 1.0
+            survivors[row] = float(a)
+            row_offsets = [offsets[(min(a, 3), min(d, 2))] for d in range(1, 3)]
+            for d in range(1, size):
+                i = row + d
+                p_win = 0.0
+                expected = 0.0
+                for offset, p in row_offsets[min(d, 2) - 1]:
+                    p_win += p * win[i - offset]
+                    expected += p * survivors[i - offset]
+                win[i] = p_win
+                survivors[i] = expected
+
+        # The tables and their size change together, so a lookup never sees tables smaller than it expects.
+        self._tables = (size, win, survivors)
+
+    def _lookup(self, attackers: int, defenders: int) -> tuple[int, Sequence[float], Sequence[float]]:
+        """Where the battle is in the tables, and the tables."""
+        attackers = max(attackers, 0)
+        defenders = max(defenders, 0)
+        largest = max(attackers, defenders)
+        if largest > MAX_BATTLE_TROOPS:
+            attackers = attackers * MAX_BATTLE_TROOPS // largest
+            defenders = defenders * MAX_BATTLE_TROOPS // largest
+            largest = MAX_BATTLE_TROOPS
+        size, win, survivors = self._tables
+        if largest >= size:
+            self._grow(max(2 * size, largest + 1))
+            size, win, survivors = self._tables
+        return attackers * size + defenders, win, survivors
+
+    def covers(self, troops: int) -> bool:
+        """Whether battles with up to this many troops a side can be looked up without growing the tables."""
+        size = self._tables[0]
+        return troops < size or size > MAX_BATTLE_TROOPS
+
+    def win_probability(self, attackers: int, defenders: int) -> float:
+        """The chance that `attackers` troops (not counting the one left behind) conquer a territory
+        held by `defenders` troops."""
+        i, win, _ = self._lookup(attackers, defenders)
+        return win[i]
+
+    def expected_survivors(self, attackers: int, defenders: int) -> float:
+        """The expected number of attacking troops left at the end of the battle (zero if it is lost)."""
+        scale = max(attackers, defenders, MAX_BATTLE_TROOPS) / MAX_BATTLE_TROOPS
+        i, _, survivors = self._lookup(attackers, defenders)
+        return survivors[i] * scale
+
+    def hold_probability(self, attacking_dice: int, attackers: int, defending_dice: int, defenders: int) -> float:
+        """The chance that a territory with `defenders` troops survives the rest of a battle, if it
+        defends this roll with `defending_dice` against `attacking_dice` dice."""
+        hold = 0.0
+        for attacking_lost, defending_lost, p in ROLL_OUTCOMES[(attacking_dice, defending_dice)]:
+            if defenders - defending_lost > 0:
+                hold += p * (1 - self.win_probability(attackers - attacking_lost, defenders - defending_lost))
+        return hold
+
+    @classmethod
+    def load(cls, path: str) -> "BattleOdds":
+        """The full tables from the file at the path, read in place, or tables grown on demand if
+        there is no file (or it was written for another table size)."""
+        size = MAX_BATTLE_TROOPS + 1
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return cls()
+        if len(data) < cls.HEADER.size:
+            return cls()
+        magic, tables_size = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or tables_size != size or len(data) != cls.HEADER.size + 16 * size * size:
+            return cls()
+        view = memoryview(data)
+        odds = cls(0)
+        odds._tables = (size, view[cls.HEADER.size:cls.HEADER.size + 8 * size * size].cast("d"), view[cls.HEADER.size + 8 * size * size:].cast("d"))
+        odds.loaded = True
+        return odds
+
+    def write(self, path: str) -> None:
+        """Grow the tables to full size and write them to the path. We write to a temporary file
+        first, so a game starting at the same time never reads half a file."""
+        self._lookup(MAX_BATTLE_TROOPS, 0)
+        size, win, survivors = self._tables
+        temporary = f"{path}.{os.getpid()}"
+        try:
+            with open(temporary, "wb") as f:
+                f.write(self.HEADER.pack(self.MAGIC, size))
+                f.write(bytes(win))
+                f.write(bytes(survivors))
+            os.replace(temporary, path)
+        except OSError:
+            pass
+
+
+battle_odds = BattleOdds.load(BATTLE_TABLES_PATH)
+
+# We only start (or carry on) a battle if we are at least this likely to win it, and when we move
+# troops into a conquered territory we leave enough behind that a neighbouring enemy is at most
+# this likely to take our attacking territory.
+MIN_ATTACK_WIN_PROBABILITY = 0.5
+MAX_HOLD_RISK = 0.5
+
+
+class PlayerDistances():
+    """For each player we are interested in, the hop distance from every territory to that player's
+    nearest territory, and which territory that is. A field is built with one multi-source BFS the
+    first time it is asked for, and then follows ownership changes: a territory a player gains can
+    only bring things closer, so a BFS from it that stops wherever it stops improving the field
+    brings it up to date. A territory a player loses leaves the field stale, and it is rebuilt the
+    next time it is asked for, unless the speculator has already built one for the board we are on."""
+
+    def __init__(self, map_index: MapIndex, ownership: OwnershipIndex):
+        self.map_index = map_index
+        self.ownership = ownership
+        self._fields: dict[Optional[int], tuple[array, array]] = {}
+        self._stale: set[Optional[int]] = set()
+        self._offered: dict[Optional[int], tuple[int, tuple[array, array]]] = {}
+        self._rebuilds = ownership.rebuilds
+
+    def update(self) -> None:
+        """Follow the ownership changes made by the latest ownership update."""
+        if self._rebuilds != self.ownership.rebuilds:
+            self._rebuilds = self.ownership.rebuilds
+            self._fields.clear()
+            self._stale.clear()
+            self._offered.clear()
+            return
+
+        for territory, previous, occupier in self.ownership.owner_changes:
+            if previous in self._fields:
+                self._stale.add(previous)
+            if occupier in self._fields and occupier not in self._stale:
+                self._gain(occupier, territory)
+
+    def _gain(self, player: Optional[int], territory: int) -> None:
+        """Bring the player's field up to date with their gaining the territory. Anywhere the territory
+        isn't strictly closer than what the player had, nothing beyond it can be either."""
+        distance, nearest = self._fields[player]
+        adjacent = self.map_index.adjacent
+        distance[territory] = 0
+        nearest[territory] = territory
+        queue = deque([territory])
+        while queue:
+            current = queue.popleft()
+            hops = distance[current] + 1
+            for neighbour in adjacent[current]:
+                if distance[neighbour] < 0 or hops < distance[neighbour]:
+                    distance[neighbour] = hops
+                    nearest[neighbour] = territory
+                    queue.append(neighbour)
+
+    def needs(self, player: Optional[int]) -> bool:
+        """Whether the player's field would have to be built the next time it is asked for."""
+        if player in self._fields and player not in self._stale:
+            return False
+        offered = self._offered.get(player)
+        return offered is None or offered[0] != self.ownership.masks[player]
+
+    def prepare(self, player: Optional[int], mask: int) -> None:
+        """Build the player's field for when they own the territories in `mask`, which the speculator
+        does while we wait for a query. It is only used if that is still what they own when the field
+        is next asked for."""
+        self._offered[player] = (mask, self._build(mask))
+
+    def _field(self, player: Optional[int]) -> tuple[array, array]:
+        # The watchdog can interrupt a build, so the field only counts as fresh once it is finished.
+        if player not in self._fields or player in self._stale:
+            mask = self.ownership.masks[player]
+            offered = self._offered.pop(player, None)
+            self._fields[player] = offered[1] if offered is not None and offered[0] == mask else self._build(mask)
+            self._stale.discard(player)
+        return self._fields[player]
+
+    def _build(self, mask: int) -> tuple[array, array]:
+        size = len(self.map_index.adjacent)
+        distance = array("i", [-1]) * size
+        nearest = array("i", [-1]) * size
+        queue = deque()
+        for root in bits(mask):
+            distance[root] = 0
+            nearest[root] = root
+            queue.append(root)
+        while queue:
+            current = queue.popleft()
+            for neighbour in self.map_index.adjacent[current]:
+                if distance[neighbour] < 0:
+                    distance[neighbour] = distance[current] + 1
+                    nearest[neighbour] = nearest[current]
+                    queue.append(neighbour)
+        return distance, nearest
+
+    def distance(self, player: Optional[int], territory: int) -> int:
+        """Hops from the territory to the player's nearest territory, or -1 if there is none."""
+        return self._field(player)[0][territory]
+
+    def nearest(self, player: Optional[int], territory: int) -> int:
+        """The player's territory nearest to the given one, or -1 if there is none."""
+        return self._field(player)[1][territory]
+
+
+class OwnedComponents():
+    """The connected groups of our territories, which are the only places fortifying can move troops
+    around. A territory we gain can only join groups together, which we do by relabelling the smaller
+    groups. A territory we lose can split a group, so then we regroup from scratch (O(territories +
+    borders)) the next time we are asked, unless the speculator has already done it for the board we
+    are on."""
+
+    def __init__(self, map_index: MapIndex, ownership: OwnershipIndex):
+        self.map_index = map_index
+        self.ownership = ownership
+        self.component_of = array("i", [-1]) * len(map_index.adjacent)
+        self._masks: dict[int, int] = {}
+        self._next_id = 0
+        self._stale = True
+        self._offered: Optional[tuple[int, array, dict[int, int]]] = None
+        self._rebuilds = ownership.rebuilds
+
+    def update(self) -> None:
+        """Follow the ownership changes made by the latest ownership update."""
+        if self._rebuilds != self.ownership.rebuilds:
+            self._rebuilds = self.ownership.rebuilds
+            self._stale = True
+            self._offered = None
+        if self._stale:
+            return
+
+        me = self.ownership.me
+        for territory, previous, occupier in self.ownership.owner_changes:
+            if previous == me:
+                self._stale = True
+                return
+            if occupier == me:
+                self._add(territory)
+
+    def _add(self, territory: int) -> None:
+        mine = self.ownership.masks[self.ownership.me]
+        component_of = self.component_of
+        groups = {component_of[x] for x in self.map_index.adjacent[territory] if mine >> x & 1 and component_of[x] >= 0}
+        if not groups:
+            group = self._next_id
+            self._next_id += 1
+            self._masks[group] = 0
+        else:
+            group = max(groups, key=lambda g: popcount(self._masks[g]))
+            for other in groups - {group}:
+                for x in bits(self._masks[other]):
+                    component_of[x] = group
+                self._masks[group] |= self._masks.pop(other)
+        component_of[territory] = group
+        self._masks[group] |= 1 << territory
+
+    def needs(self) -> bool:
+        """Whether we would have to regroup the next time we are asked."""
+        return self._stale and (self._offered is None or self._offered[0] != self.ownership.masks[self.ownership.me])
+
+    def prepare(self, mine: int) -> None:
+        """Group the territories in `mine`, which the speculator does while we wait for a query. The
+        groups are only used if that is still what we own when we are next asked."""
+        self._offered = (mine, *self._group(mine))
+
+    def _rebuild(self) -> None:
+        # The watchdog can interrupt us, so we regroup into new tables and only swap them in (and
+        # stop being stale) once they are finished.
+        mine = self.ownership.masks[self.ownership.me]
+        offered, self._offered = self._offered, None
+        if offered is not None and offered[0] == mine:
+            component_of, masks = offered[1], offered[2]
+        else:
+            component_of, masks = self._group(mine)
+        self.component_of = component_of
+        self._masks = masks
+        self._next_id = len(masks)
+        self._stale = False
+
+    def _group(self, unseen: int) -> tuple[array, dict[int, int]]:
+        masks: dict[int, int] = {}
+        component_of = array("i", [-1]) * len(self.map_index.adjacent)
+        while unseen:
+            root = lowest(unseen)
+            group = len(masks)
+            members = 1 << root
+            frontier = members
+            while frontier:
+                reached = self.map_index.frontier(frontier) & unseen & ~members
+                members |= reached
+                frontier = reached
+            unseen &= ~members
+            masks[group] = members
+            for x in bits(members):
+                component_of[x] = group
+        return component_of, masks
+
+    def groups(self) -> list[int]:
+        """The bitmask of each of our connected groups of territories."""
+        if self._stale:
+            self._rebuild()
+        return list(self._masks.values())
+
+
+# How much a territory's placement score goes up (in troops) for how much of its continent we own,
+# and for each other continent it leads into. Troops next to a territory count this many times over
+# if their owner has been attacking into its continent.
+CONTINENT_WEIGHT = 4.0
+CHOKEPOINT_WEIGHT = 2.0
+FOCUS_THREAT = 1.5
+
+
+class BoardEvaluator():
+    """Scores every territory for a player in one pass over the adjacency lists, which is
+    O(territories + borders) however big the map is, so the placement handlers only have to pick the
+    best-scoring territory from a bitmask.
+
+    - `threat`: enemy troops adjacent to the territory, weighted by how dangerous their owner is, and
+      by whether their owner has been attacking into the territory's continent.
+    - `pressure`: threat minus the troops already on it.
+    - `completion`: how much of the territory's continent the player owns.
+    - `chokepoint`: how many other continents the territory leads into (this never changes).
+    """
 
-                case QueryRedeemCards() as q:
-                    return handle_redeem_cards(game, bot_state, q)
+    def __init__(self, map_index: MapIndex, ownership: OwnershipIndex, opponents: OpponentModel, memo: LRUCache):
+        self.map_index = map_index
+        self.ownership = ownership
+        self.opponents = opponents
+        self.memo = memo
+        size = len(map_index.adjacent)
+        self.threat = array("d", [0.0]) * size
+        self.pressure = array("d", [0.0]) * size
+        self.completion = array("d", [0.0]) * size
+        self.score = array("d", [0.0]) * size
+        self.chokepoint = array("d", [0.0]) * size
+        for territory, linked in map_index.joint_links.items():
+            self.chokepoint[territory] = len(linked)
+
+    def evaluate(self, player: Optional[int]) -> None:
+        """Score every territory for the player, from the board as the ownership index has it. Boards
+        with the same hash (and the same opponents to fear) share their scores."""
+        danger = {p: self.opponents.danger(p) for p in self.ownership.masks}
+        focus = {p: self.opponents.focus(p) for p in self.ownership.masks}
+        key = ("evaluation", self.ownership.hash, player, self.opponents.signature(self.ownership.masks))
+        self.threat, self.pressure, self.completion, self.score = self.memo.get(key, lambda: self._evaluate(player, danger, focus))
+
+    def _evaluate(self, player: Optional[int], danger: dict[Optional[int], float], focus: dict[Optional[int], int]) -> tuple[array, array, array, array]:
+        map_index = self.map_index
+        owner = self.ownership.owner
+        troops = self.ownership.troops
+        progress = self.ownership.continent_progress(player)
+        size = len(map_index.adjacent)
+        threat = array("d", [0.0]) * size
+        pressure = array("d", [0.0]) * size
+        completion = array("d", [0.0]) * size
+        score = array("d", [0.0]) * size
+        chokepoint = self.chokepoint
+        for territory in map_index.territories:
+            enemy_troops = 0.0
+            continent = map_index.continent_of[territory]
+            for neighbour in map_index.adjacent[territory]:
+                if owner[neighbour] != player:
+                    focused = FOCUS_THREAT if focus.get(owner[neighbour], -1) == continent else 1.0
+                    enemy_troops += troops[neighbour] * danger.get(owner[neighbour], 1.0) * focused
+            threat[territory] = enemy_troops
+            pressure[territory] = enemy_troops - troops[territory]
+
+            # A continent we already hold doesn't get any more ours by reinforcing it.
+            continent_progress = progress[continent]
+            completion[territory] = continent_progress
+            score[territory] = pressure[territory] + CHOKEPOINT_WEIGHT * chokepoint[territory] + (CONTINENT_WEIGHT * continent_progress if continent_progress < 1 else 0.0)
+        return threat, pressure, completion, score
+
+    def best(self, mask: int) -> int:
+        """The best-scoring territory in the mask (the lowest one on a tie), or -1 if it is empty."""
+        score = self.score
+        return max(bits(mask), key=lambda x: score[x], default=-1)
+
+    def ranked(self, mask: int) -> list[int]:
+        """The territories in the mask from best to worst score."""
+        score = self.score
+        return sorted(bits(mask), key=lambda x: -score[x])
+
+
+# Card symbols, in the order we count them in, and every way three cards can make a set as how
+# many of each symbol it uses: three of a kind, one of each, or anything made up with wildcards.
+CARD_SYMBOLS = ("Infantry", "Cavalry", "Artillery", "Wildcard")
+SET_SHAPES: tuple[tuple[int, ...], ...] = tuple(
+    counts for counts in product(range(4), repeat=4)
+    if sum(counts) == 3 and (len([s for s in range(3) if counts[s]]) in (1, 3 - counts[3]) or counts[3] >= 2)
+)
+
+# The troops the n-th card set redeemed in the game is worth. After the last one, each set is worth
+# SET_BONUS_STEP more than the one before.
+SET_BONUSES = (4, 6, 8, 10, 12, 15)
+SET_BONUS_STEP = 5
+
+
+def set_bonus(sets_redeemed: int) -> int:
+    """The troops the next card set is worth, when `sets_redeemed` have been redeemed so far."""
+    if sets_redeemed < len(SET_BONUSES):
+        return SET_BONUSES[sets_redeemed]
+    return SET_BONUSES[-1] + SET_BONUS_STEP * (sets_redeemed - len(SET_BONUSES) + 1)
+
+
+class RedemptionPlanner():
+    """Chooses which card sets to redeem. A hand is indexed once by how many cards of each symbol it
+    has, and every combination of disjoint sets that fits those counts is enumerated (and cached, as
+    the counts repeat all game). Decisions are cached per hand too, so asking again costs nothing."""
 
-                case QueryDistributeTroops() as q:
-                    return handle_distribute_troops(game, bot_state, q)
+    def __init__(self):
+        self._combinations: dict[tuple[int, ...], list[tuple[int, ...]]] = {}
+        self._decisions: dict[tuple, list[tuple[int, int, int]]] = {}
+
+    def combinations(self, counts: tuple[int, ...]) -> list[tuple[tuple[int, ...], tuple[int, ...]]]:
+        """Every combination of disjoint sets the symbol counts allow (including none), each as indexes
+        into SET_SHAPES in ascending order, with how many of each symbol it uses."""
+        if counts not in self._combinations:
+            found: list[tuple[tuple[int, ...], tuple[int, ...]]] = []
+
+            def extend(used: tuple[int, ...], start: int, chosen: tuple[int, ...]) -> None:
+                found.append((chosen, used))
+                for i in range(start, len(SET_SHAPES)):
+                    total = tuple(a + b for a, b in zip(used, SET_SHAPES[i]))
+                    if all(have >= use for have, use in zip(counts, total)):
+                        extend(total, i, chosen + (i,))
+
+            extend((0,) * len(CARD_SYMBOLS), 0, ())
+            self._combinations[counts] = found
+        return self._combinations[counts]
+
+    def plan(self, cards: list[CardModel], mine: int, redeem_all: bool) -> list[tuple[int, int, int]]:
+        """The card id triples to redeem. We redeem as few sets as we must to get below five cards,
+        unless `redeem_all`, when we redeem as many as we can. Every combination of that many sets is
+        worth the same for the sets themselves, so we take one that redeems a card for a territory we
+        own (which is worth 2 more troops), and then the one that leaves us the most wildcards and
+        different symbols for later."""
+        if len(cards) < 3 or (len(cards) < 5 and not redeem_all):
+            return []
+        matching = {c.card_id for c in cards if c.territory_id is not None and mine >> c.territory_id & 1}
+        key = (tuple(sorted(c.card_id for c in cards)), tuple(sorted(matching)), redeem_all)
+        if key in self._decisions:
+            return self._decisions[key]
+
+        # Cards for territories we own go first, so any set that uses their symbol picks them up.
+        by_symbol: list[list[CardModel]] = [[] for _ in CARD_SYMBOLS]
+        for card in cards:
+            by_symbol[CARD_SYMBOLS.index(card.symbol)].append(card)
+        for symbol_cards in by_symbol:
+            symbol_cards.sort(key=lambda c: c.card_id not in matching)
+        counts = tuple(len(x) for x in by_symbol)
+        has_matching = tuple(bool(x) and x[0].card_id in matching for x in by_symbol)
+
+        combinations = self.combinations(counts)
+        wanted = max(len(x) for x, _ in combinations) if redeem_all else max(0, (len(cards) - 2) // 3)
+        candidates = [x for x in combinations if len(x[0]) == wanted] or [max(combinations, key=lambda x: len(x[0]))]
+
+        def value(candidate: tuple[tuple[int, ...], tuple[int, ...]]) -> tuple[bool, int, int]:
+            _, used = candidate
+            matched = any(u and m for u, m in zip(used, has_matching))
+            return matched, counts[3] - used[3], sum(1 for s in range(3) if counts[s] > used[s])
+
+        best, _ = max(candidates, key=value)
+        queues = [list(x) for x in by_symbol]
+        card_sets = []
+        for i in best:
+            card_set = [queues[s].pop(0) for s in range(len(CARD_SYMBOLS)) for _ in range(SET_SHAPES[i][s])]
+            card_sets.append((card_set[0].card_id, card_set[1].card_id, card_set[2].card_id))
+
+        if len(self._decisions) > 1024:
+            self._decisions.clear()
+        self._decisions[key] = card_sets
+        return card_sets
+
+
+# A player has to be at least this dangerous (see OpponentModel.danger) before we treat them as
+# the one coming for us. Otherwise we pick on a neighbour with a weak territory next to ours, where
+# each troop they can expect next turn counts as this many troops on it the other way (we would
+# rather hit them before they place them), and attacking into the continent we have most of counts
+# as this many.
+MIN_ENEMY_DANGER = 1.25
+REINFORCEMENT_WEIGHT = 0.5
+FOCUS_WEIGHT = 3.0
+
+# We stop spreading our troops and start doomstacking once the game has gone on this many records,
+# or this many turns (a game with few attacks in it can go on for a long time on few records).
+LATE_GAME_RECORDS = 4000
+LATE_GAME_TURNS = 120
+
+
+# How long we spend rolling out candidate attack chains each time we plan (0 turns the search off),
+# in how many worker processes (0 means in the bot's own process), and how many chains we compare.
+SEARCH_BUDGET_SECONDS = float(os.environ.get("BOT_SEARCH_BUDGET", "0.02"))
+SEARCH_WORKERS = int(os.environ.get("BOT_SEARCH_WORKERS", "0"))
+SEARCH_CANDIDATES = 4
+
+# What the end of a rolled-out turn is worth: each territory taken, drawing a card for taking any,
+# each troop of a newly held continent's bonus, and each troop killed or lost.
+TERRITORY_VALUE = 1.0
+CARD_VALUE = 2.0
+CONTINENT_VALUE = 2.0
+TROOP_VALUE = 0.1
+
+# The worker processes for the search, started by main() if SEARCH_WORKERS asks for them, and how
+# many there are.
+search_pool: Optional["ProcessPoolExecutor"] = None
+search_workers = 0
+
+
+def run_rollouts(search_map: tuple[list[int], tuple[int, ...], tuple[int, ...]], troops: list[int], mine: int, chains: list[tuple[tuple[int, int, int], ...]], budget: float, seed: int, stop: Optional[threading.Event] = None) -> tuple[list[float], list[int]]:
+    """Roll out every chain in turn until the budget (in seconds) runs out, or `stop` is set, and
+    return the total value and number of rollouts for each. This only uses the map data it is given,
+    so it can run in a worker process. `search_map` is the neighbour masks, continent masks and
+    continent bonuses."""
+    deadline = time.perf_counter() + budget
+    rng = random.Random(seed)
+    totals = [0.0] * len(chains)
+    counts = [0] * len(chains)
+    while True:
+        for i, chain in enumerate(chains):
+            totals[i] += rollout(search_map, troops, mine, chain, rng)
+            counts[i] += 1
+        if time.perf_counter() >= deadline or stop is not None and stop.is_set():
+            return totals, counts
+
+
+def rollout(search_map: tuple[list[int], tuple[int, ...], tuple[int, ...]], troops: list[int], mine: int, chain: tuple[tuple[int, int, int], ...], rng: random.Random) -> float:
+    """Follow the chain with random dice, the way we would play it (carrying on a battle while it is
+    in our favour, and stopping the chain at the first battle we give up), and value where we end up."""
+    _, continent_masks, continent_bonuses = search_map
+    changed: dict[int, int] = {}
+    start_mine = mine
+    lost = killed = 0
+    for source, target, keep in chain:
+        if not mine >> source & 1 or mine >> target & 1:
+            break
+        attackers = changed.get(source, troops[source]) - 1
+        defenders = changed.get(target, troops[target])
+        while attackers > 0 and defenders > 0 and battle_odds.win_probability(attackers, defenders) >= MIN_ATTACK_WIN_PROBABILITY:
+            r = rng.random()
+            for attacking_lost, defending_lost, p in ROLL_OUTCOMES[(min(attackers, 3), min(defenders, 2))]:
+                r -= p
+                if r < 0:
+                    break
+            attackers -= attacking_lost
+            defenders -= defending_lost
+            lost += attacking_lost
+            killed += defending_lost
+        if defenders > 0:
+            break
+        mine |= 1 << target
+        changed[source] = max(1, min(keep, attackers + 1 - min(3, attackers)))
+        changed[target] = attackers + 1 - changed[source]
+
+    gained = mine & ~start_mine
+    value = TERRITORY_VALUE * popcount(gained) + TROOP_VALUE * (killed - lost)
+    if gained:
+        value += CARD_VALUE
+    for continent_mask, bonus in zip(continent_masks, continent_bonuses):
+        if continent_mask & gained and continent_mask & mine == continent_mask:
+            value += CONTINENT_VALUE * bonus
+    return value
+
+
+# A plan looks at most this many conquests ahead, and prefers attacking our enemy's territories by
+# this much win probability.
+MAX_PLANNED_ATTACKS = 12
+ENEMY_PREFERENCE = 0.1
+
+
+def troops_to_keep(threat: int, attack_chance: float = 1.0) -> int:
+    """The fewest troops a territory needs so that a neighbouring enemy territory with `threat` troops,
+    whose owner attacks with `attack_chance` in a turn, is at most MAX_HOLD_RISK likely to take it."""
+    if threat <= 1:
+        return 1
+
+    # The enemy's odds only go down as we leave more behind, so we can binary search for the fewest
+    # troops to keep.
+    low, high = 1, threat
+    while low < high:
+        keep = (low + high) // 2
+        if attack_chance * battle_odds.win_probability(threat - 1, keep) <= MAX_HOLD_RISK:
+            high = keep
+        else:
+            low = keep + 1
+    return low
+
+
+class TurnPlan():
+    """What we mean to do for the rest of our turn, worked out once when we distribute our troops:
+    where the troops went, the attacks to make in order, how many troops to keep in the attacking
+    territory after each conquest, and (once we stop attacking) the fortify move. Later queries only
+    check that the next step still makes sense on the board, and we only plan again when a battle
+    has gone badly enough that it doesn't, or the troops didn't go where the plan has them."""
+
+    def __init__(self, placements: dict[int, int], attacks: deque[tuple[int, int, int]]):
+        self.placements = {territory: troops for territory, troops in placements.items() if troops}
+
+        # (attacking territory, target, troops to keep in the attacking territory after the conquest)
+        self.attacks = attacks
+        self.fortify: Optional[tuple[int, int, int]] = None
+
+    def placed(self, distributions: dict[int, int]) -> bool:
+        """Whether the distribution that was made is the one the plan was made for."""
+        return self.placements == {territory: troops for territory, troops in distributions.items() if troops}
+
+
+OPENING_BOOK_PATH = os.environ.get("BOT_OPENING_BOOK", "opening_book.bin")
+
+# The phases the opening book has picks for.
+BOOK_CLAIM = 0
+BOOK_PLACE = 1
+
+
+class OpeningBook():
+    """The continents to claim in and place initial troops in that did best from each position in
+    self-play, made offline by make_opening_book.py. The file is a header, then the sorted 64-bit
+    position keys, then the 16-bit continent (its position in `continent_names`) picked for each, all
+    little-endian. It is memory-mapped and the columns are read in place through memoryviews, so
+    opening it is O(1) and a lookup is a binary search."""
+
+    HEADER = struct.Struct("<8sQQ")
+    MAGIC = b"RISKBK02"
+
+    def __init__(self, keys: Sequence[int], picks: Sequence[int]):
+        self.keys = keys
+        self.picks = picks
+
+    @staticmethod
+    def key(map_index: MapIndex, ownership: OwnershipIndex, phase: int) -> int:
+        """The book key for the board as the ownership index has it, from our seat. The exact board
+        hardly ever comes up twice after the first few claims, so a position is only how many of each
+        continent's territories we and the others hold, and how many of ours border it."""
+        me = ownership.me
+        mine = ownership.masks[me]
+        ours, unclaimed = ownership.continent_counts[me], ownership.continent_counts[None]
+        key = mix64(phase * 256 + ownership.players)
+        for i, continent in enumerate(map_index.continent_names):
+            others = map_index.continent_sizes[i] - ours[i] - unclaimed[i]
+            bordering = popcount(mine & map_index.continent_approaches[continent])
+            key = mix64(key ^ (ours[i] << 40 | others << 20 | bordering))
+        return key
+
+    def lookup(self, key: int) -> Optional[int]:
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.picks[i]
+        return None
+
+    @classmethod
+    def load(cls, path: str, fingerprint: int) -> Optional["OpeningBook"]:
+        """The book at the path, or None if there isn't one for this map."""
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(data) < cls.HEADER.size:
+            return None
+        magic, book_fingerprint, count = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or book_fingerprint != fingerprint or len(data) != cls.HEADER.size + 10 * count:
+            return None
+        view = memoryview(data)
+        keys_end = cls.HEADER.size + 8 * count
+        return cls(view[cls.HEADER.size:keys_end].cast("Q"), view[keys_end:].cast("H"))
+
+    @classmethod
+    def write(cls, path: str, fingerprint: int, picks: dict[int, int]) -> None:
+        keys = sorted(picks)
+        with open(path, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, fingerprint, len(keys)))
+            f.write(struct.pack(f"<{len(keys)}Q", *keys))
+            f.write(struct.pack(f"<{len(keys)}H", *(picks[k] for k in keys)))
+
+
+# If this is set, we log every query we answer here, for replay.py.
+RECORD_PATH = os.environ.get("BOT_RECORD_PATH", "")
+
+# The queries, moves, records and query causes in a game log, by their position in these tuples, and
+# how many of our cards (and of the cards we redeem) a frame has room for. Records are the moves and
+# the records we read.
+LOG_QUERIES = (QueryClaimTerritory, QueryPlaceInitialTroop, QueryRedeemCards, QueryDistributeTroops, QueryAttack, QueryTroopsAfterAttack, QueryDefend, QueryFortify)
+LOG_MOVES = (MoveClaimTerritory, MovePlaceInitialTroop, MoveRedeemCards, MoveDistributeTroops, MoveAttack, MoveAttackPass, MoveTroopsAfterAttack, MoveDefend, MoveFortify, MoveFortifyPass)
+LOG_RECORDS = LOG_MOVES + (RecordAttack, RecordStartTurn, RecordPlayerEliminated)
+LOG_CAUSES = (None, "turn_started", "player_eliminated")
+LOG_CARD_SLOTS = 16
+
+
+class LogFrame():
+    """One query from a game log: what we were asked, what the board looked like and what we
+    answered. The cards and per-territory columns are views into the log rather than copies."""
+
+    def __init__(self, fields: tuple, cards: memoryview, redeemed: memoryview, troops: memoryview, vector: memoryview, owner: memoryview):
+        (self.number, self.records, query_kind, cause, self.me, self.players, self.troops_remaining, self.card_sets_redeemed,
+         self.must_place, self.attack_source, self.attack_target, self.attack_troops, move_kind, self.a, self.b, self.c) = fields
+        self.query_type = LOG_QUERIES[query_kind]
+        self.cause = LOG_CAUSES[cause]
+        self.move_type = LOG_MOVES[move_kind]
+
+        # Our cards as (card id, territory or -1, symbol) triples, the symbol being its position in
+        # CARD_SYMBOLS, and -1 past the last one.
+        self.cards = cards
+
+        # The card ids we redeemed, in threes (`a` is the number of sets), and -1 past the last one.
+        self.redeemed = redeemed
+        self.troops = troops
+
+        # Troops distributed to each territory.
+        self.vector = vector
+
+        # Each territory's occupier, or -1 for nobody.
+        self.owner = owner
+
+
+class GameLog():
+    """An append-only log of every query we answered in a game, and of the records that came before
+    each. The file is a header (magic, map fingerprint, territories, length of the map's JSON), then
+    the map as JSON so the game can be replayed without the engine, padded to 8 bytes, then per query
+    the records that arrived since the query before it, and a fixed-width frame:
+
+        records     uint64 count of words, then the records as int32 words (see `encode_record`),
+                    padded to 8 bytes
+        FRAME       query number, records so far, query, cause, me, players, troops to place,
+                    card sets redeemed, matching territory bonus (or -1), the attack the query is
+                    about (source, target, attacking troops, or -1), move, move fields a, b, c
+        cards       LOG_CARD_SLOTS triples of int32 (see `LogFrame.cards`)
+        redeemed    LOG_CARD_SLOTS int32 (see `LogFrame.redeemed`)
+        troops      int32 per territory
+        vector      int16 per territory (see `LogFrame.vector`)
+        owner       int8 per territory
+
+    all little-endian. Frames are written as we answer, so a log whose last frame was cut short
+    (because the bot was stopped) is read up to the frame before. Reading memory-maps the file and
+    finds where each frame starts, and the columns of a frame are memoryviews into it."""
+
+    MAGIC = b"RISKLG03"
+    HEADER = struct.Struct("<8sQII")
+    RECORDS = struct.Struct("<Q")
+    FRAME = struct.Struct("<IIBBBBiHhhhhBxiii")
+
+    def __init__(self, data: mmap.mmap, fingerprint: int, territories: int, layout: dict, start: int):
+        self._data = data
+        self._view = memoryview(data)
+        self.fingerprint = fingerprint
+        self.territories = territories
+        self.layout = layout
+        self.frame_size = self.frame_size_for(territories)
+
+        # Where each frame, and the records before it, start.
+        self._records = array("q")
+        self._frames = array("q")
+        offset = start
+        while offset + self.RECORDS.size <= len(data):
+            words, = self.RECORDS.unpack_from(data, offset)
+            frame = offset + self.RECORDS.size + 4 * words
+            frame += -frame % 8
+            if frame + self.frame_size > len(data):
+                break
+            self._records.append(offset)
+            self._frames.append(frame)
+            offset = frame + self.frame_size
+
+    @staticmethod
+    def frame_size_for(territories: int) -> int:
+        size = GameLog.FRAME.size + 16 * LOG_CARD_SLOTS + 7 * territories
+        return size + -size % 8
+
+    @staticmethod
+    def map_layout(game_map, map_index: MapIndex) -> dict:
+        """Everything replay.py needs to rebuild the map, as JSON."""
+        return {
+            "adjacency": {t: list(map_index.adjacent[t]) for t in map_index.territories},
+            "names": {t: game_map.get_vertex_name(t) for t in map_index.territories},
+            "continents": {c: list(members) for c, members in map_index.continent_lists.items()},
+            "continent_bonuses": dict(map_index.continent_bonus),
+        }
+
+    @classmethod
+    def open(cls, path: str) -> "GameLog":
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fingerprint, territories, layout_size = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError(f"{path} is not a game log")
+        layout = json.loads(bytes(data[cls.HEADER.size:cls.HEADER.size + layout_size]))
+        start = cls.HEADER.size + layout_size
+        return cls(data, fingerprint, territories, layout, start + -start % 8)
+
+    def close(self) -> None:
+        self._view.release()
+        self._data.close()
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def __getitem__(self, i: int) -> LogFrame:
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        n = self.territories
+        offset = self._frames[i]
+        fields = self.FRAME.unpack_from(self._data, offset)
+        cards = offset + self.FRAME.size
+        redeemed = cards + 12 * LOG_CARD_SLOTS
+        troops = redeemed + 4 * LOG_CARD_SLOTS
+        vector = troops + 4 * n
+        owner = vector + 2 * n
+        view = self._view
+        return LogFrame(
+            fields, view[cards:redeemed].cast("i"), view[redeemed:troops].cast("i"), view[troops:vector].cast("i"),
+            view[vector:owner].cast("h"), view[owner:owner + n].cast("b"),
+        )
+
+    def __iter__(self) -> Iterator[LogFrame]:
+        return (self[i] for i in range(len(self)))
+
+    def records(self, i: int) -> list:
+        """The records that arrived between the query before frame i and frame i's query, rebuilt.
+        Records we don't read come back as None, so the indices in the recording still line up."""
+        offset = self._records[i]
+        words, = self.RECORDS.unpack_from(self._data, offset)
+        start = offset + self.RECORDS.size
+        return self.decode_records(self._view[start:start + 4 * words].cast("i"))
+
+    @staticmethod
+    def encode_record(record: Any, words: list[int]) -> None:
+        """Append the record to `words`: its kind (its position in LOG_RECORDS, or -1 for a record we
+        don't read) and then its fields, with sets of cards and distributions of troops as a count
+        followed by the card ids in threes or the (territory, troops) pairs."""
+        kind = LOG_RECORDS.index(type(record)) if type(record) in LOG_RECORDS else -1
+        words.append(kind)
+        match record:
+            case MoveClaimTerritory() | MovePlaceInitialTroop():
+                words += (record.move_by_player, record.territory)
+            case MoveRedeemCards():
+                words += (record.move_by_player, LOG_CAUSES.index(record.cause) if record.cause in LOG_CAUSES else 0, len(record.sets))
+                words += (card_id for card_set in record.sets for card_id in card_set)
+            case MoveDistributeTroops():
+                words += (record.move_by_player, LOG_CAUSES.index(record.cause) if record.cause in LOG_CAUSES else 0, len(record.distributions))
+                words += (x for territory, troops in record.distributions.items() for x in (territory, troops))
+            case MoveAttack():
+                words += (record.move_by_player, record.attacking_territory, record.defending_territory, record.attacking_troops)
+            case MoveAttackPass() | MoveFortifyPass():
+                words.append(record.move_by_player)
+            case MoveTroopsAfterAttack():
+                words += (record.move_by_player, record.record_attack_id, record.troop_count)
+            case MoveDefend():
+                words += (record.move_by_player, record.move_attack_id, record.defending_troops)
+            case MoveFortify():
+                words += (record.move_by_player, record.source_territory, record.target_territory, record.troop_count)
+            case RecordAttack():
+                words += (record.move_attack_id, record.attacking_lost, record.defending_lost, record.territory_conquered, record.defender_eliminated)
+            case RecordStartTurn():
+                troops_gained = getattr(record, "troops_gained", None)
+                words += (record.player, -1 if troops_gained is None else troops_gained)
+            case RecordPlayerEliminated():
+                words += (record.player, record.record_attack_id, record.cards_surrendered_count)
+
+    @staticmethod
+    def decode_records(words: Sequence[int]) -> list:
+        """The records `encode_record` wrote into `words`."""
+        records: list = []
+        i = 0
+        while i < len(words):
+            kind = words[i]
+            record_type = LOG_RECORDS[kind] if kind >= 0 else None
+            i += 1
+            if record_type is None:
+                records.append(None)
+            elif record_type in (MoveClaimTerritory, MovePlaceInitialTroop):
+                records.append(record_type(move_by_player=words[i], territory=words[i + 1]))
+                i += 2
+            elif record_type is MoveRedeemCards:
+                player, cause, count = words[i:i + 3]
+                sets = [tuple(words[j:j + 3]) for j in range(i + 3, i + 3 + 3 * count, 3)]
+                records.append(MoveRedeemCards(move_by_player=player, sets=sets, cause=LOG_CAUSES[cause]))
+                i += 3 + 3 * count
+            elif record_type is MoveDistributeTroops:
+                player, cause, count = words[i:i + 3]
+                distributions = {words[j]: words[j + 1] for j in range(i + 3, i + 3 + 2 * count, 2)}
+                records.append(MoveDistributeTroops(move_by_player=player, distributions=distributions, cause=LOG_CAUSES[cause]))
+                i += 3 + 2 * count
+            elif record_type is MoveAttack:
+                records.append(MoveAttack(move_by_player=words[i], attacking_territory=words[i + 1], defending_territory=words[i + 2], attacking_troops=words[i + 3]))
+                i += 4
+            elif record_type in (MoveAttackPass, MoveFortifyPass):
+                records.append(record_type(move_by_player=words[i]))
+                i += 1
+            elif record_type is MoveTroopsAfterAttack:
+                records.append(MoveTroopsAfterAttack(move_by_player=words[i], record_attack_id=words[i + 1], troop_count=words[i + 2]))
+                i += 3
+            elif record_type is MoveDefend:
+                records.append(MoveDefend(move_by_player=words[i], move_attack_id=words[i + 1], defending_troops=words[i + 2]))
+                i += 3
+            elif record_type is MoveFortify:
+                records.append(MoveFortify(move_by_player=words[i], source_territory=words[i + 1], target_territory=words[i + 2], troop_count=words[i + 3]))
+                i += 4
+            elif record_type is RecordAttack:
+                records.append(RecordAttack(move_attack_id=words[i], attacking_lost=words[i + 1], defending_lost=words[i + 2], territory_conquered=bool(words[i + 3]), defender_eliminated=bool(words[i + 4])))
+                i += 5
+            elif record_type is RecordStartTurn:
+                records.append(RecordStartTurn(player=words[i], troops_gained=words[i + 1]) if words[i + 1] >= 0 else RecordStartTurn(player=words[i]))
+                i += 2
+            elif record_type is RecordPlayerEliminated:
+                records.append(RecordPlayerEliminated(player=words[i], record_attack_id=words[i + 1], cards_surrendered_count=words[i + 2]))
+                i += 3
+        return records
+
+    @staticmethod
+    def encode_move(move: MoveType, vector: array, redeemed: array) -> tuple[int, int, int, int]:
+        """The move's kind and fields a, b and c, filling in its per-territory vector and the card ids
+        it redeems (as many as `redeemed` has room for)."""
+        a = b = c = -1
+        match move:
+            case MoveClaimTerritory() | MovePlaceInitialTroop():
+                a = move.territory
+            case MoveRedeemCards():
+                a = len(move.sets)
+                card_ids = [card_id for card_set in move.sets for card_id in card_set]
+                for i, card_id in enumerate(card_ids[:len(redeemed)]):
+                    redeemed[i] = card_id
+            case MoveDistributeTroops():
+                for territory, troops in move.distributions.items():
+                    vector[territory] = troops
+            case MoveAttack():
+                a, b, c = move.attacking_territory, move.defending_territory, move.attacking_troops
+            case MoveTroopsAfterAttack():
+                a = move.troop_count
+            case MoveDefend():
+                a = move.defending_troops
+            case MoveFortify():
+                a, b, c = move.source_territory, move.target_territory, move.troop_count
+        return LOG_MOVES.index(type(move)), a, b, c
+
+
+class GameRecorder():
+    """Writes a `GameLog` as we play."""
+
+    def __init__(self, path: str, game: Game, map_index: MapIndex):
+        self._file = open(path, "wb")
+        self._territories = len(map_index.adjacent)
+        layout = json.dumps(GameLog.map_layout(game.state.map, map_index)).encode()
+        self._file.write(GameLog.HEADER.pack(GameLog.MAGIC, map_index.fingerprint, self._territories, len(layout)))
+        self._file.write(layout + bytes(-(GameLog.HEADER.size + len(layout)) % 8))
+
+        n = self._territories
+        self._frame = bytearray(GameLog.frame_size_for(n))
+        self._cards = struct.Struct(f"<{4 * LOG_CARD_SLOTS}i")
+        self._columns = struct.Struct(f"<{n}i{n}h{n}b")
+        self.frames = 0
+        self._recorded = 0
+
+    def write(self, game: Game, bot_state: "BotState", query: QueryType, move: MoveType) -> None:
+        """Log the records since the last query, then the query, the board as we saw it, and our move."""
+        me = game.state.me
+        ownership = bot_state.ownership
+        frame = self._frame
+
+        recording = game.state.recording
+        words: list[int] = []
+        for index in range(self._recorded, len(recording)):
+            GameLog.encode_record(recording[index], words)
+        self._recorded = len(recording)
+        block = struct.pack(f"<Q{len(words)}i", len(words), *words)
+        self._file.write(block + bytes(-len(block) % 8))
+
+        # The attack a defend or troops after attack query is about.
+        attack = None
+        if isinstance(query, QueryDefend):
+            attack = attack_move(game, bot_state, query.move_attack_id)
+        elif isinstance(query, QueryTroopsAfterAttack):
+            attack = attack_move_for(game, bot_state, query.record_attack_id)
+        source, target, attacking_troops = (attack.attacking_territory, attack.defending_territory, attack.attacking_troops) if attack is not None else (-1, -1, -1)
+
+        vector = array("h", [0]) * self._territories
+        redeemed = array("i", [-1]) * LOG_CARD_SLOTS
+        move_kind, a, b, c = GameLog.encode_move(move, vector, redeemed)
+        GameLog.FRAME.pack_into(
+            frame, 0, self.frames, len(game.state.recording), LOG_QUERIES.index(type(query)), LOG_CAUSES.index(getattr(query, "cause", None)),
+            me.player_id, len(game.state.players), me.troops_remaining, game.state.card_sets_redeemed,
+            me.must_place_territory_bonus[0] if me.must_place_territory_bonus else -1, source, target, attacking_troops, move_kind, a, b, c,
+        )
+
+        cards = [-1] * (3 * LOG_CARD_SLOTS)
+        for i, card in enumerate(me.cards[:LOG_CARD_SLOTS]):
+            cards[3 * i] = card.card_id
+            cards[3 * i + 1] = card.territory_id if card.territory_id is not None else -1
+            cards[3 * i + 2] = CARD_SYMBOLS.index(card.symbol)
+        self._cards.pack_into(frame, GameLog.FRAME.size, *cards, *redeemed)
+        owner = [-1 if occupier is None else occupier for occupier in ownership.owner]
+        self._columns.pack_into(frame, GameLog.FRAME.size + self._cards.size, *ownership.troops, *vector, *owner)
+
+        self._file.write(frame)
+        self.frames += 1
+
+    def close(self) -> None:
+        self._file.close()
+
+
+# If a handler takes longer than this we abandon it and answer with a cheap move that is always
+# legal, so we never miss the engine's deadline. At the end of the game we write our query stats here,
+# if we are asked to.
+SOFT_DEADLINE_SECONDS = 0.5
+STATS_PATH = os.environ.get("BOT_STATS_PATH", "")
+
+# The upper edges of the latency histogram buckets, doubling from 10us to about 2.6s.
+LATENCY_BUCKETS = [10e-6 * 2 ** i for i in range(19)]
+
+
+class QueryStats():
+    """Per query type latency histograms, and counters for records consumed and watchdog fallbacks,
+    all in a fixed amount of memory however long the game runs."""
 
-                case QueryAttack() as q:
-                    return handle_attack(game, bot_state, q)
+    def __init__(self):
+        self.histograms: defaultdict[str, list[int]] = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self.max_latency: defaultdict[str, float] = defaultdict(float)
+        self.total_latency: defaultdict[str, float] = defaultdict(float)
+        self.fallbacks: defaultdict[str, int] = defaultdict(int)
+        self.records_consumed = 0
+        self.record_errors = 0
+        self.queries = 0
+        self.caches: dict[str, LRUCache] = {}
+        self.battles: Optional[BattleHistory] = None
+        self.rollouts = 0
+        self.search_seconds = 0.0
+        self.speculated: defaultdict[str, int] = defaultdict(int)
+        self.speculation_seconds = 0.0
+        self.replans = 0
+
+        # Our start-up, not counting time spent waiting for the engine: loading this module (only
+        # known when we are run as the bot), setting up our state, and answering the first query.
+        self.import_seconds = 0.0
+        self.setup_seconds = 0.0
+        self.first_query_seconds: Optional[float] = None
+
+    def record(self, query_type: str, seconds: float) -> None:
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        self.histograms[query_type][bucket] += 1
+        if self.first_query_seconds is None:
+            self.first_query_seconds = seconds
+        self.max_latency[query_type] = max(self.max_latency[query_type], seconds)
+        self.total_latency[query_type] += seconds
+        self.queries += 1
+
+    def percentile(self, query_type: str, fraction: float) -> float:
+        """An upper bound on the given latency percentile, from the histogram."""
+        histogram = self.histograms[query_type]
+        target = fraction * sum(histogram)
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if count and seen >= target:
+                return min(LATENCY_BUCKETS[bucket], self.max_latency[query_type]) if bucket < len(LATENCY_BUCKETS) else self.max_latency[query_type]
+        return 0.0
+
+    def summary(self) -> dict:
+        return {
+            "queries": self.queries,
+            "records_consumed": self.records_consumed,
+            "record_errors": self.record_errors,
+            "caches": {name: cache.summary() for name, cache in sorted(self.caches.items())},
+            "search": {
+                "rollouts": self.rollouts,
+                "seconds": self.search_seconds,
+                "rollouts_per_second": self.rollouts / self.search_seconds if self.search_seconds else 0.0,
+            },
+            "speculation": {"units": dict(sorted(self.speculated.items())), "seconds": self.speculation_seconds},
+            "replans": self.replans,
+            "battles": self.battles.summary() if self.battles is not None else {},
+            "startup": {
+                "import_seconds": self.import_seconds,
+                "setup_seconds": self.setup_seconds,
+                "first_query_seconds": self.first_query_seconds or 0.0,
+                "first_move_seconds": self.import_seconds + self.setup_seconds + (self.first_query_seconds or 0.0),
+                "battle_tables_loaded": battle_odds.loaded,
+            },
+            "handlers": {
+                query_type: {
+                    "count": sum(histogram),
+                    "mean": self.total_latency[query_type] / max(1, sum(histogram)),
+                    "p50": self.percentile(query_type, 0.5),
+                    "p99": self.percentile(query_type, 0.99),
+                    "max": self.max_latency[query_type],
+                    "fallbacks": self.fallbacks[query_type],
+                    "histogram": histogram,
+                }
+                for query_type, histogram in sorted(self.histograms.items())
+            },
+        }
+
+    def dump(self, path: Optional[str]) -> None:
+        if not path:
+            return
+        try:
+            with open(path, "w") as f:
+                json.dump({"buckets": LATENCY_BUCKETS, **self.summary()}, f, separators=(",", ":"))
+        except OSError:
+            pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Watchdog():
+    """Interrupts the handler with `DeadlineExceeded` once the soft deadline passes. It uses a real
+    time interval timer, so it only works in the main thread of platforms that have SIGALRM, and
+    does nothing elsewhere."""
 
-                case QueryTroopsAfterAttack() as q:
-                    return handle_troops_after_attack(game, bot_state, q)
+    def __init__(self):
+        self._armed = False
+
+    def _available(self) -> bool:
+        return hasattr(signal, "setitimer") and hasattr(signal, "SIGALRM")
+
+    def _on_alarm(self, signum, frame) -> None:
+        if self._armed:
+            self._armed = False
+            raise DeadlineExceeded()
+
+    def arm(self, seconds: float) -> None:
+        if not self._available():
+            return
+        try:
+            # We install our handler every time, in case something else in the process (like another
+            # copy of the bot in a local tournament) has replaced it.
+            signal.signal(signal.SIGALRM, self._on_alarm)
+            self._armed = True
+            signal.setitimer(signal.ITIMER_REAL, max(seconds, 1e-3))
+        except ValueError:
+            # We are not in the main thread.
+            self._armed = False
+
+    def disarm(self) -> None:
+        # We clear the flag first, so an alarm that fires while we are disarming is ignored.
+        if self._armed:
+            self._armed = False
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+watchdog = Watchdog()
+
+
+# Telemetry levels. An event is kept when its level is at most TELEMETRY_LEVEL, so the default of
+# TELEMETRY_OFF keeps nothing. Kept events are written as JSON lines to TELEMETRY_PATH.
+TELEMETRY_OFF = 0
+TELEMETRY_INFO = 1
+TELEMETRY_DEBUG = 2
+TELEMETRY_LEVEL = int(os.environ.get("BOT_TELEMETRY_LEVEL", str(TELEMETRY_OFF)))
+TELEMETRY_PATH = os.environ.get("BOT_TELEMETRY_PATH", "bot_telemetry.jsonl")
+TELEMETRY_LEVEL_NAMES = ("off", "info", "debug")
+
+# How many events we hold between flushes (beyond that the oldest are dropped), and how often the
+# flush thread writes them out.
+TELEMETRY_EVENTS = 4096
+TELEMETRY_FLUSH_SECONDS = 0.5
+
+
+class Telemetry():
+    """Structured events for looking into what the bot did, which cost one comparison when their
+    level is off. Callers check `level` before building an event, so nothing about it is worked out
+    unless it will be kept:
+
+        if telemetry.level >= TELEMETRY_DEBUG:
+            telemetry.emit(TELEMETRY_DEBUG, "late_game_target", my_territories=mine, target_territory=target)
+
+    Events go into a ring of preallocated slots, and a background thread started by `start` writes
+    them out in batches. Fields ending in "_territory" (an id) and "_territories" (a bitmask) are
+    only turned into territory names when they are written, never in the handler."""
+
+    def __init__(self, level: int, path: str, size: int = TELEMETRY_EVENTS):
+        self.level = level if path else TELEMETRY_OFF
+        self.path = path
+        self._slots: list[Optional[tuple[float, int, str, dict]]] = [None] * size
+        self._written = 0
+        self._flushed = 0
+        self.dropped = 0
+        self._name: Callable[[int], str] = str
+        self._wake = threading.Event()
+        self._stop = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, game_map) -> None:
+        """Start writing events out, naming territories from the map."""
+        if self.level == TELEMETRY_OFF or self._thread is not None:
+            return
+        self._name = game_map.get_vertex_name
+        self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self._thread.start()
+
+    def emit(self, level: int, event: str, **fields: Any) -> None:
+        if level > self.level:
+            return
+        slots = self._slots
+        slots[self._written % len(slots)] = (time.time(), level, event, fields)
+        self._written += 1
+
+    def close(self) -> None:
+        """Write out whatever is left, and stop the flush thread."""
+        if self._thread is None:
+            return
+        self._stop = True
+        self._wake.set()
+        self._thread.join(timeout=1.0)
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop:
+            self._wake.wait(TELEMETRY_FLUSH_SECONDS)
+            self._flush()
+        self._flush()
+
+    def _flush(self) -> None:
+        slots = self._slots
+        written = self._written
+        start = max(self._flushed, written - len(slots))
+        dropped = start - self._flushed
+        batch = [slots[i % len(slots)] for i in range(start, written)]
+
+        # The handler may have lapped us while we were copying, in which case the oldest of the
+        # events we copied were overwritten.
+        overwritten = max(0, self._written - len(slots) - start)
+        batch = batch[overwritten:]
+        dropped += overwritten
+        self._flushed = written
+        self.dropped += dropped
+
+        lines = []
+        if dropped:
+            lines.append(json.dumps({"time": time.time(), "level": "info", "event": "telemetry_dropped", "count": dropped}))
+        for event in batch:
+            if event is not None:
+                lines.append(self._format(*event))
+        if not lines:
+            return
+        try:
+            with open(self.path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError:
+            pass
+
+    def _format(self, moment: float, level: int, event: str, fields: dict) -> str:
+        record: dict[str, Any] = {"time": moment, "level": TELEMETRY_LEVEL_NAMES[level], "event": event}
+        for key, value in fields.items():
+            if key.endswith("_territories"):
+                value = [self._name(t) for t in bits(value)]
+            elif key.endswith("_territory") and value is not None and value >= 0:
+                value = self._name(value)
+            record[key] = value
+        return json.dumps(record, default=str)
+
+
+telemetry = Telemetry(TELEMETRY_LEVEL, TELEMETRY_PATH)
+
+
+SPECULATE = os.environ.get("BOT_SPECULATE", "1") == "1"
+
+
+class SpeculationCancelled(Exception):
+    pass
+
+
+class Speculator():
+    """Does work we will probably need for the next query in a background thread, while the main
+    thread is blocked waiting for the engine to send it. The work is a list of small units, each of
+    which works on a `SpeculativeState` copy of the bot state and leaves its results in the bot's
+    memo. Those are keyed by the board hash, so anything worked out for a board that has since
+    changed is just never found, and ages out of the memo.
+
+    `pause` sets `cancelled`, which the units check between steps (and the attack search between
+    rollouts), and waits for the unit in progress to give up, so the main thread only waits a moment
+    before it has the CPU to itself."""
+
+    def __init__(self, bot_state: "BotState"):
+        self.bot_state = bot_state
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._work: deque[tuple[str, Callable[[], Any]]] = deque()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="speculator", daemon=True)
+        self._thread.start()
+
+    def resume(self, work: list[tuple[str, Callable[[], Any]]]) -> None:
+        """Start on the given (kind, unit) work, in order."""
+        with self._lock:
+            self.cancelled.clear()
+            self._work = deque(work)
+            self._wake.set()
+
+    def pause(self) -> None:
+        """Stop speculating, interrupting the unit in progress."""
+        self.cancelled.set()
+        with self._lock:
+            self._work.clear()
+
+    def _run(self) -> None:
+        memo = self.bot_state.memo
+        stats = self.bot_state.stats
+        memo.speculator = threading.get_ident()
+        while True:
+            self._wake.wait()
+            with self._lock:
+                if not self._work or self.cancelled.is_set():
+                    self._work.clear()
+                    self._wake.clear()
+                    continue
+                kind, unit = self._work.popleft()
+                start = time.perf_counter()
+                try:
+                    unit()
+                    stats.speculated[kind] += 1
+
+                # A guess that goes wrong (or is cut short) costs us nothing but the guess.
+                except Exception:
+                    pass
+                finally:
+                    stats.speculation_seconds += time.perf_counter() - start
+
+
+# We will store our enemy, the static map index, the ownership index (and the distance fields that
+# follow it) and our query stats in the bot state.
+class BotState():
+    def __init__(self, map_index: MapIndex):
+        self.enemy: Optional[int] = None
+        self.map_index = map_index
+        self.ownership = OwnershipIndex(map_index)
+        self.attacks = AttackTracker()
+
+        # Every record goes through the dispatcher once. The attack tracker has to see an attack
+        # before the ownership index can place its result.
+        self.dispatcher = RecordDispatcher()
+        self.attacks.subscribe(self.dispatcher)
+        self.ownership.subscribe(self.dispatcher, self.attacks)
+        self.opponents = OpponentModel(map_index)
+        self.opponents.subscribe(self.dispatcher)
+        self.battles = BattleHistory(map_index)
+        self.battles.subscribe(self.dispatcher)
+        self.stats = QueryStats()
+        self.stats.battles = self.battles
+        self.dispatcher.subscribe(MoveDistributeTroops, self._on_move_distribute_troops)
+
+        # Decisions and evaluations we have already worked out, keyed by the board hash.
+        self.memo = LRUCache(MEMO_SIZE)
+        self.stats.caches["memo"] = self.memo
+
+        self.distances = PlayerDistances(map_index, self.ownership)
+        self.evaluator = BoardEvaluator(map_index, self.ownership, self.opponents, self.memo)
+        self.components = OwnedComponents(map_index, self.ownership)
+        self.redemptions = RedemptionPlanner()
+
+        # The plan for the turn we are in the middle of.
+        self.plan: Optional[TurnPlan] = None
+
+        # Set on a speculative copy of the bot state, to stop it when the next query arrives.
+        self.cancelled: Optional[threading.Event] = None
+
+        self.book = OpeningBook.load(OPENING_BOOK_PATH, map_index.fingerprint)
+
+    def _on_move_distribute_troops(self, index: int, record: MoveDistributeTroops) -> None:
+        # If the troops we distributed aren't where the plan has them (because the watchdog answered
+        # for us before the plan was made, say), its attacks were worked out for a different board.
+        if record.move_by_player == self.ownership.me and self.plan is not None and not self.plan.placed(record.distributions):
+            self.plan = None
+            self.stats.replans += 1
+
+
+class SpeculativeState(BotState):
+    """What a speculative unit works on: copies of the indexes it reads (which the main thread
+    carries on updating), our enemy and a board evaluator of its own (which it changes), and the
+    bot's memo and stats. It doesn't follow the game."""
+
+    def __init__(self, bot_state: BotState, cancelled: threading.Event):
+        self.enemy = bot_state.enemy
+        self.map_index = bot_state.map_index
+        self.ownership = bot_state.ownership.snapshot()
+        self.opponents = bot_state.opponents.snapshot()
+        self.stats = bot_state.stats
+        self.memo = bot_state.memo
+        self.evaluator = BoardEvaluator(self.map_index, self.ownership, self.opponents, self.memo)
+        self.cancelled = cancelled
+
+    def check(self) -> None:
+        """Give up if the speculator has been paused."""
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise SpeculationCancelled()
+
+
+def create_bot_state(game: Game) -> BotState:
+    """Set up our state for a new game, once the game object knows the map."""
+    start = time.perf_counter()
+    bot_state = BotState(MapIndex(game.state.map, *map_continents(game.state.map)))
+    bot_state.stats.setup_seconds = time.perf_counter() - start
+    return bot_state
 
-                case QueryDefend() as q:
-                    return handle_defend(game, bot_state, q)
 
-                case QueryFortify() as q:
-                    return handle_fortify(game, bot_state, q)
-        
-        # Send the move to the engine.
-        game.send_move(choose_move(query))
+def main():
+    
+    # Get the game object, which will connect you to the engine and
+    # track the state of the game.
+    imported = time.perf_counter()
+    game = Game()
+    bot_state = create_bot_state(game)
+    bot_state.stats.import_seconds = imported - STARTED
+
+    # Start the attack search's worker processes once, if we are using any.
+    global search_pool, search_workers
+    if SEARCH_WORKERS > 0 and SEARCH_BUDGET_SECONDS > 0:
+        from concurrent.futures import ProcessPoolExecutor
+        search_pool = ProcessPoolExecutor(SEARCH_WORKERS)
+        search_workers = SEARCH_WORKERS
+   
+    # We will write out telemetry (if it is turned on) in the background.
+    telemetry.start(game.state.map)
+
+    # We will put the time we spend waiting for the engine to use.
+    speculator = Speculator(bot_state) if SPECULATE else None
+    recorder = GameRecorder(RECORD_PATH, game, bot_state.map_index) if RECORD_PATH else None
+    move = None
+
+    # Respond to the engine's queries with your moves, and write out our query stats when the
+    # game is over.
+    try:
+        while True:
+            if speculator is not None:
+                speculator.resume(speculative_work(game, bot_state, move, speculator.cancelled))
+
+            # Get the engine's query (this will block until you receive a query). The query's clock
+            # starts now, so stopping the speculator counts against it.
+            query = game.get_next_query()
+            arrived = time.perf_counter()
+            if speculator is not None:
+                speculator.pause()
+
+            # Send the move to the engine.
+            move = choose_move(game, bot_state, query, arrived)
+            if recorder is not None:
+                recorder.write(game, bot_state, query, move)
+            game.send_move(move)
+    finally:
+        bot_state.stats.dump(STATS_PATH)
+        telemetry.close()
+
+        # The game is over, so we have time to work out the full battle tables for the next one.
+        if BATTLE_TABLES_PATH and not battle_odds.loaded:
+            battle_odds.write(BATTLE_TABLES_PATH)
+        if recorder is not None:
+            recorder.close()
+        if search_pool is not None:
+            search_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def choose_move(game: Game, bot_state: BotState, query: QueryType, arrived: Optional[float] = None) -> MoveType:
+    """Bring our indexes up to date with the records that came with the query, then respond
+    with the correct move for the type of query, falling back to a safe move if the handler
+    overruns its budget. The handler's budget (and the time we record) runs from when the query
+    `arrived`, if we were doing anything else before getting here. The offline tools drive the bot
+    through here too."""
+    start = time.perf_counter() if arrived is None else arrived
+    query_type = type(query).__name__
+
+    # The alarm can go off at any point after we arm the watchdog (even while we disarm it), so both
+    # have to be inside the try. Once it has gone off, the watchdog is disarmed. Catching up with
+    # the records is inside too, since after a long wait there can be a lot of them.
+    updated = False
+    try:
+        watchdog.arm(SOFT_DEADLINE_SECONDS - (time.perf_counter() - start))
+        update_indexes(game, bot_state)
+        updated = True
+        move = handle_query(game, bot_state, query)
+        watchdog.disarm()
+    except DeadlineExceeded:
+        move = None
+    except BaseException:
+        watchdog.disarm()
+        raise
+
+    if move is None:
+        bot_state.stats.fallbacks[query_type] += 1
+        if telemetry.level >= TELEMETRY_INFO:
+            telemetry.emit(TELEMETRY_INFO, "watchdog_fallback", query=query_type, records=len(game.state.recording))
+
+        # If we ran out of time catching up, the rest of the records are delivered at the next query,
+        # and the safe move reads ownership straight from the game state.
+        if not updated:
+            bot_state.ownership.invalidate()
+            bot_state.ownership.update(game)
+        move = handle_query_safely(game, bot_state, query)
+
+    bot_state.stats.records_consumed = bot_state.dispatcher.cursor
+    bot_state.stats.record_errors = bot_state.dispatcher.errors
+    bot_state.stats.record(query_type, time.perf_counter() - start)
+    return move
+
+
+def update_indexes(game: Game, bot_state: BotState) -> None:
+    """Bring our indexes up to date with the records that came with the query. If a record didn't
+    reach all of its subscribers, ownership is rebuilt from the game state."""
+    dispatcher = bot_state.dispatcher
+    dispatcher.dispatch(game)
+    if dispatcher.dropped:
+        bot_state.ownership.invalidate()
+        dispatcher.dropped = False
+    bot_state.ownership.update(game)
+    bot_state.opponents.me = bot_state.ownership.me
+    bot_state.opponents.mine = bot_state.ownership.masks[bot_state.ownership.me]
+    bot_state.distances.update()
+    bot_state.components.update()
+
+
+def attack_move(game: Game, bot_state: BotState, move_attack_id: int) -> MoveAttack:
+    """The attack move with this record id. The attack tracker only keeps the latest attacks, and
+    misses some if we ran out of time catching up, so otherwise we look in the recording."""
+    move_attack = bot_state.attacks.move_attack(move_attack_id)
+    if move_attack is None:
+        move_attack = cast(MoveAttack, game.state.recording[move_attack_id])
+    return move_attack
+
+
+def attack_move_for(game: Game, bot_state: BotState, record_attack_id: int) -> MoveAttack:
+    """The attack move that the attack result with this record id is the result of (see `attack_move`)."""
+    move_attack = bot_state.attacks.move_attack_for(record_attack_id)
+    if move_attack is None:
+        record_attack = cast(RecordAttack, game.state.recording[record_attack_id])
+        move_attack = attack_move(game, bot_state, record_attack.move_attack_id)
+    return move_attack
+
+
+def handle_query(game: Game, bot_state: BotState, query: QueryType) -> MoveType:
+    """Based on the type of query, respond with the correct move."""
+    match query:
+        case QueryClaimTerritory() as q:
+            return handle_claim_territory(game, bot_state, q)
+
+        case QueryPlaceInitialTroop() as q:
+            return handle_place_initial_troop(game, bot_state, q)
+
+        case QueryRedeemCards() as q:
+            return handle_redeem_cards(game, bot_state, q)
+
+        case QueryDistributeTroops() as q:
+            return handle_distribute_troops(game, bot_state, q)
+
+        case QueryAttack() as q:
+            return handle_attack(game, bot_state, q)
+
+        case QueryTroopsAfterAttack() as q:
+            return handle_troops_after_attack(game, bot_state, q)
+
+        case QueryDefend() as q:
+            return handle_defend(game, bot_state, q)
+
+        case QueryFortify() as q:
+            return handle_fortify(game, bot_state, q)
+
+    raise ValueError(f"Unexpected query {query!r}.")
+
+
+def handle_query_safely(game: Game, bot_state: BotState, query: QueryType) -> MoveType:
+    """A cheap move that is always legal, for when a handler has run out of time."""
+    ownership = bot_state.ownership
+    mine = ownership.masks[game.state.me.player_id]
+    match query:
+        case QueryClaimTerritory() as q:
+            return game.move_claim_territory(q, lowest(ownership.masks[None]))
+
+        case QueryPlaceInitialTroop() as q:
+            return game.move_place_initial_troop(q, lowest(mine))
+
+        case QueryRedeemCards() as q:
+            card_sets: list[Tuple[CardModel, CardModel, CardModel]] = []
+            cards_remaining = game.state.me.cards.copy()
+            while len(cards_remaining) >= 5:
+                card_set = game.state.get_card_set(cards_remaining)
+                assert card_set != None
+                card_sets.append(card_set)
+                cards_remaining = [card for card in cards_remaining if card not in card_set]
+            return game.move_redeem_cards(q, [(x[0].card_id, x[1].card_id, x[2].card_id) for x in card_sets])
+
+        case QueryDistributeTroops() as q:
+            distributions = defaultdict(lambda: 0)
+            total_troops = game.state.me.troops_remaining
+            if len(game.state.me.must_place_territory_bonus) != 0:
+                distributions[game.state.me.must_place_territory_bonus[0]] += 2
+                total_troops -= 2
+            distributions[lowest(ownership.border_mask or mine)] += total_troops
+            return game.move_distribute_troops(q, distributions)
+
+        case QueryAttack() as q:
+            return game.move_attack_pass(q)
+
+        case QueryTroopsAfterAttack() as q:
+            move_attack = attack_move_for(game, bot_state, q.record_attack_id)
+            return game.move_troops_after_attack(q, game.state.territories[move_attack.attacking_territory].troops - 1)
+
+        case QueryDefend() as q:
+            return game.move_defend(q, 1)
+
+        case QueryFortify() as q:
+            return game.move_fortify_pass(q)
+
+    raise ValueError(f"Unexpected query {query!r}.")
                 
 
 def handle_claim_territory(game: Game, bot_state: BotState, query: QueryClaimTerritory) -> MoveClaimTerritory:
     """At the start of the game, you can claim a single unclaimed territory every turn 
     until all the territories have been claimed by players."""
-
-    country_dictionary = {
-        "North America": list(range(9)),
-        "South America": list(range(29, 32)),
-        "Europe": list(range(9, 16)),
-        "Africa": list(range(32, 38)),
-        "Asia": list(range(16, 29)),
-        "Australia": list(range(38, 43))
-    }
-    country_joint_dictionary = {
-        "North America": [0, 2, 4],
-        "South America": [30, 29],
-        "Australia": [40],
-        "Africa": [33, 34, 36],
-        "Asia": [16, 21, 22, 24, 26],
-        "Europe": [10, 12, 13, 14, 15]
-
-    }
-    continent_list = ["North America", "South America", "Australia", "Africa" ,"Europe", "Asia"]
-
-    unclaimed_territories = game.state.get_territories_owned_by(None)
-    my_territories = game.state.get_territories_owned_by(game.state.me.player_id)
-
-    def is_continent_contested(continent: str) -> bool:
+    # We will play from the opening book while it has our position.
+    pick = book_pick(bot_state, BOOK_CLAIM, bot_state.ownership.masks[None])
+    if pick is not None:
+        return game.move_claim_territory(query, pick)
+
+    return game.move_claim_territory(query, choose_claim_territory(game, bot_state))
+
+
+def book_pick(bot_state: BotState, phase: int, legal: int) -> Optional[int]:
+    """A territory in the `legal` mask in the opening book's continent for our position, if it has
+    one there. Claims go next to as many of our territories as they can, and troops go where we have
+    the most enemy neighbours."""
+    if bot_state.book is None:
+        return None
+    map_index = bot_state.map_index
+    pick = bot_state.book.lookup(OpeningBook.key(map_index, bot_state.ownership, phase))
+    if pick is None or pick >= len(map_index.continent_names):
+        return None
+    candidates = legal & map_index.continent_mask[map_index.continent_names[pick]]
+    if not candidates:
+        return None
+    mine = bot_state.ownership.masks[bot_state.ownership.me]
+    if phase == BOOK_CLAIM:
+        return max(bits(candidates), key=lambda x: (popcount(map_index.neighbour_mask[x] & mine), -x))
+    return max(bits(candidates), key=lambda x: (popcount(map_index.neighbour_mask[x] & ~mine), -x))
+
+
+def choose_claim_territory(game: Game, bot_state: BotState) -> int:
+    """The territory we claim next."""
+
+    map_index = bot_state.map_index
+    ownership = bot_state.ownership
+
+    unclaimed = ownership.masks[None]
+    mine = ownership.masks[game.state.me.player_id]
+
+    def is_continent_contested(i: int) -> bool:
         """Check if a continent has any territory occupied by other players."""
-        continent_territories = country_dictionary[continent]
-        for territory in continent_territories:
-            if territory in game.state.territories and game.state.territories[territory].occupier not in [None, game.state.me.player_id]:
-                return True
-        return False
-
-    for continent, joint_territories in country_joint_dictionary.items():
-        if not is_continent_contested(continent):
-            available = list(set(unclaimed_territories) & set(joint_territories))
-            if available:
-                selected_territory = available[0]
-                game.move_claim_territory(query, selected_territory)
+        return ownership.continent_counts[None][i] + ownership.continent_counts[game.state.me.player_id][i] < map_index.continent_sizes[i]
+
+    for i, continent in enumerate(map_index.continent_names):
+        if not is_continent_contested(i):
+            if map_index.joint_mask[continent] & unclaimed:
 
                 # 占领关键节点后优先占领对应大洲的其他领土
-                continent_territories = country_dictionary[continent]
-                available_continent_territories = list(set(unclaimed_territories) & set(continent_territories))
+                available_continent_territories = map_index.continent_mask[continent] & unclaimed
                 if available_continent_territories:
-                    selected_territory = available_continent_territories[0]
-                    return game.move_claim_territory(query, selected_territory)
-
-    adjacent_territories = game.state.get_all_adjacent_territories(my_territories)
+                    selected_territory = lowest(available_continent_territories)
+                    return selected_territory
 
     def is_player_close_to_continent_control(player_id: int) -> bool:
-        for continent, territories in country_dictionary.items():
-            player_territories = [territory for territory in territories if territory in game.state.territories and game.state.territories[territory].occupier == player_id]
-            if len(player_territories) >= len(territories) * 0.75:  
-                return True
-        return False
+        return any(progress >= 0.75 for progress in ownership.continent_progress(player_id))
 
     for player_id in game.state.players.keys():
         if player_id != game.state.me.player_id and is_player_close_to_continent_control(player_id):
 
-            for continent in continent_list:
-                continent_territories = country_dictionary[continent]
-                available = list(set(unclaimed_territories) & set(continent_territories))
+            for continent in map_index.continent_names:
+                available = map_index.continent_mask[continent] & unclaimed
                 if available:
-                    selected_territory = available[0]
-                    return game.move_claim_territory(query, selected_territory)
+                    selected_territory = lowest(available)
+                    return selected_territory
     
-    for continent, territories in country_dictionary.items():
-        if any(territory in my_territories for territory in territories):
-            available = list(set(unclaimed_territories) & set(territories))
+    for continent in map_index.continent_names:
+        if map_index.continent_mask[continent] & mine:
+            available = map_index.continent_mask[continent] & unclaimed
             if available:
-                selected_territory = available[0]
-                return game.move_claim_territory(query, selected_territory)
+                selected_territory = lowest(available)
+                return selected_territory
 
 
-    available = list(set(unclaimed_territories) & set(adjacent_territories))
-    if len(available) != 0:
+    available = map_index.frontier(mine) & unclaimed
+    if available:
 
         def count_adjacent_friendly(x: int) -> int:
-            return len(set(my_territories) & set(game.state.map.get_adjacent_to(x)))
+            return popcount(map_index.neighbour_mask[x] & mine)
 
-        selected_territory = sorted(available, key=lambda x: count_adjacent_friendly(x), reverse=True)[0]
+        selected_territory = max(bits(available), key=lambda x: count_adjacent_friendly(x))
     else:
-        selected_territory = sorted(unclaimed_territories, key=lambda x: len(game.state.map.get_adjacent_to(x)), reverse=True)[0]
+        selected_territory = max(bits(unclaimed), key=lambda x: len(map_index.adjacent[x]))
 
-    return game.move_claim_territory(query, selected_territory)
+    return selected_territory
 
 
 def handle_place_initial_troop(game: Game, bot_state: BotState, query: QueryPlaceInitialTroop) -> MovePlaceInitialTroop:
     """After all the territories have been claimed, you can place a single troop on one
     of your territories each turn until each player runs out of troops."""
-    all_territories = game.state.get_territories_owned_by(game.state.me.player_id)
-    country_dictionary = {
-        "North America":list(range(9)),
-        "South America":list(range(29, 32)),
-        "Europe": list(range(9, 16)),
-        "Africa": list(range(32, 38)),
-        "Asia": list(range(16,29)),
-        "Australia": list(range(38,43))
-    }
-    joint_list = [0,2,4,30,29,10,12,13,14,15,33,34,36,16,21,22,24,26,40]
-    continent_list = ["North America", "South America", "Australia", "Africa" ,"Europe", "Asia"]
-    
-    # We will place troops along the territories on our border.
-    border_territories = game.state.get_all_border_territories(
-        game.state.get_territories_owned_by(game.state.me.player_id)
-    )
+    pick = book_pick(bot_state, BOOK_PLACE, bot_state.ownership.masks[game.state.me.player_id])
+    if pick is not None:
+        return game.move_place_initial_troop(query, pick)
+
+    return game.move_place_initial_troop(query, choose_initial_troop(game, bot_state))
 
-    # We will place a troop in the border territory with the biggest difference in troops comparing to 
-    # the adjacent enemy territories 
 
-    border_territory_models = [game.state.territories[x] for x in border_territories]
+def choose_initial_troop(game: Game, bot_state: BotState) -> int:
+    """The territory we place our next initial troop on."""
+    map_index = bot_state.map_index
+    ownership = bot_state.ownership
+    mine = ownership.masks[game.state.me.player_id]
     
+    # We will place troops along the territories on our border.
 
     # all joint country need at least 3 troops
-    for joint in joint_list:
-        if joint in all_territories:
-            if game.state.territories[joint].troops < 3:
-                return game.move_place_initial_troop(query, joint)
+    for joint in map_index.joint_order:
+        if mine >> joint & 1:
+            if ownership.troops[joint] < 3:
+                return joint
 
     # all boarder country need at least 2 troops
-    for border_territory in border_territory_models:
-        if border_territory.troops < 2:
-            return game.move_place_initial_troop(query, border_territory.territory_id)
-
-    # rest of the troops goes to the border of the most percentage continent
-    def calculate_continent_progress(all_territory: list[int], country_dictionary: dict[str, list[int]], continent_list: list[str]) -> list[float]:
-        territory_percentage = []
-        for continent in continent_list:
-            owned_territory = 0
-            unowned_territory = 0
-            continent_territory = country_dictionary[continent]
-            for territory in continent_territory:
-                if territory in all_territory:
-                    owned_territory += 1
-                else:
-                    unowned_territory += 1
-            percentage = owned_territory/(owned_territory + unowned_territory)
-            territory_percentage.append(percentage)
-        return territory_percentage
-
-    
-    continent_progress = calculate_continent_progress(all_territories, country_dictionary, continent_list)
-    
-    # find maximum percentage continent that is not 100%
-    max_percentage = 0
-    max_percentage_continent = ''
-    for i, percentage in enumerate(continent_progress):
-        if percentage > max_percentage and percentage != 1:
-            max_percentage = percentage
-            max_percentage_continent = continent_list[i]
-    
-    # all in one of the boarder territory, prioritise joint
-    border_territory_in_max_continent = []
-    for border_territory in border_territories:
+    for border_territory in bits(ownership.border_mask):
+        if ownership.troops[border_territory] < 2:
+            return border_territory
 
-        if border_territory in country_dictionary[max_percentage_continent]:
-            border_territory_in_max_continent.append(border_territory)
+    # rest of the troops goes to the border of the most percentage continent that is not 100%, on
+    # whichever of those territories scores best (joints score higher)
+    evaluator = bot_state.evaluator
+    evaluator.evaluate(game.state.me.player_id)
+    continent_progress = ownership.continent_progress(game.state.me.player_id)
+    incomplete = [i for i, percentage in enumerate(continent_progress) if 0 < percentage < 1]
+    if incomplete:
+        max_percentage_continent = map_index.continent_names[max(incomplete, key=continent_progress.__getitem__)]
+        candidates = ownership.border_mask & map_index.continent_mask[max_percentage_continent]
+        if candidates:
+            return evaluator.best(candidates)
 
-            if border_territory in joint_list:
-                return game.move_place_initial_troop(query, border_territory)
-    
-    return game.move_place_initial_troop(query, border_territory_in_max_continent[0])
+    return evaluator.best(ownership.border_mask)
 
 
 def handle_redeem_cards(game: Game, bot_state: BotState, query: QueryRedeemCards) -> MoveRedeemCards:
@@ -246,30 +2700,17 @@ def handle_redeem_cards(game: Game, bot_state: BotState, query: QueryRedeemCards
     cards you have at the start of each turn, or after killing another player."""
 
     # We will always redeem the minimum number of card sets we can until the 12th card set has been redeemed.
-    # This is just an arbitrary choice to try and save our cards for the late game.
+    # This is just an arbitrary choice to try and save our cards for the late game. We always have to
+    # redeem enough cards to reduce our card count below five, and we can't redeem any more than that
+    # if we have just eliminated a player.
+    redeem_all = game.state.card_sets_redeemed > 12 and query.cause == "turn_started"
+    card_sets = bot_state.redemptions.plan(game.state.me.cards, bot_state.ownership.masks[game.state.me.player_id], redeem_all)
+    return game.move_redeem_cards(query, card_sets)
 
-    # We always have to redeem enough cards to reduce our card count below five.
-    card_sets: list[Tuple[CardModel, CardModel, CardModel]] = []
-    cards_remaining = game.state.me.cards.copy()
 
-    while len(cards_remaining) >= 5:
-        card_set = game.state.get_card_set(cards_remaining)
-        # According to the pigeonhole principle, we should always be able to make a set
-        # of cards if we have at least 5 cards.
-        assert card_set != None
-        card_sets.append(card_set)
-        cards_remaining = [card for card in cards_remaining if card not in card_set]
-
-    # Remember we can't redeem any more than the required number of card sets if 
-    # we have just eliminated a player.
-    if game.state.card_sets_redeemed > 12 and query.cause == "turn_started":
-        card_set = game.state.get_card_set(cards_remaining)
-        while card_set != None:
-            card_sets.append(card_set)
-            cards_remaining = [card for card in cards_remaining if card not in card_set]
-            card_set = game.state.get_card_set(cards_remaining)
-
-    return game.move_redeem_cards(query, [(x[0].card_id, x[1].card_id, x[2].card_id) for x in card_sets])
+def late_game(game: Game, bot_state: BotState) -> bool:
+    """Whether we should stop spreading our troops and start doomstacking."""
+    return len(game.state.recording) >= LATE_GAME_RECORDS or bot_state.battles.turns >= LATE_GAME_TURNS
 
 
 def handle_distribute_troops(game: Game, bot_state: BotState, query: QueryDistributeTroops) -> MoveDistributeTroops:
@@ -281,10 +2722,7 @@ def handle_distribute_troops(game: Game, bot_state: BotState, query: QueryDistri
     # We will distribute troops across our border territories.
     total_troops = game.state.me.troops_remaining
     distributions = defaultdict(lambda: 0)
-    border_territories = game.state.get_all_border_territories(
-        game.state.get_territories_owned_by(game.state.me.player_id)
-    )
-    all_territories = game.state.get_territories_owned_by(game.state.me.player_id)
+    ownership = bot_state.ownership
 
 
 
@@ -298,293 +2736,560 @@ def handle_distribute_troops(game: Game, bot_state: BotState, query: QueryDistri
 
     # We will equally distribute across border territories in the early game,
     # but start doomstacking in the late game.
-    country_dictionary = {
-        "North America":list(range(9)),
-        "South America":list(range(29, 32)),
-        "Australia": list(range(38,43)),
-        "Africa": list(range(32, 38)),
-        "Europe": list(range(9, 16)),
-        "Asia": list(range(16,29)),
-    }
-    country_joint_dictionary = {
-        "North America":[0,2,4],
-        "South America":[30,29],
-        "Australia": [40],
-        "Africa": [33,34,36],
-        "Europe": [10,12,13,14,15],
-        "Asia": [16,21,22,24,26],
-    }
-
-    continent_list = ["North America", "South America", "Australia", "Africa" ,"Europe", "Asia"]
+    map_index = bot_state.map_index
+    if not late_game(game, bot_state):
+        spread_troops(bot_state, game.state.me.player_id, total_troops, distributions)
+
+    else:
+        mine = ownership.masks[game.state.me.player_id]
+        frontier = map_index.frontier(mine)
+        weakest_players = sorted(game.state.players.values(), key=lambda x: ownership.troop_totals[x.player_id])
+
+        for player in weakest_players:
+            bordering_enemy_territories = frontier & ownership.masks[player.player_id]
+            if bordering_enemy_territories:
+                # We stack on our strongest territory facing them, so the stack keeps growing in one place.
+                selected_territory = max(bits(ownership.border_mask & map_index.frontier(bordering_enemy_territories)), key=ownership.troops.__getitem__)
+                target = min(bits(map_index.neighbour_mask[selected_territory] & bordering_enemy_territories), key=ownership.troops.__getitem__)
+                if telemetry.level >= TELEMETRY_DEBUG:
+                    telemetry.emit(
+                        TELEMETRY_DEBUG, "late_game_stack", my_territories=mine, bordering_enemy_territories=bordering_enemy_territories,
+                        target_territory=target, adjacent_territories=map_index.neighbour_mask[target], stack_territory=selected_territory, troops=total_troops,
+                    )
+                distributions[selected_territory] += total_troops
+                break
+
+    # Now we know where our troops are going, we will plan the rest of our turn.
+    choose_enemy(bot_state, game.state.players)
+    bot_state.plan = TurnPlan(dict(distributions), plan_attacks(bot_state, distributions))
+    return game.move_distribute_troops(query, distributions)
+
+
+def spread_troops(bot_state: BotState, me: int, total_troops: int, distributions: defaultdict[int, int]) -> None:
+    """Spread the troops across our border the early game way: over the exposed joints of the
+    continents we hold, or if we hold none, over the border of the continent we are closest to taking."""
+    ownership = bot_state.ownership
+    map_index = bot_state.map_index
 
     #calculate if there is any continent that has been completely dominated
-    def calculate_continent_progress(all_territory: list[int], country_dictionary: dict[str, list[int]], continent_list: list[str]) -> list[float]:
-        territory_percentage = []
-        for continent in continent_list:
-            owned_territory = 0
-            unowned_territory = 0
-            continent_territory = country_dictionary[continent]
-            for territory in continent_territory:
-                if territory in all_territory:
-                    owned_territory += 1
-                else:
-                    unowned_territory += 1
-            percentage = owned_territory/(owned_territory + unowned_territory)
-            territory_percentage.append(percentage)
-        return territory_percentage
+    continent_progress = ownership.continent_progress(me)
+    captured_continent = {map_index.continent_names[i] for i, progress in enumerate(continent_progress) if progress == 1.0}
 
-    
-    continent_progress = calculate_continent_progress(all_territories, country_dictionary, continent_list)
-    captured_continent = []
-
-    i = 0
-    while i < len(continent_progress):
-        if continent_progress[i] == 1.0:
-            captured_continent.append(continent_list[i])
-        i += 1
-
-    all_joint_territory = []
-    for continent in captured_continent:
-
-        #include all the joint territory that need to be reinforced if next to opponent territory
-        all_joint_territory += country_joint_dictionary[continent]
-        
-    if len(game.state.recording) < 4000:
-        if len(all_joint_territory) != 0:
+    #include all the joint territory that need to be reinforced if next to opponent territory,
+    #which are the ones that don't just lead into another continent we have captured
+    all_joint_territory = [t for t in map_index.exposed_joints(captured_continent) if ownership.border_mask >> t & 1]
 
-            if "North America" in captured_continent:
-                if "South America" in captured_continent:
-                    all_joint_territory.remove(30)
-                    all_joint_territory.remove(2)
-                if "Asia" in captured_continent:
-                    all_joint_territory.remove(0)
-                    all_joint_territory.remove(21)
-                if "Europe" in captured_continent:
-                    all_joint_territory.remove(4)
-                    all_joint_territory.remove(10)
-            if "South America" in captured_continent:
-                if "Africa" in captured_continent:
-                    all_joint_territory.remove(29)
-                    all_joint_territory.remove(36)
-            if "Europe" in captured_continent:
-                if "Asia" in captured_continent:
-                    all_joint_territory.remove(13)
-                    all_joint_territory.remove(14)
-                    all_joint_territory.remove(16)
-                    all_joint_territory.remove(22)
-                    all_joint_territory.remove(26)
-                    if "Africa" in captured_continent:              
-                        all_joint_territory.remove(15)
-                        all_joint_territory.remove(34)
-                        all_joint_territory.remove(36)
-            if "Asia" in captured_continent:
-                if "Australia" in captured_continent:
-                    all_joint_territory.remove(24)
-                    all_joint_territory.remove(40)
-            if len(all_joint_territory) != 0:
-                troops_per_territory = total_troops // len(all_joint_territory)
-                leftover_troops = total_troops % len(all_joint_territory)
-                for territory in all_joint_territory:
-                    distributions[territory] += troops_per_territory
-                distributions[border_territories[0]] += leftover_troops
-            else:
-                distributions[border_territories[0]] += total_troops
-        else:
-            #if we did not have any continent, we try to stack on the continent with greatest friendly territory, and conquer the entire continent
-            max_percentage = 0
-            max_continent = ""
-            count = 0
-            while count < len(continent_progress):
-                if continent_progress[count] >= max_percentage:
-                    max_continent = continent_list[count]
-                count += 1
-
-            reinforce_territory = []
-            for territory in border_territories:
-                if territory in country_dictionary[max_continent]:
-                    reinforce_territory.append(territory)
-
-            if len(reinforce_territory) != 0:
-                troops_per_territory = total_troops // len(reinforce_territory)
-                leftover_troops = total_troops % len(reinforce_territory)
-                for territory in reinforce_territory:
-                    distributions[territory] += troops_per_territory
-        
-                # The leftover troops will be put some territory (we don't care)
-                distributions[border_territories[0]] += leftover_troops
-            else:
-                distributions[border_territories[0]] += total_troops
+    # Whatever doesn't divide evenly goes to our best-scoring border territory.
+    evaluator = bot_state.evaluator
+    evaluator.evaluate(me)
+    best_border_territory = evaluator.best(ownership.border_mask)
 
+    if len(captured_continent) != 0:
+        if len(all_joint_territory) != 0:
+            troops_per_territory = total_troops // len(all_joint_territory)
+            leftover_troops = total_troops % len(all_joint_territory)
+            for territory in all_joint_territory:
+                distributions[territory] += troops_per_territory
+            distributions[best_border_territory] += leftover_troops
+        else:
+            distributions[best_border_territory] += total_troops
     else:
-        my_territories = game.state.get_territories_owned_by(game.state.me.player_id)
-        weakest_players = sorted(game.state.players.values(), key=lambda x: sum(
-            [game.state.territories[y].troops for y in game.state.get_territories_owned_by(x.player_id)]
-        ))
+        #if we did not have any continent, we try to stack on the continent with greatest friendly territory, and conquer the entire continent
+        max_continent = map_index.continent_names[max(range(len(continent_progress)), key=continent_progress.__getitem__)]
+        reinforce_territory = evaluator.ranked(ownership.border_mask & map_index.continent_mask[max_continent])
+
+        if len(reinforce_territory) != 0:
+            troops_per_territory = total_troops // len(reinforce_territory)
+            leftover_troops = total_troops % len(reinforce_territory)
+            for territory in reinforce_territory:
+                distributions[territory] += troops_per_territory
+
+            # The leftover troops go to the territories there that need them most.
+            for territory in reinforce_territory[:leftover_troops]:
+                distributions[territory] += 1
+        else:
+            distributions[best_border_territory] += total_troops
 
-        for player in weakest_players:
-            bordering_enemy_territories = set(game.state.get_all_adjacent_territories(my_territories)) & set(game.state.get_territories_owned_by(player.player_id))
-            if len(bordering_enemy_territories) > 0:
-                print("my territories", [game.state.map.get_vertex_name(x) for x in my_territories])
-                print("bordering enemies", [game.state.map.get_vertex_name(x) for x in bordering_enemy_territories])
-                print("adjacent to target", [game.state.map.get_vertex_name(x) for x in game.state.map.get_adjacent_to(list(bordering_enemy_territories)[0])])
-                selected_territory = list(set(game.state.map.get_adjacent_to(list(bordering_enemy_territories)[0])) & set(my_territories))[0]
-                distributions[selected_territory] += total_troops
-                break
 
+def troops_to_keep_at(bot_state: BotState, territory: int, troops: Sequence[int], mine: int) -> int:
+    """`troops_to_keep` against the strongest territory next to this one that isn't in `mine`,
+    allowing for how often its owner attacks."""
+    strongest = max(bits(bot_state.map_index.neighbour_mask[territory] & ~mine), key=troops.__getitem__, default=-1)
+    if strongest < 0:
+        return 1
+    return troops_to_keep(troops[strongest], bot_state.opponents.attack_chance(bot_state.ownership.owner[strongest]))
 
-    return game.move_distribute_troops(query, distributions)
+
+def choose_enemy(bot_state: BotState, players: Iterable[int]) -> None:
+    """Make the player who has been attacking us most lately our enemy, or if nobody has, the
+    neighbour that is easiest to hurt (see MIN_ENEMY_DANGER)."""
+    ownership = bot_state.ownership
+    me = ownership.me
+    mine = ownership.masks[me]
+    opponents = bot_state.opponents
+    alive = [p for p in players if p != me and ownership.masks[p]]
+    hostile = max(alive, key=lambda p: opponents.danger(p), default=None)
+
+    if hostile is not None and opponents.danger(hostile) >= MIN_ENEMY_DANGER:
+        bot_state.enemy = hostile
+
+    # If we have no enemy, we will pick on the neighbour with the weakest territory bordering us,
+    # counting what they are about to get and whether they are after our continent.
+    else:
+        bordering_territories = bot_state.map_index.frontier(mine)
+        weakest: dict[Optional[int], int] = {}
+        for territory in bits(bordering_territories):
+            owner = ownership.owner[territory]
+            weakest[owner] = min(weakest.get(owner, ownership.troops[territory]), ownership.troops[territory])
+        progress = ownership.continent_progress(me)
+        ours = max(range(len(progress)), key=progress.__getitem__, default=-1)
+
+        def appeal(player: Optional[int]) -> float:
+            if player is None:
+                return weakest[player]
+            return weakest[player] - REINFORCEMENT_WEIGHT * opponents.reinforcements(player, ownership.income(player)) - FOCUS_WEIGHT * (opponents.focus(player) == ours)
+
+        if weakest:
+            bot_state.enemy = min(weakest, key=lambda p: (appeal(p), -1 if p is None else p))
+
+
+def plan_attacks(bot_state: BotState, placements: dict[int, int]) -> deque[tuple[int, int, int]]:
+    """The attacks to make for the rest of our turn (see `search_attacks`), which we only work out
+    once for each board, enemy and set of placements."""
+    key = ("attack_plan", bot_state.ownership.hash, bot_state.enemy, bot_state.opponents.signature(bot_state.ownership.masks), tuple(sorted((t, n) for t, n in placements.items() if n)))
+    return deque(bot_state.memo.get(key, lambda: tuple(search_attacks(bot_state, placements))))
+
+
+def projected_troops(bot_state: BotState, placements: dict[int, int]) -> list[int]:
+    """The troops on every territory once the placements are made."""
+    troops = list(bot_state.ownership.troops)
+    for territory, count in placements.items():
+        troops[territory] += count
+    return troops
+
+
+def simulate_attacks(bot_state: BotState, placements: dict[int, int], first_target: Optional[int] = None) -> list[tuple[int, int, int]]:
+    """Play out the rest of our turn on a copy of the troop counts, assuming every battle we start
+    goes the way a battle we win usually does. We keep taking the territory we are most likely to
+    conquer (favouring our enemy's) from our strongest territory next to it, until nothing left is
+    in our favour. If there is a `first_target`, we attack that first."""
+    map_index = bot_state.map_index
+    ownership = bot_state.ownership
+    troops = projected_troops(bot_state, placements)
+    mine = ownership.masks[ownership.me]
+    enemy_mask = ownership.masks[bot_state.enemy] if bot_state.enemy is not None else 0
+
+    attacks: list[tuple[int, int, int]] = []
+    while len(attacks) < MAX_PLANNED_ATTACKS:
+        best_score = 0.0
+        best = None
+        targets = 1 << first_target if first_target is not None and not attacks else map_index.frontier(mine)
+        for target in bits(targets):
+            source = max(bits(map_index.neighbour_mask[target] & mine), key=troops.__getitem__)
+            odds = battle_odds.win_probability(troops[source] - 1, troops[target])
+            if odds < MIN_ATTACK_WIN_PROBABILITY:
+                continue
+            score = odds + ENEMY_PREFERENCE * (enemy_mask >> target & 1)
+            if score > best_score:
+                best_score = score
+                best = (source, target, odds)
+        if best is None:
+            break
+
+        source, target, odds = best
+        survivors = max(1, round(battle_odds.expected_survivors(troops[source] - 1, troops[target]) / odds))
+        mine |= 1 << target
+        keep = troops_to_keep_at(bot_state, source, troops, mine)
+        attacks.append((source, target, keep))
+        troops[source] = max(1, min(keep, survivors + 1 - min(3, survivors)))
+        troops[target] = survivors + 1 - troops[source]
+    return attacks
+
+
+def search_attacks(bot_state: BotState, placements: dict[int, int]) -> list[tuple[int, int, int]]:
+    """Choose between a few candidate attack chains by rolling each of them out with real dice many
+    times, for up to SEARCH_BUDGET_SECONDS. The candidates are the expected-case plan starting from
+    each of the most promising first targets, and not attacking at all. With no budget, or nothing
+    to choose between, this is just `simulate_attacks`."""
+    greedy = simulate_attacks(bot_state, placements)
+    if SEARCH_BUDGET_SECONDS <= 0 or not greedy:
+        return greedy
+
+    map_index = bot_state.map_index
+    ownership = bot_state.ownership
+    troops = projected_troops(bot_state, placements)
+    mine = ownership.masks[ownership.me]
+    first_targets = sorted(
+        (t for t in bits(map_index.frontier(mine)) if t != greedy[0][1]),
+        key=lambda t: -battle_odds.win_probability(max(troops[x] for x in bits(map_index.neighbour_mask[t] & mine)) - 1, troops[t]),
+    )[:SEARCH_CANDIDATES - 1]
+    candidates = [tuple(greedy), ()]
+    for target in first_targets:
+        chain = tuple(simulate_attacks(bot_state, placements, target))
+        if chain and chain not in candidates:
+            candidates.append(chain)
+    if len(candidates) <= 2:
+        return greedy
+
+    start = time.perf_counter()
+    search_map = (map_index.neighbour_mask, tuple(map_index.continent_mask.values()), tuple(map_index.continent_bonus.values()))
+    seed = ownership.hash
+
+    # A speculative search stays in our own process, so that it can be stopped, and is thrown away if it is.
+    if search_pool is not None and bot_state.cancelled is None:
+        futures = [search_pool.submit(run_rollouts, search_map, troops, mine, candidates, SEARCH_BUDGET_SECONDS, seed + i) for i in range(search_workers)]
+        results = [future.result() for future in futures]
+    else:
+        results = [run_rollouts(search_map, troops, mine, candidates, SEARCH_BUDGET_SECONDS, seed, bot_state.cancelled)]
+        if bot_state.cancelled is not None and bot_state.cancelled.is_set():
+            raise SpeculationCancelled()
+
+    totals = [sum(r[0][i] for r in results) for i in range(len(candidates))]
+    counts = [sum(r[1][i] for r in results) for i in range(len(candidates))]
+    bot_state.stats.rollouts += sum(counts)
+    bot_state.stats.search_seconds += time.perf_counter() - start
+    best = max(range(len(candidates)), key=lambda i: (totals[i] / max(1, counts[i]), -i))
+    return list(candidates[best])
+
+
+def next_planned_attack(bot_state: BotState, plan: TurnPlan) -> Optional[tuple[int, int, int]]:
+    """The (attacking territory, target, dice) of the plan's next attack, if it is still in our favour."""
+    ownership = bot_state.ownership
+    mine = ownership.masks[ownership.me]
+    while plan.attacks:
+        source, target, _ = plan.attacks[0]
+        if mine >> target & 1:
+            plan.attacks.popleft()
+            continue
+        attackers = ownership.troops[source] - 1
+        if mine >> source & 1 and attackers > 0 and battle_odds.win_probability(attackers, ownership.troops[target]) >= MIN_ATTACK_WIN_PROBABILITY:
+            return source, target, min(3, attackers)
+        break
+    return None
+
+
+def attack_from_strongest(bot_state: BotState) -> Optional[tuple[int, int, int]]:
+    """The (attacking territory, target, dice) of an attack on the weakest enemy next to our strongest
+    border territory, or next to our next strongest if that isn't in our favour."""
+    ownership = bot_state.ownership
+    troops = ownership.troops
+    mine = ownership.masks[ownership.me]
+    for source in sorted(bits(ownership.border_mask), key=troops.__getitem__, reverse=True):
+        attackers = troops[source] - 1
+        if attackers <= 0:
+            break
+        target = min(bits(bot_state.map_index.neighbour_mask[source] & ~mine), key=troops.__getitem__)
+        if battle_odds.win_probability(attackers, troops[target]) >= MIN_ATTACK_WIN_PROBABILITY:
+            return source, target, min(3, attackers)
+    return None
 
 
 def handle_attack(game: Game, bot_state: BotState, query: QueryAttack) -> Union[MoveAttack, MoveAttackPass]:
     """After the troop phase of your turn, you may attack any number of times until you decide to
     stop attacking (by passing). After a successful attack, you may move troops into the conquered
     territory. If you eliminated a player you will get a move to redeem cards and then distribute troops."""
-    
-    # We will attack someone.
-    my_territories = game.state.get_territories_owned_by(game.state.me.player_id)
-    bordering_territories = game.state.get_all_adjacent_territories(my_territories)
-
-    def attack_weakest(territories: list[int]) -> Optional[MoveAttack]:
-        # We will attack the weakest territory from the list.
-        territories = sorted(territories, key=lambda x: game.state.territories[x].troops)
-        for candidate_target in territories:
-            candidate_attackers = sorted(list(set(game.state.map.get_adjacent_to(candidate_target)) & set(my_territories)), key=lambda x: game.state.territories[x].troops, reverse=True)
-            for candidate_attacker in candidate_attackers:
-                if game.state.territories[candidate_attacker].troops > 1:
-                    return game.move_attack(query, candidate_attacker, candidate_target, min(3, game.state.territories[candidate_attacker].troops - 1))
-
-
-    if len(game.state.recording) < 4000:
-        # We will check if anyone attacked us in the last round.
-        new_records = game.state.recording[game.state.new_records:]
-        enemy = None
-        for record in new_records:
-            match record:
-                case MoveAttack() as r:
-                    if r.defending_territory in set(my_territories):
-                        enemy = r.move_by_player
-
-        # If we don't have an enemy yet, or we feel angry, this player will become our enemy.
-        if enemy != None:
-            if bot_state.enemy == None or random.random() < 0.05:
-                bot_state.enemy = enemy
-        
-        # If we have no enemy, we will pick the player with the weakest territory bordering us, and make them our enemy.
-        else:
-            weakest_territory = min(bordering_territories, key=lambda x: game.state.territories[x].troops)
-            bot_state.enemy = game.state.territories[weakest_territory].occupier
-            
-        # We will attack their weakest territory that gives us a favourable battle if possible.
-        enemy_territories = list(set(bordering_territories) & set(game.state.get_territories_owned_by(enemy)))
-        move = attack_weakest(enemy_territories)
-        if move != None:
-            return move
-        
-        # Otherwise we will attack anyone most of the time.
-        if random.random() < 0.8:
-            move = attack_weakest(bordering_territories)
-            if move != None:
-                return move
+
+    # We will follow the plan we made when we distributed our troops. If the next attack isn't in our
+    # favour any more, or we have run out of plan, we will plan again from the board as it is now.
+    plan = bot_state.plan
+    if plan is None:
+        plan = bot_state.plan = TurnPlan({}, plan_attacks(bot_state, {}))
+    attack = next_planned_attack(bot_state, plan)
+    if attack is None:
+        plan.attacks = plan_attacks(bot_state, {})
+        bot_state.stats.replans += 1
+        attack = next_planned_attack(bot_state, plan)
 
     # In the late game, we will attack anyone adjacent to our strongest territories (hopefully our doomstack).
-    else:
-        strongest_territories = sorted(my_territories, key=lambda x: game.state.territories[x].troops, reverse=True)
-        for territory in strongest_territories:
-            move = attack_weakest(list(set(game.state.map.get_adjacent_to(territory)) - set(my_territories)))
-            if move != None:
-                return move
+    if attack is None and late_game(game, bot_state):
+        attack = attack_from_strongest(bot_state)
+    if attack is not None:
+        return game.move_attack(query, *attack)
 
+    # Once we stop attacking the board won't change before we fortify, so we can decide that now.
+    plan.fortify = plan_fortify(game, bot_state)
     return game.move_attack_pass(query)
 
 
 def handle_troops_after_attack(game: Game, bot_state: BotState, query: QueryTroopsAfterAttack) -> MoveTroopsAfterAttack:
     """After conquering a territory in an attack, you must move troops to the new territory."""
     
-    # First we need to get the record that describes the attack, and then the move that specifies
-    # which territory was the attacking territory.
-    record_attack = cast(RecordAttack, game.state.recording[query.record_attack_id])
-    move_attack = cast(MoveAttack, game.state.recording[record_attack.move_attack_id])
-
-    # We will always move the maximum number of troops we can.
-    return game.move_troops_after_attack(query, game.state.territories[move_attack.attacking_territory].troops - 1)
+    # First we need the move that specifies which territory was the attacking territory, which the
+    # attack tracker has usually kept for us.
+    move_attack = attack_move_for(game, bot_state, query.record_attack_id)
+
+    # We will move as many troops as we can, unless our attacking territory is next to another enemy,
+    # in which case we leave just enough behind that it is unlikely to fall. If this was the attack
+    # we planned, we already know how many that is.
+    source = move_attack.attacking_territory
+    source_troops = game.state.territories[source].troops
+    minimum = min(move_attack.attacking_troops, source_troops - 1)
+
+    plan = bot_state.plan
+    if plan is not None and plan.attacks and plan.attacks[0][:2] == (source, move_attack.defending_territory):
+        keep = plan.attacks.popleft()[2]
+    else:
+        keep = troops_to_keep_at(bot_state, source, bot_state.ownership.troops, bot_state.ownership.masks[game.state.me.player_id])
+    keep = max(1, min(keep, source_troops - minimum))
+    return game.move_troops_after_attack(query, source_troops - keep)
 
 
 def handle_defend(game: Game, bot_state: BotState, query: QueryDefend) -> MoveDefend:
     """If you are being attacked by another player, you must choose how many troops to defend with."""
 
-    # We will always defend with the most troops that we can.
+    # We will defend with however many troops gives us the best chance of holding the territory
+    # for the rest of the battle, which is nearly always the most we can.
 
-    # First we need to get the record that describes the attack we are defending against.
-    move_attack = cast(MoveAttack, game.state.recording[query.move_attack_id])
+    # First we need the move that describes the attack we are defending against.
+    move_attack = attack_move(game, bot_state, query.move_attack_id)
     defending_territory = move_attack.defending_territory
-    
+    defenders = game.state.territories[defending_territory].troops
+    attackers = game.state.territories[move_attack.attacking_territory].troops - 1
+    return game.move_defend(query, choose_defence(bot_state, move_attack.move_by_player, move_attack.attacking_troops, attackers, defenders))
+
+
+def choose_defence(bot_state: BotState, attacker: Optional[int], attacking_dice: int, attackers: int, defenders: int) -> int:
+    """How many troops to defend with, which we only work out once for each battle position. We play
+    the battle out against as many of the attackers as the attacker is likely to spend on it."""
+    attackers = bot_state.opponents.committed(attacker, attackers, attacking_dice)
+
     # We can only defend with up to 2 troops, and no more than we have stationed on the defending
     # territory.
-    defending_troops = min(game.state.territories[defending_territory].troops, 2)
-    return game.move_defend(query, defending_troops)
+    def best_defence() -> int:
+        return max(range(1, min(defenders, 2) + 1), key=lambda x: (battle_odds.hold_probability(attacking_dice, attackers, x, defenders), x))
+
+    return bot_state.memo.get(("defend", attacking_dice, attackers, defenders), best_defence)
 
 
 def handle_fortify(game: Game, bot_state: BotState, query: QueryFortify) -> Union[MoveFortify, MoveFortifyPass]:
     """At the end of your turn, after you have finished attacking, you may move a number of troops between
     any two of your territories (they must be adjacent)."""
 
+    # We decided how to fortify when we stopped attacking, so we only need to check that the move is
+    # still legal. Either way, this is the end of our turn and of its plan.
+    plan = bot_state.plan
+    fortify = plan.fortify if plan is not None else None
+    mine = bot_state.ownership.masks[game.state.me.player_id]
+    if fortify is None or not (mine >> fortify[0] & 1 and mine >> fortify[1] & 1 and game.state.territories[fortify[0]].troops > fortify[2]):
+        fortify = plan_fortify(game, bot_state)
+    bot_state.plan = None
 
-    # We will always fortify towards the most powerful player (player with most troops on the map) to defend against them.
-    my_territories = game.state.get_territories_owned_by(game.state.me.player_id)
-    total_troops_per_player = {}
-    for player in game.state.players.values():
-        total_troops_per_player[player.player_id] = sum([game.state.territories[x].troops for x in game.state.get_territories_owned_by(player.player_id)])
-
-    most_powerful_player = max(total_troops_per_player.items(), key=lambda x: x[1])[0]
+    if fortify is None:
+        return game.move_fortify_pass(query)
+    return game.move_fortify(query, *fortify)
+
+
+def plan_fortify(game: Game, bot_state: BotState) -> Optional[tuple[int, int, int]]:
+    """The (source, target, troops) of our fortify move, or None if we should pass.
+
+    Each of our border territories needs enough troops that its strongest enemy neighbour is unlikely
+    to take it, and its shortfall matters in proportion to the enemy troops next to it (counting the
+    troops of players who have been attacking us for more). We make the
+    one move that most reduces the total weighted shortfall. If no single move can, we bring our
+    biggest idle stack one step closer to a territory that is short, through the group of our
+    territories it is in, or if nothing in its group is short, one step closer to the group's border."""
+    map_index = bot_state.map_index
+    ownership = bot_state.ownership
+    me = game.state.me.player_id
+    mine = ownership.masks[me]
+    owner = ownership.owner
+    troops = ownership.troops
+
+    need: dict[int, int] = {}
+    weight: dict[int, float] = {}
+    short = 0
+    danger = {p: bot_state.opponents.danger(p) for p in ownership.masks}
+    for territory in bits(ownership.border_mask):
+        total = 0.0
+        for neighbour in map_index.adjacent[territory]:
+            if owner[neighbour] != me:
+                total += troops[neighbour] * danger.get(owner[neighbour], 1.0)
+        need[territory] = troops_to_keep_at(bot_state, territory, troops, mine)
+        weight[territory] = total
+        if troops[territory] < need[territory]:
+            short |= 1 << territory
+
+    best_gain = 0.0
+    best_move = None
+    for target in bits(short):
+        shortfall = need[target] - troops[target]
+        for source in bits(map_index.neighbour_mask[target] & mine):
+            spare = troops[source] - need.get(source, 1)
+            if spare <= 0:
+                continue
+
+            # Troops in a territory behind our border aren't holding anything, so they can all move up,
+            # but a border territory only gives up what it can spare.
+            moved = min(spare, shortfall) if source in need else spare
+            gain = weight[target] * min(moved, shortfall)
+            if gain > best_gain:
+                best_gain = gain
+                best_move = (source, target, moved)
+    if best_move is not None:
+        return best_move
+
+    # A multi-source BFS from the territories that are short (or if none are, from the border), inside
+    # each group of our territories, gives every territory in the group its next step towards the
+    # nearest of them. Troops behind our border can't attack or defend anything, so they always move up.
+    best_stack = 1
+    for group in bot_state.components.groups():
+        targets = short & group or ownership.border_mask & group
+        if not targets:
+            continue
+        toward = {x: x for x in bits(targets)}
+        queue = deque(bits(targets))
+        while queue:
+            current = queue.popleft()
+            for neighbour in map_index.adjacent[current]:
+                if group >> neighbour & 1 and neighbour not in toward:
+                    toward[neighbour] = current
+                    queue.append(neighbour)
+        for source in bits(group & ~ownership.border_mask):
+            if troops[source] > best_stack and source in toward:
+                best_stack = troops[source]
+                best_move = (source, toward[source], troops[source] - 1)
+    if best_move is not None:
+        return best_move
+
+    # If nothing is short of troops, we will fortify towards the most powerful player (player with most
+    # troops on the map) to defend against them.
+    most_powerful_player = max(game.state.players.keys(), key=lambda x: ownership.troop_totals[x])
 
     # If we are the most powerful, we will pass.
     if most_powerful_player == game.state.me.player_id:
-        return game.move_fortify_pass(query)
+        return None
     
     # Otherwise we will find the shortest path between our territory with the most troops
     # and any of the most powerful player's territories and fortify along that path.
-    candidate_territories = game.state.get_all_border_territories(my_territories)
+    candidate_territories = list(bits(ownership.border_mask))
+    if not candidate_territories:
+        return None
     most_troops_territory = max(candidate_territories, key=lambda x: game.state.territories[x].troops)
 
-    # To find the shortest path, we will use a custom function.
-    shortest_path = find_shortest_path_from_vertex_to_set(game, most_troops_territory, set(game.state.get_territories_owned_by(most_powerful_player)))
+    # To find the shortest path, we will use the precomputed distance tables.
+    shortest_path = find_shortest_path_from_vertex_to_set(bot_state, most_troops_territory, most_powerful_player)
     # We will move our troops along this path (we can only move one step, and we have to leave one troop behind).
-    # We have to check that we can move any troops though, if we can't then we will pass our turn.
-    if len(shortest_path) > 0 and game.state.territories[most_troops_territory].troops > 1:
-        return game.move_fortify(query, shortest_path[0], shortest_path[1], game.state.territories[most_troops_territory].troops - 1)
-    else:
-        return game.move_fortify_pass(query)
-
-
-def find_shortest_path_from_vertex_to_set(game: Game, source: int, target_set: set[int]) -> list[int]:
-    """Used in move_fortify()."""
-
-    # We perform a BFS search from our source vertex, stopping at the first member of the target_set we find.
-    queue = deque()
-    queue.appendleft(source)
-
-    current = queue.pop()
-    parent = {}
-    seen = {current: True}
-
-    while len(queue) != 0:
-        if current in target_set:
-            break
-
-        for neighbour in game.state.map.get_adjacent_to(current):
-            if neighbour not in seen:
-                seen[neighbour] = True
-                parent[neighbour] = current
-                queue.appendleft(neighbour)
-
-        current = queue.pop()
-
-    path = []
-    while current in parent:
-        path.append(current)
-        current = parent[current]
-
-    return path[::-1]
+    # We have to check that we can move any troops though, and that the first step is still one of
+    # our territories, if not then we will pass our turn.
+    if len(shortest_path) > 1 and mine >> shortest_path[0] & 1 and game.state.territories[most_troops_territory].troops > 1:
+        return most_troops_territory, shortest_path[0], game.state.territories[most_troops_territory].troops - 1
+    return None
+
+
+# How many rolls into a battle we work out our defence ahead of time.
+SPECULATIVE_DEFENCE_ROLLS = 3
+
+
+def speculative_work(game: Game, bot_state: BotState, move: Optional[MoveType], cancelled: threading.Event) -> list[tuple[str, Callable[[], Any]]]:
+    """What is worth working out while we wait for the query after `move`. This runs in the main
+    thread, so it takes what it needs from the game and bot state now; the units it returns only
+    touch a speculative copy of the bot state (and the memo), or offer the live indexes something
+    they can check before using."""
+    ownership = bot_state.ownership
+    me = ownership.me
+    if me is None:
+        return []
+    work: list[tuple[str, Callable[[], Any]]] = []
+    players = list(game.state.players)
+
+    # Copying the indexes is O(territories), so rather than doing it on the query path we leave it to
+    # the first unit that runs, in the speculator's thread. The main thread doesn't touch the indexes
+    # again until it has paused the speculator, and pausing waits for the running unit.
+    states: list[SpeculativeState] = []
+    def state() -> SpeculativeState:
+        if not states:
+            states.append(SpeculativeState(bot_state, cancelled))
+        return states[0]
+
+    # Redeeming cards is always followed by distributing troops on a board that hasn't changed, and
+    # we can tell how many troops we will have, so the distribution (and its attack search) can be done
+    # now. Growing the battle tables can't be interrupted, so we leave battles they don't cover yet
+    # to the main thread.
+    if isinstance(move, MoveRedeemCards) and not late_game(game, bot_state):
+        troops, must_place = predicted_troops(game, bot_state, move)
+        if battle_odds.covers(max(ownership.troops) + troops):
+            work.append(("distribute", lambda: speculate_distribution(state(), players, troops, must_place)))
+
+    # The distance fields and our groups of territories that the last few captures left stale will
+    # be rebuilt when fortifying asks for them, and that is cheap enough to get out of the way first.
+    # The masks are taken now, as the live index won't have them once the game moves on.
+    for player in players:
+        mask = ownership.masks[player]
+        if player != me and mask and bot_state.distances.needs(player):
+            work.append(("distances", lambda player=player, mask=mask: bot_state.distances.prepare(player, mask)))
+    if bot_state.components.needs():
+        mine = ownership.masks[me]
+        work.append(("components", lambda: bot_state.components.prepare(mine)))
+
+    # Otherwise it is most likely someone else's turn, and we will be asked to defend the border.
+    for territory in bits(ownership.border_mask):
+        work.append(("defend", lambda territory=territory: speculate_defence(state(), territory)))
+    return work
+
+
+def predicted_troops(game: Game, bot_state: BotState, move: MoveRedeemCards) -> tuple[int, list[int]]:
+    """The troops we will have to distribute after redeeming the sets in `move`, and the territory
+    (if any) the matching territory bonus will have to go on."""
+    me = game.state.me
+    mine = bot_state.ownership.masks[me.player_id]
+    cards = {card.card_id: card for card in me.cards}
+    troops = me.troops_remaining
+
+    # If the redeemed cards have already left our hand, the game state has caught up with the move.
+    if any(card_id not in cards for card_set in move.sets for card_id in card_set):
+        return troops, list(me.must_place_territory_bonus)
+
+    sets_redeemed = game.state.card_sets_redeemed
+    matched = []
+    for card_set in move.sets:
+        troops += set_bonus(sets_redeemed)
+        sets_redeemed += 1
+        for card_id in card_set:
+            territory = cards[card_id].territory_id
+            if territory is not None and mine >> territory & 1 and territory not in matched:
+                matched.append(territory)
+    if matched:
+        troops += 2
+    return troops, matched[:1]
+
+
+def speculate_distribution(state: SpeculativeState, players: list[int], troops: int, must_place: list[int]) -> None:
+    """Distribute the troops the way `handle_distribute_troops` will, so the attack plan for the
+    distribution is waiting in the memo when it is asked for."""
+    distributions = defaultdict(lambda: 0)
+    if must_place:
+        distributions[must_place[0]] += 2
+        troops -= 2
+    spread_troops(state, state.ownership.me, troops, distributions)
+    state.check()
+    choose_enemy(state, players)
+    plan_attacks(state, distributions)
+
+
+def speculate_defence(state: SpeculativeState, territory: int) -> None:
+    """Work out our defence of the territory for the first few rolls of an attack from each of its
+    enemy neighbours."""
+    ownership = state.ownership
+    defenders = ownership.troops[territory]
+    for neighbour in bits(state.map_index.neighbour_mask[territory] & ~ownership.masks[ownership.me]):
+        state.check()
+        attacker = ownership.owner[neighbour]
+        most_attackers = ownership.troops[neighbour] - 1
+        if not battle_odds.covers(max(most_attackers, defenders)):
+            continue
+        for attackers in range(most_attackers, max(0, most_attackers - SPECULATIVE_DEFENCE_ROLLS), -1):
+            for remaining in range(defenders, max(0, defenders - SPECULATIVE_DEFENCE_ROLLS), -1):
+                for attacking_dice in range(1, min(attackers, 3) + 1):
+                    choose_defence(state, attacker, attacking_dice, attackers, remaining)
+
+
+def find_shortest_path_from_vertex_to_set(bot_state: BotState, source: int, player: int) -> list[int]:
+    """Used in move_fortify(). The shortest path from the source to the player's nearest territory,
+    not including the source."""
+    target = bot_state.distances.nearest(player, source)
+    if target < 0:
+        return []
+    return bot_state.map_index.path(source, target)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
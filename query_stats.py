@@ -0,0 +1,149 @@
+"""Read the query stats the bot writes at the end of a game, and add them up over many games.
+
+The bot writes its stats as JSON to BOT_STATS_PATH when it is run as the real bot, and tournament.py
+--stats DIR writes one file per seat per game into DIR. Pass any mix of files and directories (every
+.json file in a directory is read):
+
+    python query_stats.py bot_stats.json
+    python query_stats.py --json totals.json stats/
+"""
+
+import argparse
+from collections import defaultdict
+import json
+import os
+from typing import Optional
+
+
+def stats_files(paths: list[str]) -> list[str]:
+    """The files to read: the paths that are files, and the .json files in the paths that are directories."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".json"))
+        else:
+            files.append(path)
+    return files
+
+
+def load(files: list[str]) -> list[dict]:
+    dumps = []
+    for path in files:
+        with open(path) as f:
+            dumps.append(json.load(f))
+    return dumps
+
+
+def percentile(buckets: list[float], histogram: list[int], slowest: float, fraction: float) -> float:
+    """An upper bound on the given latency percentile, from a histogram, as the bot works it out."""
+    target = fraction * sum(histogram)
+    seen = 0
+    for bucket, count in enumerate(histogram):
+        seen += count
+        if count and seen >= target:
+            return min(buckets[bucket], slowest) if bucket < len(buckets) else slowest
+    return 0.0
+
+
+def aggregate(dumps: list[dict]) -> dict:
+    """The stats of many games added up: counters are summed, latency histograms merged (and their
+    percentiles worked out again), and start-up times averaged."""
+    buckets: Optional[list[float]] = None
+    handlers: defaultdict[str, dict] = defaultdict(lambda: {"count": 0, "total": 0.0, "max": 0.0, "fallbacks": 0, "histogram": []})
+    caches: defaultdict[str, defaultdict[str, list[int]]] = defaultdict(lambda: defaultdict(lambda: [0, 0, 0]))
+    speculated: defaultdict[str, int] = defaultdict(int)
+    totals = {"queries": 0, "records_consumed": 0, "record_errors": 0, "rollouts": 0, "search_seconds": 0.0, "speculation_seconds": 0.0, "first_move_seconds": 0.0, "replans": 0}
+
+    for dump in dumps:
+        if buckets is None:
+            buckets = dump["buckets"]
+        elif dump["buckets"] != buckets:
+            raise ValueError("the stats were written with different latency buckets")
+        totals["queries"] += dump["queries"]
+        totals["records_consumed"] += dump["records_consumed"]
+        totals["record_errors"] += dump["record_errors"]
+        totals["rollouts"] += dump["search"]["rollouts"]
+        totals["search_seconds"] += dump["search"]["seconds"]
+        totals["speculation_seconds"] += dump["speculation"]["seconds"]
+        totals["first_move_seconds"] += dump["startup"]["first_move_seconds"]
+        totals["replans"] += dump.get("replans", 0)
+        for kind, units in dump["speculation"]["units"].items():
+            speculated[kind] += units
+        for name, cache in dump["caches"].items():
+            for kind, counts in cache["kinds"].items():
+                total = caches[name][kind]
+                total[0] += counts["hits"]
+                total[1] += counts["misses"]
+                total[2] += counts["speculative_hits"]
+        for query_type, handler in dump["handlers"].items():
+            total = handlers[query_type]
+            total["count"] += handler["count"]
+            total["total"] += handler["mean"] * handler["count"]
+            total["max"] = max(total["max"], handler["max"])
+            total["fallbacks"] += handler["fallbacks"]
+            histogram = total["histogram"] or [0] * len(handler["histogram"])
+            total["histogram"] = [a + b for a, b in zip(histogram, handler["histogram"])]
+
+    games = len(dumps)
+    return {
+        "games": games,
+        "queries": totals["queries"],
+        "records_consumed": totals["records_consumed"],
+        "record_errors": totals["record_errors"],
+        "search": {"rollouts": totals["rollouts"], "seconds": totals["search_seconds"]},
+        "speculation": {"units": dict(sorted(speculated.items())), "seconds": totals["speculation_seconds"]},
+        "replans": totals["replans"],
+        "first_move_seconds_mean": totals["first_move_seconds"] / max(1, games),
+        "caches": {
+            name: {
+                kind: {"hits": hits, "misses": misses, "speculative_hits": speculative_hits, "hit_rate": hits / max(1, hits + misses)}
+                for kind, (hits, misses, speculative_hits) in sorted(kinds.items())
+            }
+            for name, kinds in sorted(caches.items())
+        },
+        "handlers": {
+            query_type: {
+                "count": handler["count"],
+                "mean": handler["total"] / max(1, handler["count"]),
+                "p50": percentile(buckets or [], handler["histogram"], handler["max"], 0.5),
+                "p99": percentile(buckets or [], handler["histogram"], handler["max"], 0.99),
+                "max": handler["max"],
+                "fallbacks": handler["fallbacks"],
+            }
+            for query_type, handler in sorted(handlers.items())
+        },
+    }
+
+
+def report(totals: dict, indent: str = "") -> None:
+    print(f"{indent}{totals['games']} games, {totals['queries']} queries, {totals['records_consumed']} records read, "
+          f"{totals['record_errors']} record errors, {totals['replans']} turn plans redone, first move in {1e3 * totals['first_move_seconds_mean']:.1f}ms on average")
+    for query_type, handler in totals["handlers"].items():
+        print(f"{indent}  {query_type:<24} {handler['count']:>9} queries  mean {1e6 * handler['mean']:>9.1f}us  "
+              f"p99 <= {1e6 * handler['p99']:>10.1f}us  max {1e6 * handler['max']:>10.1f}us  {handler['fallbacks']:>5} fallbacks")
+    for name, kinds in totals["caches"].items():
+        for kind, cache in kinds.items():
+            print(f"{indent}  {name}/{kind:<16} {cache['hits']:>9} hits  {cache['misses']:>9} misses  ({cache['hit_rate']:.1%})  {cache['speculative_hits']:>7} speculative hits")
+    if totals["speculation"]["units"]:
+        units = ", ".join(f"{count} {kind}" for kind, count in totals["speculation"]["units"].items())
+        print(f"{indent}  speculated {units} in {totals['speculation']['seconds']:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="stats files, or directories of them")
+    parser.add_argument("--json", default=None, help="also write the totals to this file")
+    args = parser.parse_args()
+
+    files = stats_files(args.paths)
+    if not files:
+        parser.error("no stats files found")
+    totals = aggregate(load(files))
+    report(totals)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(totals, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Replay a game log written by the bot (run with BOT_RECORD_PATH set) through the bot's handlers, and
+report how fast they answered and how many answers differ from the ones in the log.
+
+Before each logged query, the records that came before it in the game are added to the recording and
+the board is set to the log's snapshot of it, so a replay needs neither the engine nor the other
+players. The bot keeps its state from query to query and follows the records as it would in a game,
+so it is asked the same questions with the same knowledge, and answers as it did. The exceptions are
+the attack search, which is randomised (set BOT_SEARCH_BUDGET=0, for the game that is logged too, to
+take it out), and queries where the bot ran out of time in the game.
+
+    python replay.py game.log
+    python replay.py --record-seed 3 game.log    # play a local game first, and log seat 0's queries
+"""
+
+import argparse
+from array import array
+from collections import defaultdict
+import contextlib
+import io
+import json
+import random
+import time
+from types import ModuleType
+from typing import Optional
+
+from local_engine import LocalBoard, LocalEngine, LocalGame, LocalMap
+from risk_shared.models.card_model import CardModel
+from risk_shared.queries.query_defend import QueryDefend
+from risk_shared.queries.query_distribute_troops import QueryDistributeTroops
+from risk_shared.queries.query_redeem_cards import QueryRedeemCards
+from risk_shared.queries.query_troops_after_attack import QueryTroopsAfterAttack
+from risk_shared.records.moves.move_attack import MoveAttack
+from risk_shared.records.record_attack import RecordAttack
+from tournament import load_bot
+
+
+def record_local_game(bot: ModuleType, path: str, seed: int, players: int) -> None:
+    """Play a local game with the bot in every seat, and log the queries seat 0 answers."""
+    random.seed(seed)
+    engine = LocalEngine(players, seed)
+    recorder = None
+
+    def make_policy(player: int, game: LocalGame):
+        bot_state = bot.create_bot_state(game)
+
+        def policy(query):
+            nonlocal recorder
+            move = bot.choose_move(game, bot_state, query)
+            if player == 0:
+                if recorder is None:
+                    recorder = bot.GameRecorder(path, game, bot_state.map_index)
+                recorder.write(game, bot_state, query, move)
+            return move
+        return policy
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine.play([make_policy(player, game) for player, game in enumerate(engine.games)])
+    if recorder is not None:
+        recorder.close()
+
+
+def load_frame(bot: ModuleType, board: LocalBoard, log, i: int) -> None:
+    """Make the board, and its recording, look like they did when the i-th query was asked."""
+    frame = log[i]
+    board.recording += log.records(i)
+    if len(board.recording) != frame.records:
+        raise ValueError(f"query {i} came after {frame.records} records, but the log has {len(board.recording)}")
+
+    for territory, model in board.territories.items():
+        occupier = frame.owner[territory]
+        model.occupier = occupier if occupier >= 0 else None
+        model.troops = frame.troops[territory]
+
+    me = board.players[frame.me]
+    me.troops_remaining = frame.troops_remaining
+    me.must_place_territory_bonus = [frame.must_place] if frame.must_place >= 0 else []
+    me.cards = []
+    for i in range(bot.LOG_CARD_SLOTS):
+        card_id, territory, symbol = frame.cards[3 * i:3 * i + 3]
+        if card_id < 0:
+            break
+        me.cards.append(CardModel(card_id=card_id, territory_id=territory if territory >= 0 else None, symbol=bot.CARD_SYMBOLS[symbol]))
+    board.card_sets_redeemed = frame.card_sets_redeemed
+
+
+def latest(board: LocalBoard, record_type: type) -> int:
+    """The index of the latest record of this type, or -1."""
+    for index in range(len(board.recording) - 1, -1, -1):
+        if isinstance(board.recording[index], record_type):
+            return index
+    return -1
+
+
+def logged_query(board: LocalBoard, frame):
+    """The frame's query. A query about an attack is about the latest one in the recording."""
+    if frame.query_type in (QueryRedeemCards, QueryDistributeTroops):
+        return frame.query_type(update={}, cause=frame.cause)
+    if frame.query_type is QueryDefend:
+        return QueryDefend(update={}, move_attack_id=latest(board, MoveAttack))
+    if frame.query_type is QueryTroopsAfterAttack:
+        return QueryTroopsAfterAttack(update={}, record_attack_id=latest(board, RecordAttack))
+    return frame.query_type(update={})
+
+
+def replay(bot: ModuleType, log) -> dict:
+    """Ask the bot every query in the log again, and time and check its answers."""
+    game_map = LocalMap.from_layout(log.layout)
+    board = LocalBoard(game_map, log[0].players, random.Random(0))
+    game = LocalGame(board, log[0].me)
+    bot_state = bot.create_bot_state(game)
+    if bot_state.map_index.fingerprint != log.fingerprint:
+        print(f"warning: the bot sees map {bot_state.map_index.fingerprint:016x}, but the log was made on {log.fingerprint:016x}")
+
+    # Query type -> [queries, total seconds, slowest seconds, answers that differ].
+    handlers: defaultdict[str, list] = defaultdict(lambda: [0, 0.0, 0.0, 0])
+    vector = array("h", [0]) * log.territories
+    redeemed = array("i", [-1]) * bot.LOG_CARD_SLOTS
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i, frame in enumerate(log):
+            load_frame(bot, board, log, i)
+            query = logged_query(board, frame)
+
+            query_start = time.perf_counter()
+            move = bot.choose_move(game, bot_state, query)
+            elapsed = time.perf_counter() - query_start
+
+            for i in range(len(vector)):
+                vector[i] = 0
+            for i in range(len(redeemed)):
+                redeemed[i] = -1
+            kind, a, b, c = bot.GameLog.encode_move(move, vector, redeemed)
+            handler = handlers[frame.query_type.__name__]
+            handler[0] += 1
+            handler[1] += elapsed
+            handler[2] = max(handler[2], elapsed)
+            handler[3] += (bot.LOG_MOVES[kind], a, b, c) != (frame.move_type, frame.a, frame.b, frame.c) or vector.tolist() != frame.vector.tolist() or redeemed.tolist() != frame.redeemed.tolist()
+    seconds = time.perf_counter() - start
+
+    return {
+        "frames": len(log),
+        "seconds": seconds,
+        "differ": sum(h[3] for h in handlers.values()),
+        "handlers": {
+            query_type: {"queries": count, "mean_us": 1e6 * total / count, "max_us": 1e6 * slowest, "differ": differ}
+            for query_type, (count, total, slowest, differ) in sorted(handlers.items())
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", help="the game log to replay")
+    parser.add_argument("--bot", default="my_submission.py", help="the bot file to replay the log through")
+    parser.add_argument("--repeat", type=int, default=1, help="replay this many times, each with a fresh bot state")
+    parser.add_argument("--record-seed", type=int, default=None, help="first play a local game with this seed and write its log to LOG")
+    parser.add_argument("--players", type=int, default=4, help="players in the game played by --record-seed")
+    parser.add_argument("--json", default=None, help="also write the summary of the last replay to this file")
+    args = parser.parse_args()
+
+    bot = load_bot(args.bot)
+    if args.record_seed is not None:
+        record_local_game(bot, args.log, args.record_seed, args.players)
+
+    log = bot.GameLog.open(args.log)
+    summary: Optional[dict] = None
+    try:
+        for run in range(args.repeat):
+            summary = replay(bot, log)
+            print(f"run {run + 1}: {summary['frames']} queries in {summary['seconds']:.2f}s, {summary['differ']} answers differ from the log")
+    finally:
+        log.close()
+
+    if summary is not None:
+        for query_type, handler in summary["handlers"].items():
+            print(f"  {query_type:<24} {handler['queries']:>7} queries  mean {handler['mean_us']:>9.1f}us  max {handler['max_us']:>10.1f}us  {handler['differ']:>6} differ")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Checks of the state the bot keeps incrementally against a brute-force recompute, on seeded games
+played on the local engine with the bot in every seat.
+
+    python -m pytest test_bot.py
+"""
+
+import contextlib
+import io
+import os
+import random
+
+import pytest
+
+from local_engine import LocalEngine
+import replay
+from tournament import load_bot
+
+
+bot = load_bot(os.path.join(os.path.dirname(os.path.abspath(__file__)), "my_submission.py"))
+
+
+def play(seed: int, players: int = 4, after_move=None):
+    """Play a seeded game, calling `after_move(game, bot_state, query, move)` after every move, and
+    return the result and each seat's game and bot state."""
+    random.seed(seed)
+    engine = LocalEngine(players, seed)
+    seats = [(game, bot.create_bot_state(game)) for game in engine.games]
+
+    def policy(game, bot_state):
+        def answer(query):
+            move = bot.choose_move(game, bot_state, query)
+            if after_move is not None:
+                after_move(game, bot_state, query, move)
+            return move
+        return answer
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = engine.play([policy(game, bot_state) for game, bot_state in seats])
+    return result, seats
+
+
+@pytest.fixture(autouse=True)
+def no_search(monkeypatch):
+    # The attack search is randomised, and only slows the games down here.
+    monkeypatch.setattr(bot, "SEARCH_BUDGET_SECONDS", 0.0)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_indexes_follow_the_game(monkeypatch, seed):
+    # DEBUG_INDEXES checks the ownership index against a full rebuild from the game state after
+    # every update; the distance fields and our groups of territories are checked here.
+    monkeypatch.setattr(bot, "DEBUG_INDEXES", True)
+
+    def check(game, bot_state, query, move):
+        ownership = bot_state.ownership
+        for player in list(ownership.masks):
+            if player is not None and ownership.masks[player]:
+                distance, nearest = bot_state.distances._build(ownership.masks[player])
+                for territory in bot_state.map_index.territories:
+                    assert bot_state.distances.distance(player, territory) == distance[territory]
+        _, groups = bot_state.components._group(ownership.masks[ownership.me])
+        assert sorted(bot_state.components.groups()) == sorted(groups.values())
+
+    result, seats = play(seed, after_move=check)
+    assert result.banned == {}
+    for _, bot_state in seats:
+        assert bot_state.dispatcher.errors == 0
+
+
+def logged_records(log, frames: list) -> list:
+    """Check the log's frames against what was logged, and return the records it has."""
+    # The frames are views into the log, so they are only kept in here, where they are let go of
+    # before the log is closed.
+    assert len(log) == len(frames)
+    records = []
+    for i, (frame, (query_type, move_type, recorded, owner, troops)) in enumerate(zip(log, frames)):
+        assert (frame.query_type, frame.move_type, frame.records, frame.me) == (query_type, move_type, recorded, 0)
+        assert frame.owner.tolist() == owner[:log.territories]
+        assert frame.troops.tolist() == troops[:log.territories]
+        records += log.records(i)
+    return records
+
+
+def test_game_log_round_trips(tmp_path):
+    path = str(tmp_path / "game.log")
+    recorder = None
+    frames = []
+
+    def record(game, bot_state, query, move):
+        nonlocal recorder
+        if game.state.me.player_id != 0:
+            return
+        if recorder is None:
+            recorder = bot.GameRecorder(path, game, bot_state.map_index)
+        recorder.write(game, bot_state, query, move)
+        ownership = bot_state.ownership
+        frames.append((type(query), type(move), len(game.state.recording), [-1 if o is None else o for o in ownership.owner], list(ownership.troops)))
+
+    _, seats = play(5, after_move=record)
+    recorder.close()
+    recording = seats[0][0].state.recording
+
+    log = bot.GameLog.open(path)
+    try:
+        records = logged_records(log, frames)
+        assert len(records) == frames[-1][2]
+
+        # Records come back as None when the log doesn't keep them, and otherwise encode as they did.
+        for original, decoded in zip(recording, records):
+            if decoded is not None:
+                words, again = [], []
+                bot.GameLog.encode_record(original, words)
+                bot.GameLog.encode_record(decoded, again)
+                assert words == again
+
+        # The bot answers every logged query the same way again.
+        assert replay.replay(bot, log)["differ"] == 0
+    finally:
+        log.close()
+
+
+def test_battle_history_wraps(monkeypatch):
+    # A ring much smaller than the game, so it wraps many times over.
+    monkeypatch.setattr(bot, "BATTLE_HISTORY", 64)
+    _, seats = play(2)
+    game, bot_state = seats[0]
+    history = bot_state.battles
+    assert history.capacity == 64
+
+    # Every roll of the game, worked out from the recording as far as the bot has read it (which is
+    # only up to its last query).
+    recording = game.state.recording[:bot_state.dispatcher.cursor]
+    defences = {record.move_attack_id: record for record in recording if isinstance(record, bot.MoveDefend)}
+    rolls = []
+    turn = 0
+    for record in recording:
+        if isinstance(record, bot.RecordStartTurn):
+            turn += 1
+        elif isinstance(record, bot.RecordAttack):
+            attack = recording[record.move_attack_id]
+            defence = defences.get(record.move_attack_id)
+            rolls.append((
+                turn, attack.move_by_player, defence.move_by_player if defence is not None else -1, attack.attacking_territory, attack.defending_territory,
+                attack.attacking_troops, defence.defending_troops if defence is not None else record.attacking_lost + record.defending_lost,
+                record.attacking_lost, record.defending_lost, int(record.territory_conquered),
+            ))
+    assert history.rolls == len(rolls) > history.capacity
+    assert history.turns == turn
+
+    columns = (history.turn, history.attacker, history.defender, history.source, history.target, history.attacking_dice,
+               history.defending_dice, history.attacking_lost, history.defending_lost, history.conquered)
+    for i in range(len(rolls) - history.capacity, len(rolls)):
+        assert tuple(column[i % history.capacity] for column in columns) == rolls[i]
+
+    # The running totals cover the whole game.
+    for player in range(bot.MAX_PLAYERS):
+        mine = [roll for roll in rolls if roll[1] == player]
+        assert history.rolls_by[player] == len(mine)
+        assert history.lost_by[player] == sum(roll[7] for roll in mine)
+        assert history.killed_by[player] == sum(roll[8] for roll in mine)
+        assert history.conquests_by[player] == sum(roll[9] for roll in mine)
+
+    # Queries about the last few turns read the ring, so they can only be checked as far back as it goes.
+    kept = rolls[-history.capacity:]
+    turns = max(1, history.turns - kept[0][0])
+    since = history.turns - turns + 1
+    recent = [roll for roll in rolls if roll[0] >= since]
+    assert all(roll in kept for roll in recent)
+    for territory in {roll[3] for roll in recent}:
+        lost = sum(roll[7] for roll in recent if roll[3] == territory)
+        killed = sum(roll[8] for roll in recent if roll[3] == territory)
+        assert history.loss_rate_from(territory, turns=turns) == (lost / (lost + killed) if lost + killed else 0.5)
+    for continent in range(len(bot_state.map_index.continent_names)):
+        counts = [0] * bot.MAX_PLAYERS
+        for roll in recent:
+            if bot_state.map_index.continent_of[roll[4]] == continent:
+                counts[roll[1]] += 1
+        assert history.continent_attackers(continent, turns) == counts
@@ -0,0 +1,241 @@
+"""Play many seeded games between bots on the local engine, in parallel, and report how they did.
+
+Each entrant is a path to a bot file that offers `create_bot_state(game)` and
+`choose_move(game, bot_state, query)`, like `my_submission.py`. Seats are dealt round-robin
+between the entrants and rotated every game, so every entrant plays from every seat. With --stats
+DIR, every bot that keeps query stats writes them to DIR at the end of each game, the way it does to
+BOT_STATS_PATH in a real game, and they are added up per entrant with query_stats.py.
+
+    python tournament.py --games 2000 --players 4 my_submission.py old_submission.py
+    python tournament.py --games 200 --stats stats/ my_submission.py
+"""
+
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from dataclasses import dataclass, field
+import importlib.util
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from types import ModuleType
+from typing import Optional
+
+from local_engine import LocalEngine, LocalGame, LocalMap
+import query_stats
+
+
+@dataclass
+class GameJob():
+    seed: int
+    entrants: list[str]
+    players: int
+    territories: Optional[int] = None
+    max_turns: int = 400
+    stats_dir: Optional[str] = None
+
+
+@dataclass
+class GameSummary():
+    seed: int
+    seats: list[int]
+    winner: Optional[int]
+    turns: int
+    records: int
+    banned: dict[int, str]
+    seconds: float
+
+    # Query type -> entrant -> (queries answered, total seconds, slowest seconds).
+    timings: dict[str, dict[int, tuple[int, float, float]]] = field(default_factory=dict)
+
+    # Entrant -> queries answered by the bot's deadline watchdog instead of its handlers.
+    fallbacks: dict[int, int] = field(default_factory=dict)
+
+
+_modules: dict[str, ModuleType] = {}
+
+
+def load_bot(path: str) -> ModuleType:
+    """Import a bot file under a name of its own, so two versions of the bot can play each other."""
+    path = os.path.abspath(path)
+    if path not in _modules:
+        name = f"_entrant_{len(_modules)}"
+        spec = importlib.util.spec_from_file_location(name, path)
+        assert spec is not None and spec.loader is not None, f"can't load {path}"
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        for attribute in ("create_bot_state", "choose_move"):
+            if not hasattr(module, attribute):
+                raise SystemExit(f"{path} has no {attribute}(), so it can't be played locally")
+        _modules[path] = module
+    return _modules[path]
+
+
+def play_game(job: GameJob) -> GameSummary:
+    """Play one game. This runs in a worker process."""
+    random.seed(job.seed)
+    game_map = LocalMap.generate_large(job.seed, job.territories) if job.territories else LocalMap.generate(job.seed)
+    seats = [(job.seed + i) % len(job.entrants) for i in range(job.players)]
+    timings: dict[str, dict[int, list]] = defaultdict(lambda: defaultdict(lambda: [0, 0.0, 0.0]))
+    bot_states = []
+
+    engine = LocalEngine(job.players, job.seed, game_map, job.max_turns)
+
+    def timed_policy(entrant: int, game: LocalGame):
+        module = load_bot(job.entrants[entrant])
+        bot_state = module.create_bot_state(game)
+        bot_states.append((entrant, bot_state))
+
+        def policy(query):
+            start = time.perf_counter()
+            move = module.choose_move(game, bot_state, query)
+            elapsed = time.perf_counter() - start
+            timing = timings[type(query).__name__][entrant]
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+            return move
+        return policy
+
+    policies = [timed_policy(entrant, game) for entrant, game in zip(seats, engine.games)]
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = engine.play(policies)
+    seconds = time.perf_counter() - start
+
+    fallbacks: Counter = Counter()
+    for seat, (entrant, bot_state) in enumerate(bot_states):
+        stats = getattr(bot_state, "stats", None)
+        if stats is not None:
+            fallbacks[entrant] += sum(stats.fallbacks.values())
+            if job.stats_dir is not None:
+                stats.dump(stats_path(job.stats_dir, job.seed, seat, entrant))
+
+    return GameSummary(
+        seed=job.seed,
+        seats=seats,
+        winner=result.winner,
+        turns=result.turns,
+        records=result.records,
+        banned=result.banned,
+        seconds=seconds,
+        timings={q: {e: tuple(t) for e, t in per_entrant.items()} for q, per_entrant in timings.items()},
+        fallbacks=dict(fallbacks),
+    )
+
+
+def stats_path(stats_dir: str, seed: int, seat: int, entrant: int) -> str:
+    return os.path.join(stats_dir, f"game{seed}_seat{seat}_entrant{entrant}.json")
+
+
+def entrant_stats(stats_dir: str, results: list[GameSummary], entrant: int) -> Optional[dict]:
+    """The entrant's query stats added up over the games, or None if it didn't write any."""
+    files = [stats_path(stats_dir, r.seed, seat, entrant) for r in results for seat, e in enumerate(r.seats) if e == entrant]
+    files = [path for path in files if os.path.exists(path)]
+    return query_stats.aggregate(query_stats.load(files)) if files else None
+
+
+def run_tournament(entrants: list[str], games: int, players: int, seed: int = 0, workers: Optional[int] = None, territories: Optional[int] = None, stats_dir: Optional[str] = None) -> list[GameSummary]:
+    jobs = [GameJob(seed + i, entrants, players, territories, stats_dir=stats_dir) for i in range(games)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(play_game, jobs, chunksize=max(1, games // (8 * (workers or os.cpu_count() or 1)))))
+
+
+def summarise(entrants: list[str], results: list[GameSummary]) -> dict:
+    wins = Counter()
+    seats = Counter()
+    bans = Counter()
+    for result in results:
+        seats.update(result.seats)
+        if result.winner is not None:
+            wins[result.seats[result.winner]] += 1
+        for player in result.banned:
+            if player >= 0:
+                bans[result.seats[player]] += 1
+
+    timings: dict[str, dict[int, list]] = defaultdict(lambda: defaultdict(lambda: [0, 0.0, 0.0]))
+    for result in results:
+        for query_type, per_entrant in result.timings.items():
+            for entrant, (count, total, slowest) in per_entrant.items():
+                timing = timings[query_type][entrant]
+                timing[0] += count
+                timing[1] += total
+                timing[2] = max(timing[2], slowest)
+
+    turns = [r.turns for r in results]
+    return {
+        "games": len(results),
+        "entrants": [
+            {
+                "path": path,
+                "seats": seats[i],
+                "wins": wins[i],
+                # An entrant's win rate is per game it played in, so it is comparable across seat counts.
+                "win_rate": wins[i] / max(1, sum(1 for r in results if i in r.seats)),
+                "bans": bans[i],
+                "fallbacks": sum(r.fallbacks.get(i, 0) for r in results),
+                "handlers": {
+                    query_type: {
+                        "queries": per_entrant[i][0],
+                        "mean_us": 1e6 * per_entrant[i][1] / max(1, per_entrant[i][0]),
+                        "max_us": 1e6 * per_entrant[i][2],
+                    }
+                    for query_type, per_entrant in sorted(timings.items()) if i in per_entrant
+                },
+            }
+            for i, path in enumerate(entrants)
+        ],
+        "undecided": sum(1 for r in results if r.winner is None),
+        "turns": {"mean": statistics.fmean(turns), "median": statistics.median(turns), "max": max(turns)} if turns else {},
+        "records_mean": statistics.fmean(r.records for r in results) if results else 0,
+        "game_seconds_mean": statistics.fmean(r.seconds for r in results) if results else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("entrants", nargs="*", default=["my_submission.py"], help="bot files to play against each other")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--territories", type=int, default=None, help="play on a generated map of this size instead of a classic-shaped one")
+    parser.add_argument("--stats", default=None, metavar="DIR", help="have the bots write their query stats to this directory, and add them up")
+    parser.add_argument("--json", default=None, help="also write the summary to this file")
+    args = parser.parse_args()
+
+    if args.stats is not None:
+        os.makedirs(args.stats, exist_ok=True)
+    start = time.perf_counter()
+    results = run_tournament(args.entrants, args.games, args.players, args.seed, args.workers, args.territories, args.stats)
+    summary = summarise(args.entrants, results)
+    summary["wall_seconds"] = time.perf_counter() - start
+    if args.stats is not None:
+        for i, entrant in enumerate(summary["entrants"]):
+            entrant["stats"] = entrant_stats(args.stats, results, i)
+
+    print(f"{summary['games']} games in {summary['wall_seconds']:.1f}s, {summary['undecided']} undecided")
+    if summary["turns"]:
+        print(f"turns: mean {summary['turns']['mean']:.1f}, median {summary['turns']['median']}, max {summary['turns']['max']}")
+    for entrant in summary["entrants"]:
+        print(f"\n{entrant['path']}: {entrant['wins']} wins in {entrant['seats']} seats ({100 * entrant['win_rate']:.1f}% of games), {entrant['bans']} bans, {entrant['fallbacks']} watchdog fallbacks")
+        for query_type, timing in entrant["handlers"].items():
+            print(f"  {query_type:<24} {timing['queries']:>9} queries  mean {timing['mean_us']:>9.1f}us  max {timing['max_us']:>10.1f}us")
+        if entrant.get("stats"):
+            print("  query stats:")
+            query_stats.report(entrant["stats"], indent="    ")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()